@@ -0,0 +1,297 @@
+import argparse
+import collections
+import concurrent.futures
+import os
+import random
+import time
+
+import numpy as np
+
+import decode
+import descriptions
+from capture import CaptureReader, kind_session
+from topics import Topics, checksum
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+frameTypes = {203: "main", 20: "optional"}
+outputFormats = ("parquet", "npz")
+
+
+# vectorized frame codecs, called with the byte columns at the topic's offsets like their decode.py counterparts
+
+def word_minus_1(b1: np.ndarray, b2: np.ndarray) -> np.ndarray:
+    return b1.astype(np.int64) * 256 + b2 - 1
+
+
+def get_pump_flow(fraction: np.ndarray, integer: np.ndarray) -> np.ndarray:
+    # np.round() matches round() for all 65536 byte pairs, --verify checks it
+    return np.round(integer + (fraction - 1.0) / 256, 2)
+
+
+# the quarters added by decode.get_temp_with_fraction() for the fraction bits 0 to 7
+temperatureFractions = np.array([0, 0, .25, .5, .75, 0, 0, 0])
+
+
+def get_temp_with_fraction(value: np.ndarray, fractional: np.ndarray) -> np.ndarray:
+    return (value.astype(np.int64) - 128) + temperatureFractions[fractional]
+
+
+def get_inlet_temp(value: np.ndarray, fraction_byte: np.ndarray) -> np.ndarray:
+    return get_temp_with_fraction(value, fraction_byte & 0b111)
+
+
+def get_outlet_temp(value: np.ndarray, fraction_byte: np.ndarray) -> np.ndarray:
+    return get_temp_with_fraction(value, (fraction_byte >> 3) & 0b111)
+
+
+# error codes are text, all byte pairs are formatted once by decode.get_error_info()
+errorTable: np.ndarray = None
+
+
+def get_error_info(error_type: np.ndarray, error_number: np.ndarray) -> np.ndarray:
+    global errorTable
+    if errorTable is None:
+        errorTable = np.array([[decode.get_error_info(t, n) for n in range(256)] for t in range(256)])
+    return errorTable[error_type, error_number]
+
+
+knownModels = np.array(descriptions.knownModels, dtype=np.uint8)
+
+
+def get_model(*model: np.ndarray) -> np.ndarray:
+    model = np.stack(model, axis=1)
+    result = np.full(len(model), -1, dtype=np.int64)
+    # backwards, so the first matching model wins like in decode.get_model()
+    for index in range(len(knownModels) - 1, -1, -1):
+        result[(model == knownModels[index]).all(axis=1)] = index
+    return result
+
+
+frameCodecs = {
+    "word_minus_1": word_minus_1,
+    "pump_flow": get_pump_flow,
+    "inlet_temp": get_inlet_temp,
+    "outlet_temp": get_outlet_temp,
+    "error_info": get_error_info,
+    "model": get_model,
+}
+
+
+class BatchDecoder:
+    # decodes a matrix of frames of one type, one frame per row, into one column per topic. Single byte codecs
+    # index the topic's 256 entry lookup table with the byte column, the others use the vectorized codecs above.
+    def __init__(self, topic_type: str):
+        self.topicType = topic_type
+        self.topics = [topic for topic in Topics().topics if topic.type == topic_type]
+        # (name, table or None, codec or None, offsets)
+        self.plans = [(topic.name, None if topic.values is None else np.array(topic.values),
+                       frameCodecs[topic.codec] if topic.values is None else None, topic.offsets)
+                      for topic in self.topics]
+
+    def decode(self, frames: np.ndarray) -> ():
+        # returns the valid frames mask and the columns of the valid frames
+        valid = (frames.sum(axis=1, dtype=np.uint32) & 0xFF) == 0
+        frames = frames[valid]
+        columns = {}
+        for name, table, fnc, offsets in self.plans:
+            if table is not None:
+                columns[name] = table[frames[:, offsets[0]]]
+            else:
+                columns[name] = fnc(*[frames[:, offset] for offset in offsets])
+        return valid, columns
+
+
+# decoders of a worker process, created on its first chunk
+decoders = {}
+
+
+def decode_chunk(topic_type: str, times: np.ndarray, frames: np.ndarray) -> ():
+    decoder = decoders.get(topic_type)
+    if decoder is None:
+        decoder = decoders[topic_type] = BatchDecoder(topic_type)
+    valid, columns = decoder.decode(frames)
+    return topic_type, int(len(valid) - valid.sum()), {"time": times[valid], **columns}
+
+
+def read_chunks(reader: CaptureReader, chunk_frames: int) -> iter:
+    # yields (frame type, wall clock times, frame matrix) of up to chunk_frames frames of one type
+    buffers = {topic_type: (bytearray(), []) for topic_type in frameTypes.values()}
+    session_offset = 0.0
+    for kind, wall, monotonic, frame in reader.records():
+        if kind == kind_session:
+            session_offset = wall - monotonic
+            continue
+        topic_type = frameTypes.get(len(frame))
+        if topic_type is None:
+            continue
+        data, times = buffers[topic_type]
+        data += frame
+        times.append(monotonic + session_offset)
+        if len(times) >= chunk_frames:
+            yield chunk(topic_type, data, times)
+            buffers[topic_type] = (bytearray(), [])
+    for topic_type, (data, times) in buffers.items():
+        if times:
+            yield chunk(topic_type, data, times)
+
+
+def chunk(topic_type: str, data: bytearray, times: []) -> ():
+    return topic_type, np.array(times), np.frombuffer(bytes(data), dtype=np.uint8).reshape(len(times), -1)
+
+
+class ParquetOutput:
+    # one parquet file per frame type, every chunk becomes a row group
+    def __init__(self, prefix: str):
+        if pyarrow is None:
+            raise ValueError("parquet output needs pyarrow, install it or use --format npz")
+        self.prefix = prefix
+        self.writers = {}
+
+    def write(self, topic_type: str, columns: {}):
+        table = pyarrow.table({name: pyarrow.array(column) for name, column in columns.items()})
+        writer = self.writers.get(topic_type)
+        if writer is None:
+            writer = self.writers[topic_type] = pyarrow.parquet.ParquetWriter(
+                F"{self.prefix}-{topic_type}.parquet", table.schema, compression="zstd")
+        writer.write_table(table)
+
+    def close(self) -> []:
+        for writer in self.writers.values():
+            writer.close()
+        return [F"{self.prefix}-{topic_type}.parquet" for topic_type in self.writers]
+
+
+class NpzOutput:
+    # one compressed npz file per frame type with an array per column, written when all chunks are decoded
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.chunks = collections.defaultdict(list)
+
+    def write(self, topic_type: str, columns: {}):
+        self.chunks[topic_type].append(columns)
+
+    def close(self) -> []:
+        paths = []
+        for topic_type, chunks in self.chunks.items():
+            path = F"{self.prefix}-{topic_type}.npz"
+            np.savez_compressed(path, **{name: np.concatenate([columns[name] for columns in chunks])
+                                         for name in chunks[0]})
+            paths.append(path)
+        return paths
+
+
+def decode_capture(path: str, prefix: str, output_format: str = "parquet", workers: int = 0,
+                   chunk_frames: int = 100000) -> {}:
+    # decodes a capture into columnar files, chunks are decoded by a pool of worker processes (0 for
+    # one per cpu) while the next ones are read. Returns frame counts per type.
+    output = ParquetOutput(prefix) if output_format == "parquet" else NpzOutput(prefix)
+    reader = CaptureReader(path)
+    counts = collections.Counter()
+
+    def write(result: ()):
+        topic_type, invalid, columns = result
+        counts[topic_type] += len(columns["time"])
+        counts["invalid"] += invalid
+        output.write(topic_type, columns)
+
+    workers = workers or os.cpu_count()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            pending = collections.deque()
+            for topic_type, times, frames in read_chunks(reader, chunk_frames):
+                pending.append(pool.submit(decode_chunk, topic_type, times, frames))
+                # bounded, so a capture larger than the memory streams through
+                if len(pending) >= workers * 2:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+    finally:
+        reader.close()
+        counts["files"] = output.close()
+    return counts
+
+
+def random_frames(count: int, size: int, seed: int = 1) -> np.ndarray:
+    # random frames with valid checksums, a few broken ones, and known models in half the main frames
+    rng = random.Random(seed)
+    frames = bytearray()
+    for i in range(count):
+        frame = bytearray(rng.randbytes(size))
+        if size == 203 and i % 2:
+            frame[129:139] = bytes(rng.choice(descriptions.knownModels))
+        if i % 100:
+            frame[-1] = checksum(frame[:-1])
+        frames += frame
+    return np.frombuffer(bytes(frames), dtype=np.uint8).reshape(count, size)
+
+
+def verify(topic_type: str, frames: np.ndarray) -> int:
+    # decodes the frames with the batch decoder and with Topics.decode_and_update() frame by frame and
+    # compares every value including its type. Returns the number of mismatches.
+    started = time.perf_counter()
+    valid, columns = BatchDecoder(topic_type).decode(frames)
+    batch_elapsed = time.perf_counter() - started
+
+    topics = Topics()
+    streamed = [topic for topic in topics.topics if topic.type == topic_type]
+    values = {topic.name: [] for topic in streamed}
+    streamed_valid = []
+    started = time.perf_counter()
+    for frame in frames:
+        changed = topics.decode_and_update(frame.tobytes())
+        streamed_valid.append(changed is not None)
+        if changed is not None:
+            for topic in streamed:
+                values[topic.name].append(topic.value)
+    stream_elapsed = time.perf_counter() - started
+
+    mismatches = 0
+    if streamed_valid != valid.tolist():
+        print(F"{topic_type}: frames rejected differently")
+        mismatches += 1
+    for name, column in columns.items():
+        for row, (batch, stream) in enumerate(zip(column.tolist(), values[name])):
+            if batch != stream or type(batch) is not type(stream):
+                print(F"{topic_type}: {name} differs in frame {row}: batch {batch!r}, streaming {stream!r}")
+                mismatches += 1
+                break
+    print(F"{topic_type}: {len(frames)} frames, {int(valid.sum())} valid, {len(columns)} topics, "
+          F"batch {len(frames) / batch_elapsed:.0f} frames/s, streaming {len(frames) / stream_elapsed:.0f} frames/s, "
+          F"{mismatches} mismatches")
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="decode pyshamon captures into parquet or npz columns")
+    parser.add_argument("command", choices=("decode", "verify"))
+    parser.add_argument("file", nargs="?", help="capture file, optional for verify")
+    parser.add_argument("output", nargs="?", help="output path prefix, <prefix>-main.<format> and -optional")
+    parser.add_argument("--format", choices=outputFormats, default="parquet")
+    parser.add_argument("--workers", type=int, default=0, help="decoding processes, 0 for one per cpu")
+    parser.add_argument("--chunk", type=int, default=100000, help="frames decoded at once per process")
+    parser.add_argument("--random", type=int, default=20000, help="random frames per type checked by verify")
+    args = parser.parse_args()
+
+    if args.command == "decode":
+        if args.file is None or args.output is None:
+            parser.error("decode needs a capture file and an output prefix")
+        started = time.perf_counter()
+        result = decode_capture(args.file, args.output, args.format, args.workers, args.chunk)
+        elapsed = time.perf_counter() - started
+        print(F"{result['main']} main and {result['optional']} optional frames decoded in {elapsed:.1f}s, "
+              F"{result['invalid']} with invalid checksums skipped, written to {', '.join(result['files'])}")
+    else:
+        failed = 0
+        for topic_type, size in (("main", 203), ("optional", 20)):
+            failed += verify(topic_type, random_frames(args.random, size))
+        if args.file is not None:
+            capture = CaptureReader(args.file)
+            for topic_type, _, frames in read_chunks(capture, 1 << 62):
+                failed += verify(topic_type, frames)
+            capture.close()
+        exit(1 if failed else 0)
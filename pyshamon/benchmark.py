@@ -0,0 +1,445 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import socket
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import decode
+from simulator import Simulator, sampleMainFrame, noisyBytes
+from topics import Topics, checksum, valid_checksum
+
+
+def sample_frames(count: int, seed: int = 0, change_rate: float = 0.2) -> []:
+    # random walk on the noisy bytes, consecutive frames differ in a handful of bytes like on a real unit
+    rnd = random.Random(seed)
+    frame = bytearray(sampleMainFrame)
+    frames = []
+    for _ in range(count):
+        for offset in noisyBytes:
+            if rnd.random() < change_rate:
+                frame[offset] = max(1, min(254, frame[offset] + rnd.choice((-1, 1))))
+        frame[-1] = checksum(frame[:-1])
+        frames.append(bytes(frame))
+    return frames
+
+
+def legacy_decoder(topics: Topics) -> []:
+    # one lambda plus one decode helper call per topic, the way topics were decoded before compilation
+    decoders = []
+    for topic in topics.topics:
+        if topic.type != "main":
+            continue
+        if topic.codec in decode.byteCodecs:
+            decoders.append((topic, lambda d, f=decode.byteCodecs[topic.codec], o=topic.offsets[0]: f(d[o])))
+        else:
+            decoders.append((topic, lambda d, f=decode.frameCodecs[topic.codec], o=topic.offsets: f(*[d[i] for i in o])))
+    return decoders
+
+
+def run_legacy(topics: Topics, frames: []):
+    decoders = legacy_decoder(topics)
+    for frame in frames:
+        if not valid_checksum(frame):
+            continue
+        for topic, fnc in decoders:
+            value = fnc(frame)
+            if value != topic.value:
+                topic.value = value
+                topic.since = datetime.now()
+                topic.description = topic.describe(value)
+
+
+def run_compiled(topics: Topics, frames: []):
+    for frame in frames:
+        topics.decode_and_update(frame)
+
+
+def best_of(fnc: any, count: int, repeat: int) -> float:
+    # microseconds per item of the fastest run
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fnc()
+        elapsed = (time.perf_counter() - start) / count
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1e6, 3)
+
+
+def benchmark_checksum(count: int, repeat: int) -> {}:
+    frames = sample_frames(count)
+
+    def run():
+        for frame in frames:
+            valid_checksum(frame)
+    return {"frames": count, "us_per_frame": best_of(run, count, repeat)}
+
+
+def benchmark_on_receive(count: int, repeat: int) -> {}:
+    # Heatpump.on_receive with decoding and the per topic callback, the port is a simulator pty nobody talks to
+    from heatpump import Heatpump
+    frames = sample_frames(count)
+    simulator = Simulator()
+    calls = [0]
+
+    def on_topic_received(topic) -> bool:
+        calls[0] += 1
+        return True
+
+    heatpump = Heatpump(simulator.port, 0, 0, on_topic_received, lambda topic_type, raw: None)
+    try:
+        def run():
+            for frame in frames:
+                heatpump.on_receive(frame)
+        result = best_of(run, count, repeat)
+    finally:
+        heatpump.serial.close()
+        simulator.stop()
+    return {"frames": count, "us_per_frame": result, "callbacks_per_frame": round(calls[0] / (count * repeat), 2)}
+
+
+def benchmark_raw_diff(count: int, repeat: int) -> {}:
+    from pyshamon import raw_diff
+    frames = sample_frames(count + 1)
+
+    def run():
+        for old, new in zip(frames, frames[1:]):
+            raw_diff(old, new)
+    return {"frames": count, "us_per_frame": best_of(run, count, repeat)}
+
+
+def measure(fnc: any, frames: [], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        topics = Topics()
+        start = time.perf_counter()
+        fnc(topics, frames)
+        elapsed = (time.perf_counter() - start) / len(frames)
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e6
+
+
+def benchmark_decode(count: int, repeat: int) -> {}:
+    frames = sample_frames(count)
+    before = measure(run_legacy, frames, repeat)
+    after = measure(run_compiled, frames, repeat)
+    return {"frames": count, "legacy_us_per_frame": round(before, 2), "compiled_us_per_frame": round(after, 2),
+            "speedup": round(before / after, 2)}
+
+
+class StandInBroker:
+    # minimal mqtt 3.1.1/5 broker in its own process: accepts clients, acknowledges connects,
+    # subscriptions and pings and counts publishes. It does not route messages.
+    def __init__(self):
+        self.published = multiprocessing.Value("Q", 0)
+        self.connections = multiprocessing.Value("Q", 0)
+        # time.monotonic() of the first and the last publish since the last reset(), comparable across processes
+        self.firstPublished = multiprocessing.Value("d", 0, lock=False)
+        self.lastPublished = multiprocessing.Value("d", 0, lock=False)
+        self.ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=self.serve, daemon=True)
+        self.port = None
+
+    def start(self) -> int:
+        self.process.start()
+        self.port = self.ready.get(timeout=10)
+        return self.port
+
+    def reset(self):
+        with self.published.get_lock():
+            self.firstPublished.value = 0
+            self.lastPublished.value = 0
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    def serve(self):
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        self.ready.put(server.getsockname()[1])
+        while True:
+            client, _ = server.accept()
+            with self.connections.get_lock():
+                self.connections.value += 1
+            threading.Thread(target=self.handle, args=(client,), daemon=True).start()
+
+    def handle(self, client: socket.socket):
+        buffer = b""
+        v5 = False
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return
+            buffer += data
+            while True:
+                packet = self.parse(buffer)
+                if packet is None:
+                    break
+                packet_type, body, size = packet
+                buffer = buffer[size:]
+                if packet_type == 1:
+                    v5 = body[6] == 5
+                    client.sendall(b"\x20\x03\x00\x00\x00" if v5 else b"\x20\x02\x00\x00")
+                elif packet_type == 3:
+                    received = time.monotonic()
+                    with self.published.get_lock():
+                        self.published.value += 1
+                        if not self.firstPublished.value:
+                            self.firstPublished.value = received
+                        self.lastPublished.value = received
+                elif packet_type == 8:
+                    client.sendall(bytes([0x90, 4 if v5 else 3]) + body[:2] + (b"\x00" if v5 else b"") + b"\x01")
+                elif packet_type == 12:
+                    client.sendall(b"\xd0\x00")
+                elif packet_type == 14:
+                    client.close()
+                    return
+
+    @staticmethod
+    def parse(buffer: bytes) -> any:
+        length = 0
+        multiplier = 1
+        for i in range(1, min(len(buffer), 5)):
+            length += (buffer[i] & 0x7F) * multiplier
+            multiplier *= 128
+            if not buffer[i] & 0x80:
+                size = i + 1 + length
+                if len(buffer) < size:
+                    return None
+                return buffer[0] >> 4, buffer[i + 1:size], size
+        return None
+
+
+def legacy_publish(mqtt, published_topics: [], topic):
+    # the publish path before per-topic plans: list lookup, string formatting and new properties per value
+    from paho.mqtt.properties import Properties
+    from paho.mqtt.packettypes import PacketTypes
+    if topic.name.lower() in published_topics:
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.UserProperty = ("dt", str(int(topic.timestamp())))
+        properties.UserProperty = ("dsc", topic.description)
+        mqtt.client.publish(
+            f"{mqtt.topic_base}/{topic.type}/{topic.name}",
+            payload=topic.value, qos=0, retain=True, properties=properties)
+
+
+async def measure_publish(broker: StandInBroker, rounds: int) -> {}:
+    from mqtt import MQTT
+    topics = Topics()
+    topics.decode_and_update(sampleMainFrame)
+    main_topics = [topic for topic in topics.topics if topic.type == "main"]
+    names = [topic.name.lower() for topic in topics.topics]
+    mqtt = MQTT(protocol_version=5, host="127.0.0.1", port=broker.port, topic_base="benchmark", on_command=None,
+                published_topics=names, subscribed_commands=[])
+    mqtt.prepare(topics.topics)
+    await mqtt.run()
+    while not mqtt.client.is_connected():
+        await asyncio.sleep(0.01)
+
+    result = {}
+    for name, publish in (("legacy", lambda t: legacy_publish(mqtt, names, t)), ("planned", mqtt.publish)):
+        expected = broker.published.value + rounds * len(main_topics)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for topic in main_topics:
+                publish(topic)
+            # let the event loop write the queued packets
+            await asyncio.sleep(0)
+        cpu = time.perf_counter() - start
+        while broker.published.value < expected:
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        result[name] = {"publish_us": round(cpu / (rounds * len(main_topics)) * 1e6, 2),
+                        "publishes_per_second": round(rounds * len(main_topics) / elapsed)}
+    await mqtt.stop()
+    return result
+
+
+def benchmark_publish(rounds: int) -> {}:
+    broker = StandInBroker()
+    broker.start()
+    try:
+        return asyncio.run(measure_publish(broker, rounds))
+    finally:
+        broker.stop()
+
+
+async def measure_end_to_end(broker: StandInBroker, simulator: Simulator, polls: int) -> {}:
+    # poll the simulator and take the time from its last written byte to the broker receiving
+    # the first and the last publish of the decoded frame
+    from heatpump import Heatpump
+    from mqtt import MQTT
+    mqtt = MQTT(protocol_version=5, host="127.0.0.1", port=broker.port, topic_base="benchmark", on_command=None,
+                published_topics=[], subscribed_commands=[])
+    heatpump = Heatpump(simulator.port, 0, 0, mqtt.publish, None)
+    mqtt.published_topics = set(topic.name.lower() for topic in heatpump.topics.topics if topic.type == "main")
+    mqtt.prepare(heatpump.topics.topics)
+    await mqtt.run()
+    task = asyncio.get_running_loop().create_task(heatpump.run())
+    while not mqtt.client.is_connected():
+        await asyncio.sleep(0.01)
+
+    first = []
+    last = []
+    for _ in range(polls + 1):
+        broker.reset()
+        published = broker.published.value
+        heatpump.send_poll()
+        deadline = time.monotonic() + 5
+        # the answer changes a few measured bytes, wait until the broker got the changed topics
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            if broker.published.value > published and time.monotonic() - broker.lastPublished.value > 0.05:
+                break
+        if broker.firstPublished.value and simulator.answered:
+            first.append((broker.firstPublished.value - simulator.answered) * 1e3)
+            last.append((broker.lastPublished.value - simulator.answered) * 1e3)
+
+    heatpump.shutdown()
+    await task
+    await mqtt.stop()
+    # the first poll publishes every topic, the following ones only the changed topics
+    first, last = first[1:], last[1:]
+    if not first:
+        return {"polls": 0}
+    first.sort()
+    last.sort()
+    return {"polls": len(first),
+            "first_publish_ms": {"median": round(first[len(first) // 2], 3), "max": round(first[-1], 3)},
+            "last_publish_ms": {"median": round(last[len(last) // 2], 3), "max": round(last[-1], 3)}}
+
+
+def benchmark_end_to_end(polls: int) -> {}:
+    simulator = Simulator(delay=0, noise=0.5)
+    simulator.start()
+    broker = StandInBroker()
+    broker.start()
+    try:
+        return asyncio.run(measure_end_to_end(broker, simulator, polls))
+    finally:
+        broker.stop()
+        simulator.stop()
+
+
+async def measure_fleet(broker: StandInBroker, simulators: [], polls: int) -> {}:
+    # several heat pumps in one process on one mqtt connection, polled at the same time
+    from heatpump import Heatpump
+    from memreport import rss_kb
+    from mqtt import MQTT
+    connections = broker.connections.value
+    rss = rss_kb()
+    tracemalloc.start()
+    traced = tracemalloc.get_traced_memory()[0]
+    mqtt = MQTT(protocol_version=5, host="127.0.0.1", port=broker.port, topic_base="benchmark", on_command=None,
+                published_topics=[], subscribed_commands=[])
+    heatpumps = []
+    for index, simulator in enumerate(simulators):
+        namespace = mqtt.add_namespace(F"unit{index}", None)
+        heatpump = Heatpump(simulator.port, 0, 0, namespace.publish, None)
+        namespace.published_topics = set(topic.name.lower() for topic in heatpump.topics.topics)
+        namespace.prepare(heatpump.topics.topics)
+        heatpumps.append(heatpump)
+    await mqtt.run()
+    tasks = [asyncio.get_running_loop().create_task(heatpump.run()) for heatpump in heatpumps]
+    while not mqtt.client.is_connected():
+        await asyncio.sleep(0.01)
+
+    rounds = []
+    for _ in range(polls + 1):
+        frames = [heatpump.frameReader.frames for heatpump in heatpumps]
+        start = time.perf_counter()
+        for heatpump in heatpumps:
+            heatpump.send_poll()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and \
+                any(heatpump.frameReader.frames == count for heatpump, count in zip(heatpumps, frames)):
+            await asyncio.sleep(0.001)
+        rounds.append((time.perf_counter() - start) * 1e3)
+    units_traced = tracemalloc.get_traced_memory()[0] - traced
+    tracemalloc.stop()
+
+    for heatpump in heatpumps:
+        heatpump.shutdown()
+    await asyncio.gather(*tasks)
+    await mqtt.stop()
+    # the first round publishes every topic, the following ones only the changed topics
+    rounds = sorted(rounds[1:])
+    return {"units": len(heatpumps), "mqtt_connections": broker.connections.value - connections,
+            "traced_kb_per_unit": round(units_traced / 1024 / len(heatpumps), 1),
+            "rss_growth_kb": rss_kb() - rss,
+            "poll_round_ms": {"median": round(rounds[len(rounds) // 2], 3), "max": round(rounds[-1], 3)}}
+
+
+def benchmark_fleet(units: int, polls: int) -> {}:
+    # the simulators answer without delay, a poll round measures the time until every unit decoded its frame
+    simulators = [Simulator(delay=0, noise=0.5) for _ in range(units)]
+    for simulator in simulators:
+        simulator.start()
+    broker = StandInBroker()
+    broker.start()
+    try:
+        return asyncio.run(measure_fleet(broker, simulators, polls))
+    finally:
+        broker.stop()
+        for simulator in simulators:
+            simulator.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="pyshamon benchmarks")
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--publish-rounds", type=int, default=100)
+    parser.add_argument("--polls", type=int, default=20, help="end to end polls through the simulator")
+    parser.add_argument("--fleet", type=int, default=8, help="heat pumps sharing one process, 0 to skip")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {"checksum": benchmark_checksum(args.frames, args.repeat)}
+    print(F"checksum: {results['checksum']['us_per_frame']}us/frame")
+
+    results["decode"] = benchmark_decode(args.frames, args.repeat)
+    print(F"decode: {results['decode']['legacy_us_per_frame']}us/frame before, "
+          F"{results['decode']['compiled_us_per_frame']}us/frame after ({results['decode']['speedup']}x)")
+
+    results["on_receive"] = benchmark_on_receive(args.frames, args.repeat)
+    print(F"on_receive: {results['on_receive']['us_per_frame']}us/frame, "
+          F"{results['on_receive']['callbacks_per_frame']} topic callbacks/frame")
+
+    results["raw_diff"] = benchmark_raw_diff(args.frames, args.repeat)
+    print(F"raw_diff: {results['raw_diff']['us_per_frame']}us/frame")
+
+    results["publish"] = benchmark_publish(args.publish_rounds)
+    print(F"publish: {results['publish']['legacy']['publishes_per_second']}/s before, "
+          F"{results['publish']['planned']['publishes_per_second']}/s after "
+          F"({results['publish']['legacy']['publish_us']}us -> {results['publish']['planned']['publish_us']}us per call)")
+
+    results["end_to_end"] = benchmark_end_to_end(args.polls)
+    if results["end_to_end"]["polls"]:
+        print(F"end to end: serial to broker {results['end_to_end']['first_publish_ms']['median']}ms first, "
+              F"{results['end_to_end']['last_publish_ms']['median']}ms last publish (median of "
+              F"{results['end_to_end']['polls']} polls)")
+
+    if args.fleet:
+        results["fleet"] = [benchmark_fleet(units, args.polls) for units in sorted({1, args.fleet})]
+        for fleet in results["fleet"]:
+            print(F"fleet: {fleet['units']} heat pumps on {fleet['mqtt_connections']} mqtt connection, "
+                  F"{fleet['traced_kb_per_unit']}kB traced per unit, rss +{fleet['rss_growth_kb']}kB, "
+                  F"poll round {fleet['poll_round_ms']['median']}ms median")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"time": datetime.now().isoformat(timespec="seconds"), "machine": platform.machine(),
+                       "platform": platform.platform(), "python": platform.python_version(),
+                       "arguments": vars(args), "results": results}, output, indent=2)
+        print(F"results written to {args.output}")
@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import heapq
+import logging
+import mmap
+import os
+import struct
+import time
+
+# a capture is a sequence of records, each starting with its kind:
+#   session: wall clock and time.monotonic() when capturing started, frame times are monotonic
+#   frame:   time.monotonic(), length, the frame's bytes
+#   repeat:  time.monotonic() of the last repeat, length, count of identical frames following the last frame
+#            of that length
+magic = b"PYSHCAP1"
+kind_session = 0
+kind_frame = 1
+kind_repeat = 2
+
+sessionRecord = struct.Struct("<Bdd")
+frameRecord = struct.Struct("<BdH")
+repeatRecord = struct.Struct("<BdHI")
+recordSizes = {kind_session: sessionRecord.size, kind_frame: frameRecord.size, kind_repeat: repeatRecord.size}
+
+
+def record_size(data: any, offset: int) -> int:
+    # size of the record at offset, None if it is cut off by the end of data or of an unknown kind
+    size = recordSizes.get(data[offset])
+    if size is None or offset + size > len(data):
+        return None
+    if data[offset] == kind_frame:
+        size += frameRecord.unpack_from(data, offset)[2]
+        if offset + size > len(data):
+            return None
+    return size
+
+
+def complete_length(data: any) -> int:
+    # length up to the end of the last complete record
+    offset = len(magic)
+    while offset < len(data):
+        size = record_size(data, offset)
+        if size is None:
+            break
+        offset += size
+    return offset
+
+
+def sync(fileno: int):
+    try:
+        os.fsync(fileno)
+    except OSError as err:
+        logging.warning(F"capture: failed to sync to disk: {err}")
+
+
+class CaptureWriter:
+    # the file is flushed to disk every flush_interval seconds of frames, together with the pending repeats,
+    # so a crash or power cut loses at most that much of the capture. A record torn by a crash is cut off
+    # when the capture is opened again.
+    def __init__(self, path: str, flush_interval: float = 10):
+        self.path = path
+        self.flushInterval = flush_interval
+        if os.path.exists(path):
+            self.truncate_torn_record()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        if new:
+            self.file.write(magic)
+        self.file.write(sessionRecord.pack(kind_session, time.time(), time.monotonic()))
+        # last frame and pending repeats per frame length, main and optional frames alternate on the bus
+        self.last = {}
+        self.repeats = {}
+        self.frames = 0
+        self.written = 0
+        self.flushed: float = None
+        # the fsync running in the event loop's executor
+        self.syncing: asyncio.Future = None
+
+    def truncate_torn_record(self):
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return
+        with open(self.path, "rb") as file:
+            if size < len(magic):
+                length = 0
+            else:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if data[:len(magic)] != magic:
+                        raise ValueError(F"{self.path} is not a pyshamon capture")
+                    length = complete_length(data)
+        if length < size:
+            logging.warning(F"capture: cutting off {size - length} bytes of a torn record at the end of {self.path}")
+            os.truncate(self.path, length)
+
+    def write(self, frame: bytes, monotonic: float = None):
+        if monotonic is None:
+            monotonic = time.monotonic()
+        self.frames += 1
+        length = len(frame)
+        if self.last.get(length) == frame:
+            count, _ = self.repeats.get(length, (0, 0))
+            self.repeats[length] = (count + 1, monotonic)
+        else:
+            self.write_frame(frame, monotonic)
+        if self.flushed is None:
+            self.flushed = monotonic
+        elif monotonic - self.flushed >= self.flushInterval:
+            self.flush()
+            self.flushed = monotonic
+
+    def write_frame(self, frame: bytes, monotonic: float):
+        length = len(frame)
+        # repeats end with any new frame, so records stay in the order frames were received
+        for pending in list(self.repeats):
+            self.flush_repeats(pending)
+        self.last[length] = bytes(frame)
+        # one write per record, a crash tears at most the last one
+        self.file.write(frameRecord.pack(kind_frame, monotonic, length) + frame)
+        self.written += 1
+
+    def flush_repeats(self, length: int):
+        pending = self.repeats.pop(length, None)
+        if pending is not None:
+            count, monotonic = pending
+            self.file.write(repeatRecord.pack(kind_repeat, monotonic, length, count))
+
+    def flush(self):
+        # a repeat run ends here, identical frames after it start a new run continuing from its last repeat
+        for length in list(self.repeats):
+            self.flush_repeats(length)
+        self.file.flush()
+        # an fsync can take long on an sd card, on the event loop it must not hold up serial reads
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            sync(self.file.fileno())
+            return
+        if self.syncing is None or self.syncing.done():
+            self.syncing = loop.run_in_executor(None, sync, self.file.fileno())
+
+    def close(self):
+        for length in list(self.repeats):
+            self.flush_repeats(length)
+        self.file.close()
+        logging.info(F"capture: {self.frames} frames captured as {self.written} records in {self.path}")
+
+
+def spread(first: float, step: float, count: int, frame: bytes) -> iter:
+    for i in range(1, count + 1):
+        yield first + step * i, frame
+
+
+class CaptureReader:
+    # reads through a memory map, so captures larger than the available memory can be replayed
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(magic)] != magic:
+            raise ValueError(F"{path} is not a pyshamon capture")
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def records(self) -> iter:
+        # yields (kind, wall time of the session start, monotonic time, frame) with repeats expanded evenly
+        # between the repeated frame and the last repeat
+        data = self.map
+        offset = len(magic)
+        session_wall = 0.0
+        session_monotonic = 0.0
+        last = {}
+        repeats = []
+        while offset < len(data):
+            kind = data[offset]
+            if kind in recordSizes and record_size(data, offset) is None:
+                logging.warning(F"capture: {self.path} ends in a torn record at offset {offset}, "
+                                F"skipping its last {len(data) - offset} bytes")
+                break
+            if repeats and kind != kind_repeat:
+                # repeats of main and optional frames ran side by side, interleave them again by time
+                for monotonic, frame in heapq.merge(*repeats, key=lambda repeat: repeat[0]):
+                    yield kind_repeat, session_wall, monotonic, frame
+                repeats = []
+            if kind == kind_session:
+                _, session_wall, session_monotonic = sessionRecord.unpack_from(data, offset)
+                offset += sessionRecord.size
+                last = {}
+                yield kind_session, session_wall, session_monotonic, None
+            elif kind == kind_frame:
+                _, monotonic, length = frameRecord.unpack_from(data, offset)
+                offset += frameRecord.size
+                frame = data[offset:offset + length]
+                offset += length
+                last[length] = (monotonic, frame)
+                yield kind_frame, session_wall, monotonic, frame
+            elif kind == kind_repeat:
+                _, monotonic, length, count = repeatRecord.unpack_from(data, offset)
+                offset += repeatRecord.size
+                first, frame = last[length]
+                step = (monotonic - first) / count
+                repeats.append(spread(first, step, count, frame))
+                last[length] = (monotonic, frame)
+            else:
+                raise ValueError(F"{self.path}: unknown record kind {kind} at offset {offset}, capture is damaged")
+        for monotonic, frame in heapq.merge(*repeats, key=lambda repeat: repeat[0]):
+            yield kind_repeat, session_wall, monotonic, frame
+
+
+async def replay(reader: CaptureReader, on_receive: any, speed: float = 1.0) -> int:
+    # feeds the captured frames to on_receive, e.g. Heatpump.on_receive, at speed times real time or
+    # as fast as possible with speed 0
+    loop = asyncio.get_running_loop()
+    start = None
+    frames = 0
+    for kind, _, monotonic, frame in reader.records():
+        if kind == kind_session:
+            start = None
+            continue
+        if speed > 0:
+            if start is None:
+                start = (loop.time(), monotonic)
+            delay = start[0] + (monotonic - start[1]) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        try:
+            on_receive(frame)
+        except Exception as err:
+            logging.error(F"capture: error while replaying frame at {monotonic:.3f}: {err}")
+        frames += 1
+    return frames
+
+
+def info(reader: CaptureReader):
+    sessions = frames = records = 0
+    duration = 0.0
+    first = None
+    for kind, wall, monotonic, _ in reader.records():
+        if kind == kind_session:
+            sessions += 1
+            first = monotonic
+            print(F"session {sessions}: started {time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(wall))}")
+            continue
+        frames += 1
+        records += kind == kind_frame
+        duration = max(duration, monotonic - first)
+    print(F"{frames} frames in {records} frame records, {os.path.getsize(reader.path)} bytes, "
+          F"last session {duration:.0f}s")
+
+
+if __name__ == '__main__':
+    from heatpump import Heatpump
+
+    parser = argparse.ArgumentParser(description="inspect and replay pyshamon frame captures")
+    parser.add_argument("command", choices=("info", "replay"))
+    parser.add_argument("file")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, e.g. 10 for 10x, 0 for maximum")
+    parser.add_argument("--verbose", action="store_true", help="log every changed topic")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+
+    capture = CaptureReader(args.file)
+    if args.command == "info":
+        info(capture)
+    else:
+        changes = [0]
+
+        def on_topic_received(topic) -> bool:
+            changes[0] += 1
+            logging.info(F"topic: {topic}")
+            return True
+
+        heatpump = Heatpump(None, 0, 0, on_topic_received, None)
+        started = time.perf_counter()
+        replayed = asyncio.run(replay(capture, heatpump.on_receive, args.speed))
+        elapsed = time.perf_counter() - started
+        print(F"replayed {replayed} frames in {elapsed:.1f}s, {changes[0]} topic changes")
+    capture.close()
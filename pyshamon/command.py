@@ -1,3 +1,6 @@
+import logging
+import time
+
 from topics import checksum
 
 panasonicPollQuery = [0x71, 0x6c, 0x01, 0x10] + [0x00]*106
@@ -5,313 +8,326 @@ panasonicSendQuery = [0xf1, 0x6c, 0x01, 0x10] + [0x00]*106
 optionalPCBQuery = [0xF1, 0x11, 0x01, 0x50, 0x00, 0x00, 0x40, 0xFF, 0xFF, 0xE5,
                     0xFF, 0xFF, 0x00, 0xFF, 0xEB, 0xFF, 0xFF, 0x00, 0x00]
 
-
-class Command:
-
+# complete frames including the checksum, copied for every new command
+pollQuery = bytes(panasonicPollQuery + [checksum(panasonicPollQuery)])
+sendTemplate = bytes(panasonicSendQuery + [checksum(panasonicSendQuery)])
+optionalPCBTemplate = bytes(optionalPCBQuery + [checksum(optionalPCBQuery)])
+
+
+def on_off(on: int, off: int) -> any:
+    return lambda value: on if value else off
+
+
+def plus(offset: int) -> any:
+    return lambda value: value + offset
+
+
+def clamped(minimum: int, maximum: int, encode: any) -> any:
+    return lambda value: encode(min(maximum, max(minimum, value)))
+
+
+def lookup(values: ()) -> any:
+    # values outside the table are sent as 0
+    return lambda value: values[value] if 0 <= value < len(values) else 0
+
+
+def reported(mask: int) -> any:
+    # the heat pump reports the bits of mask at the command's byte offset of its main frame as they were sent
+    return lambda reported_byte, sent: reported_byte & mask == sent & mask
+
+
+# operation modes reported differently than sent: auto as auto(heat) or auto(cool), auto + DHW alike
+reportedOperationModes = {24: (25, 26), 40: (41, 42)}
+
+
+def reported_operation_mode(reported_byte: int, sent: int) -> bool:
+    return reported_byte & 0x3F in reportedOperationModes.get(sent & 0x3F, (sent & 0x3F,))
+
+
+# name, byte offset, encoder, minimum, maximum, read back check (None for commands only triggering an action)
+commandTable = [
+    # set heatpump state to on by sending 1
+    ("SetHeatpump", 4, on_off(2, 1), 0, 1, reported(0x03)),
+    # set pump state to on by sending 1
+    ("SetPump", 4, on_off(32, 16), 0, 1, reported(0x30)),
+    # set max pump duty
+    ("SetMaxPumpDuty", 45, plus(1), 0, 254, reported(0xFF)),
+    # set 0 for Off mode, set 1 for Quiet mode 1, set 2 for Quiet mode 2, set 3 for Quiet mode 3
+    ("SetQuietMode", 7, clamped(0, 3, lambda mode: (mode + 1) * 8), 0, 3, reported(0x38)),
+    # z1 heat request temp -  set from -5 to 5 to get same temperature shift point or set direct temp
+    ("SetZ1HeatRequestTemperature", 38, plus(128), -128, 127, reported(0xFF)),
+    # z1 cool request temp -  set from -5 to 5 to get same temperature shift point or set direct temp
+    ("SetZ1CoolRequestTemperature", 39, plus(128), -128, 127, reported(0xFF)),
+    # z2 heat request temp -  set from -5 to 5 to get same temperature shift point or set direct temp
+    ("SetZ2HeatRequestTemperature", 40, plus(128), -128, 127, reported(0xFF)),
+    # z2 cool request temp -  set from -5 to 5 to get same temperature shift point or set direct temp
+    ("SetZ2CoolRequestTemperature", 41, plus(128), -128, 127, reported(0xFF)),
+    # set mode to force DHW by sending 1
+    ("SetForceDHW", 4, on_off(128, 64), 0, 1, reported(0xC0)),
+    # set mode to force defrost  by sending 1
+    ("SetForceDefrost", 8, on_off(2, 0), 0, 1, None),
+    # set mode to force sterilization by sending 1
+    ("SetForceSterilization", 8, on_off(4, 0), 0, 1, None),
+    # set Holiday mode by sending 1, off will be 0
+    ("SetHolidayMode", 5, on_off(32, 16), 0, 1, reported(0x30)),
+    # set Powerful mode by sending 0 = off, 1 for 30min, 2 for 60min, 3 for 90 min
+    ("SetPowerfulMode", 7, clamped(0, 3, plus(73)), 0, 3, reported(0x07)),
+    # set Heat pump operation mode  3 = DHW only, 0 = heat only, 1 = cool only,
+    # 2 = Auto, 4 = Heat+DHW, 5 = Cool+DHW, 6 = Auto + DHW
+    ("SetOperationMode", 6, lookup((18, 19, 24, 33, 34, 35, 40)), 0, 6, reported_operation_mode),
+    # set DHW temperature by sending desired temperature between 40C-75C
+    ("SetDHWTemp", 42, plus(128), -128, 127, reported(0xFF)),
+    # set heat/cool curves on z1 and z2
+    ("SetZ1HeatCurveTargetHighTemp", 75, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ1HeatCurveTargetLowTemp", 76, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ1HeatCurveOutsideHighTemp", 78, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ1HeatCurveOutsideLowTemp", 77, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ2HeatCurveTargetHighTemp", 79, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ2HeatCurveTargetLowTemp", 80, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ2HeatCurveOutsideHighTemp", 82, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ2HeatCurveOutsideLowTemp", 81, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ1CoolCurveTargetHighTemp", 86, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ1CoolCurveTargetLowTemp", 87, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ1CoolCurveOutsideHighTemp", 89, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ1CoolCurveOutsideLowTemp", 88, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ2CoolCurveTargetHighTemp", 90, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ2CoolCurveTargetLowTemp", 91, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ2CoolCurveOutsideHighTemp", 93, plus(128), -128, 127, reported(0xFF)),
+    ("SetZ2CoolCurveOutsideLowTemp", 92, plus(128), -128, 127, reported(0xFF)),
+    # set zones to active
+    ("SetZones", 6, lookup((64, 128, 192)), 0, 2, reported(0xC0)),
+    ("SetFloorHeatDelta", 84, plus(128), -128, 127, reported(0xFF)),
+    ("SetFloorCoolDelta", 94, plus(128), -128, 127, reported(0xFF)),
+    ("SetDHWHeatDelta", 99, plus(128), -128, 127, reported(0xFF)),
+    ("SetReset", 8, on_off(1, 0), 0, 1, None),
+    ("SetHeaterDelayTime", 104, plus(1), 0, 254, reported(0xFF)),
+    ("SetHeaterStartDelta", 105, plus(128), -128, 127, reported(0xFF)),
+    ("SetHeaterStopDelta", 106, plus(128), -128, 127, reported(0xFF)),
+    ("SetMainSchedule", 5, on_off(128, 64), 0, 1, reported(0xC0)),
+    ("SetAltExternalSensor", 20, on_off(32, 16), 0, 1, reported(0x30)),
+    ("SetExternalPadHeater", 25, lambda mode: 48 if mode == 2 else 32 if mode == 1 else 16, 0, 2, reported(0x30)),
+    ("SetBufferDelta", 59, plus(128), -128, 127, reported(0xFF)),
+]
+
+
+def bits(bit: int, maximum: int) -> any:
+    return lambda value: min(maximum, max(0, value)) << bit
+
+
+# name, byte offset, encoder, minimum, maximum, mask of the bits written
+optionalCommandTable = [
+    ("SetHeatCoolMode", 6, lambda value: (1 if value == 1 else 0) << 7, 0, 1, 0b1 << 7),
+    ("SetCompressorState", 6, lambda value: (1 if value == 1 else 0) << 6, 0, 1, 0b1 << 6),
+    ("SetSmartGridMode", 6, bits(4, 3), 0, 3, 0b11 << 4),
+    ("SetExternalThermostat1State", 6, bits(2, 3), 0, 3, 0b11 << 2),
+    ("SetExternalThermostat2State", 6, bits(0, 3), 0, 3, 0b11),
+    ("SetDemandControl", 14, int, 0, 255, 0xFF),
+    ("SetPoolTemp", 7, int, 0, 255, 0xFF),
+    ("SetBufferTemp", 8, int, 0, 255, 0xFF),
+    ("SetZ1RoomTemp", 10, int, 0, 255, 0xFF),
+    ("SetZ1WaterTemp", 16, int, 0, 255, 0xFF),
+    ("SetZ2RoomTemp", 11, int, 0, 255, 0xFF),
+    ("SetZ2WaterTemp", 15, int, 0, 255, 0xFF),
+    ("SetSolarTemp", 13, int, 0, 255, 0xFF),
+    ("SetOptPCBByte9", 9, int, 0, 255, 0xFF),
+]
+
+
+class CommandSpec:
+    __slots__ = ("name", "offset", "encode", "minimum", "maximum", "mask", "optional", "readback")
+
+    def __init__(self, name: str, offset: int, encode: any, minimum: int, maximum: int, mask: int = 0xFF,
+                 optional: bool = False, readback: any = None):
+        self.name = name
+        self.offset = offset
+        self.encode = encode
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mask = mask
+        self.optional = optional
+        self.readback = readback
+
+    def accepts(self, value: int) -> bool:
+        return self.minimum <= value <= self.maximum
+
+
+# case folded command name -> spec, built once for main and optional pcb commands
+commands = {row[0].lower(): CommandSpec(*row[:5], readback=row[5]) for row in commandTable}
+optionalCommands = {row[0].lower(): CommandSpec(*row, optional=True) for row in optionalCommandTable}
+
+
+def find_command(name: str) -> CommandSpec:
+    return commands.get(name.lower()) or optionalCommands.get(name.lower())
+
+
+class Frame:
+    # query template plus checksum byte. Writes adjust the checksum by the difference of the changed byte.
+    def __init__(self, template: bytes):
+        self.query = bytearray(template)
+        self.checksum = len(template) - 1
+
+    def write(self, offset: int, value: int, mask: int = 0xFF) -> bool:
+        # returns whether the byte changed
+        old = self.query[offset]
+        new = (old & ~mask) | (value & mask)
+        self.query[offset] = new
+        self.query[self.checksum] = (self.query[self.checksum] + old - new) & 0xFF
+        return new != old
+
+
+class Command(Frame):
     def __init__(self):
-        self.send_query = panasonicSendQuery.copy()
-        self.optional_query = optionalPCBQuery.copy()
-        self.commands = {
-            # set heatpump state to on by sending 1
-            "SetHeatpump": self.set_heatpump_state,
-            # set pump state to on by sending 1
-            "SetPump": self.set_pump_service_mode,
-            # set max pump duty
-            "SetMaxPumpDuty": self.set_max_pump_duty,
-            # set 0 for Off mode, set 1 for Quiet mode 1, set 2 for Quiet mode 2, set 3 for Quiet mode 3
-            "SetQuietMode": self.set_quiet_mode,
-            # z1 heat request temp -  set from -5 to 5 to get same temperature shift point or set direct temp
-            "SetZ1HeatRequestTemperature": self.set_z1_heat_request_temperature,
-            # z1 cool request temp -  set from -5 to 5 to get same temperature shift point or set direct temp
-            "SetZ1CoolRequestTemperature": self.set_z1_cool_request_temperature,
-            # z2 heat request temp -  set from -5 to 5 to get same temperature shift point or set direct temp
-            "SetZ2HeatRequestTemperature": self.set_z2_heat_request_temperature,
-            # z2 cool request temp -  set from -5 to 5 to get same temperature shift point or set direct temp
-            "SetZ2CoolRequestTemperature": self.set_z2_cool_request_temperature,
-            # set mode to force DHW by sending 1
-            "SetForceDHW": self.set_force_dhw,
-            # set mode to force defrost  by sending 1
-            "SetForceDefrost": self.set_force_defrost,
-            # set mode to force sterilization by sending 1
-            "SetForceSterilization": self.set_force_sterilization,
-            # set Holiday mode by sending 1, off will be 0
-            "SetHolidayMode": self.set_holiday_mode,
-            # set Powerful mode by sending 0 = off, 1 for 30min, 2 for 60min, 3 for 90 min
-            "SetPowerfulMode": self.set_powerful_mode,
-            # set Heat pump operation mode  3 = DHW only, 0 = heat only, 1 = cool only,
-            # 2 = Auto, 4 = Heat+DHW, 5 = Cool+DHW, 6 = Auto + DHW
-            "SetOperationMode": self.set_operation_mode,
-            # set DHW temperature by sending desired temperature between 40C-75C
-            "SetDHWTemp": self.set_dhw_temp,
-            # set heat/cool curves on z1 and z2
-            "SetZ1HeatCurveTargetHighTemp": self.set_z1_heat_curve_target_high_temp,
-            "SetZ1HeatCurveTargetLowTemp": self.set_z1_heat_curve_target_low_temp,
-            "SetZ1HeatCurveOutsideHighTemp": self.set_z1_heat_curve_outside_high_temp,
-            "SetZ1HeatCurveOutsideLowTemp": self.set_z1_heat_curve_outside_low_temp,
-            "SetZ2HeatCurveTargetHighTemp": self.set_z2_heat_curve_target_high_temp,
-            "SetZ2HeatCurveTargetLowTemp": self.set_z2_heat_curve_target_low_temp,
-            "SetZ2HeatCurveOutsideHighTemp": self.set_z2_heat_curve_outside_high_temp,
-            "SetZ2HeatCurveOutsideLowTemp": self.set_z2_heat_curve_outside_low_temp,
-            "SetZ1CoolCurveTargetHighTemp": self.set_z1_cool_curve_target_high_temp,
-            "SetZ1CoolCurveTargetLowTemp": self.set_z1_cool_curve_target_low_temp,
-            "SetZ1CoolCurveOutsideHighTemp": self.set_z1_cool_curve_outside_high_temp,
-            "SetZ1CoolCurveOutsideLowTemp": self.set_z1_cool_curve_outside_low_temp,
-            "SetZ2CoolCurveTargetHighTemp": self.set_z2_cool_curve_target_high_temp,
-            "SetZ2CoolCurveTargetLowTemp": self.set_z2_cool_curve_target_low_temp,
-            "SetZ2CoolCurveOutsideHighTemp": self.set_z2_cool_curve_outside_high_temp,
-            "SetZ2CoolCurveOutsideLowTemp": self.set_z2_cool_curve_outside_low_temp,
-            # set zones to active
-            "SetZones": self.set_zones,
-            "SetFloorHeatDelta": self.set_floor_heat_delta,
-            "SetFloorCoolDelta": self.set_floor_cool_delta,
-            "SetDHWHeatDelta": self.set_dhw_heat_delta,
-            "SetReset": self.set_reset,
-            "SetHeaterDelayTime": self.set_heater_delay_time,
-            "SetHeaterStartDelta": self.set_heater_start_delta,
-            "SetHeaterStopDelta": self.set_heater_stop_delta,
-            "SetMainSchedule": self.set_main_schedule,
-            "SetAltExternalSensor": self.set_alt_external_sensor,
-            "SetExternalPadHeater": self.set_external_pad_heater,
-            "SetBufferDelta": self.set_buffer_delta,
-        }
-
-    def command_query(self) -> []:
-        return self.send_query + [checksum(self.send_query)]
-
-    def poll_query(self) -> []:
-        return panasonicPollQuery.copy() + [checksum(panasonicPollQuery)]
-
-    def known_commands(self) -> []:
-        return list(self.commands)
-
-    def reset(self):
-        self.send_query = panasonicSendQuery.copy()
-
-    def set(self, command: str, value: int) -> bool:
-        for name, fnc in self.commands.items():
-            if name.lower() == command.lower():
-                fnc(value)
-                return True
-
-        return False
-
-    def set_command(self, index: int, byte: int):
-        self.send_query[index] = byte & 0xFF
-
-    def set_heatpump_state(self, onoff: int):
-        self.set_command(4, 2 if onoff else 1)
-
-    def set_pump_service_mode(self, onoff: int):
-        self.set_command(4, 32 if onoff else 16)
-
-    def set_max_pump_duty(self, duty: int):
-        self.set_command(45, duty + 1)
-
-    def set_quiet_mode(self, mode: int):
-        self.set_command(7, (min(3, max(0, mode))+1) * 8)
-
-    def set_z1_heat_request_temperature(self, temperature: int):
-        self.set_command(38, temperature + 128)
-
-    def set_z1_cool_request_temperature(self, temperature: int):
-        self.set_command(39, temperature + 128)
-
-    def set_z2_heat_request_temperature(self, temperature: int):
-        self.set_command(40, temperature + 128)
-
-    def set_z2_cool_request_temperature(self, temperature: int):
-        self.set_command(41, temperature + 128)
-
-    def set_force_dhw(self, onoff: int):
-        self.set_command(4, 128 if onoff else 64)
-
-    def set_force_defrost(self, onoff: int):
-        self.set_command(8, 2 if onoff else 0)
-
-    def set_force_sterilization(self, onoff: int):
-        self.set_command(8, 4 if onoff else 0)
-
-    def set_holiday_mode(self, onoff: int):
-        self.set_command(5, 32 if onoff else 16)
-
-    def set_powerful_mode(self, mode: int):
-        self.set_command(7, min(3, max(0, mode)) + 73)
-
-    def set_dhw_temp(self, temperature: int):
-        self.set_command(42, temperature + 128)
-
-    def set_operation_mode(self, mode):
-        self.set_command(6, [18, 19, 24, 33, 34, 35, 40][mode] if mode < 7 else 0)
-
-    def set_zones(self, mode):
-        self.set_command(6, [64, 128, 192][mode] if mode < 3 else 0)
-
-    def set_floor_heat_delta(self, delta):
-        self.set_command(84, delta + 128)
-
-    def set_floor_cool_delta(self, delta):
-        self.set_command(94, delta + 128)
-
-    def set_dhw_heat_delta(self, delta):
-        self.set_command(99, delta + 128)
-
-    def set_reset(self, onoff: int):
-        self.set_command(8, 1 if onoff else 0)
-
-    def set_heater_delay_time(self, time):
-        self.set_command(104, time + 1)
-
-    def set_heater_start_delta(self, delta):
-        self.set_command(105, delta + 128)
-
-    def set_heater_stop_delta(self, delta):
-        self.set_command(106, delta + 128)
-
-    def set_main_schedule(self, onoff: int):
-        self.set_command(5, 128 if onoff else 64)
-
-    def set_alt_external_sensor(self, onoff: int):
-        self.set_command(20, 32 if onoff else 16)
-
-    def set_external_pad_heater(self, mode: int):
-        self.set_command(25, 48 if mode == 2 else 32 if mode == 1 else 16)
-
-    def set_buffer_delta(self, delta: int):
-        self.set_command(59, delta + 128)
+        Frame.__init__(self, sendTemplate)
+        # byte offsets written by the setters called so far
+        self.written = set()
 
-    def set_z1_heat_curve_target_high_temp(self, temp: int):
-        self.set_command(75, temp + 128)
+    def command_query(self) -> bytes:
+        return bytes(self.query)
 
-    def set_z1_heat_curve_target_low_temp(self, temp: int):
-        self.set_command(76, temp + 128)
-
-    def set_z1_heat_curve_outside_low_temp(self, temp: int):
-        self.set_command(77, temp + 128)
-
-    def set_z1_heat_curve_outside_high_temp(self, temp: int):
-        self.set_command(78, temp + 128)
-
-    def set_z2_heat_curve_target_high_temp(self, temp: int):
-        self.set_command(79, temp + 128)
-
-    def set_z2_heat_curve_target_low_temp(self, temp: int):
-        self.set_command(80, temp + 128)
-
-    def set_z2_heat_curve_outside_low_temp(self, temp: int):
-        self.set_command(81, temp + 128)
-
-    def set_z2_heat_curve_outside_high_temp(self, temp: int):
-        self.set_command(82, temp + 128)
-
-    def set_z1_cool_curve_target_high_temp(self, temp: int):
-        self.set_command(86, temp + 128)
-
-    def set_z1_cool_curve_target_low_temp(self, temp: int):
-        self.set_command(87, temp + 128)
-
-    def set_z1_cool_curve_outside_low_temp(self, temp: int):
-        self.set_command(88, temp + 128)
-
-    def set_z1_cool_curve_outside_high_temp(self, temp: int):
-        self.set_command(89, temp + 128)
-
-    def set_z2_cool_curve_target_high_temp(self, temp: int):
-        self.set_command(90, temp + 128)
-
-    def set_z2_cool_curve_target_low_temp(self, temp: int):
-        self.set_command(91, temp + 128)
-
-    def set_z2_cool_curve_outside_low_temp(self, temp: int):
-        self.set_command(92, temp + 128)
-
-    def set_z2_cool_curve_outside_high_temp(self, temp: int):
-        self.set_command(93, temp + 128)
-
-
-class OptionalCommand:
-
-    def __init__(self):
-        self.optional_query = optionalPCBQuery.copy()
-        self.commands = {
-            "SetHeatCoolMode": self.set_heat_cool_mode,
-            "SetCompressorState": self.set_compressor_state,
-            "SetSmartGridMode": self.set_smart_grid_mode,
-            "SetExternalThermostat1State": self.set_external_thermostat_1_state,
-            "SetExternalThermostat2State": self.set_external_thermostat_2_state,
-            "SetDemandControl": self.set_demand_control,
-            "SetPoolTemp": self.set_pool_temp,
-            "SetBufferTemp": self.set_buffer_temp,
-            "SetZ1RoomTemp": self.set_z1_room_temp,
-            "SetZ1WaterTemp": self.set_z1_water_temp,
-            "SetZ2RoomTemp": self.set_z2_room_temp,
-            "SetZ2WaterTemp": self.set_z2_water_temp,
-            "SetSolarTemp": self.set_solar_temp,
-            "SetOptPCBByte9": self.set_byte_9
-        }
-
-    def optional_command_query(self) -> []:
-        return self.optional_query + [checksum(self.optional_query)]
-
-    def known_commands(self) -> []:
-        return list(self.commands)
-
-    def reset(self):
-        self.optional_query = optionalPCBQuery.copy()
+    @staticmethod
+    def known_commands() -> []:
+        return [spec.name for spec in commands.values()]
 
     def set(self, command: str, value: int) -> bool:
-        for name, fnc in self.commands.items():
-            if name.lower() == command.lower():
-                fnc(value)
-                return True
-
-        return False
-
-    def set_byte_6(self, val, base, bit):
-        hex_val = (self.optional_query[6] & ~(base << bit)) | (val << bit)
-        self.optional_query[6] = hex_val
-        return len(self.optional_query)
-
-    def set_byte_9(self, set_pcb_value):
-        self.optional_query[9] = set_pcb_value
-
-    def set_heat_cool_mode(self, set_pcb_value: int):
-        self.set_byte_6(1 if set_pcb_value == 1 else 0, 0b1, 7)
-
-    def set_compressor_state(self, set_pcb_value: int):
-        self.set_byte_6(1 if set_pcb_value == 1 else 0, 0b1, 6)
-
-    def set_smart_grid_mode(self, set_pcb_value: int):
-        self.set_byte_6(0 if set_pcb_value < 0 else 3 if set_pcb_value > 3 else set_pcb_value, 0b11, 4)
-
-    def set_external_thermostat_1_state(self, set_pcb_value: int):
-        self.set_byte_6(0 if set_pcb_value < 0 else 3 if set_pcb_value > 3 else set_pcb_value, 0b11, 2)
-
-    def set_external_thermostat_2_state(self, set_pcb_value: int):
-        self.set_byte_6(0 if set_pcb_value < 0 else 3 if set_pcb_value > 3 else set_pcb_value, 0b11, 0)
-
-    def set_demand_control(self, set_pcb_value: int):
-        self.optional_query[14] = set_pcb_value
-
-    def set_xxx_temp(self, temp: int, byte):
-        self.optional_query[byte] = temp
-
-    def set_pool_temp(self, temp: int):
-        self.set_xxx_temp(temp, 7)
-
-    def set_buffer_temp(self, temp: int):
-        self.set_xxx_temp(temp, 8)
-
-    def set_z1_room_temp(self, temp: int):
-        self.set_xxx_temp(temp, 10)
-
-    def set_z1_water_temp(self, temp: int):
-        self.set_xxx_temp(temp, 16)
+        spec: CommandSpec = commands.get(command.lower())
+        if spec is None:
+            return False
+        self.write(spec.offset, spec.encode(value))
+        self.written.add(spec.offset)
+        return True
+
+
+class CommandBuffer:
+    # pending commands waiting for the next send slot. A command set again before it was sent only keeps
+    # its latest value, commands writing different bytes share one frame and commands writing the same
+    # byte (e.g. SetHeatpump and SetForceDHW on byte 4) go out in consecutive frames.
+    def __init__(self, max_pending: int = 32):
+        self.maxPending = max_pending
+        self.pending = {}
+        # time.monotonic() a pending command was first added, and how long the commands of the last frame waited
+        self.queued = {}
+        self.waited = []
+        # (spec, value) of the commands in the last frame
+        self.sent = []
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    @staticmethod
+    def known(command: str) -> bool:
+        return command.lower() in commands
+
+    def add(self, command: str, value: int) -> bool:
+        spec: CommandSpec = commands[command.lower()]
+        if spec not in self.pending and len(self.pending) >= self.maxPending:
+            self.dropped += 1
+            logging.warning(F"command: buffer full with {len(self.pending)} pending commands, dropping {spec.name}")
+            return False
+        self.pending[spec] = value
+        self.queued.setdefault(spec, time.monotonic())
+        return True
+
+    def pop(self) -> ():
+        # merges as many pending commands as possible into one frame, returns it with the merged command names
+        command = Command()
+        merged = []
+        for spec, value in self.pending.items():
+            if spec.offset not in command.written:
+                command.set(spec.name, value)
+                merged.append(spec)
+        now = time.monotonic()
+        self.waited = [now - self.queued.pop(spec) for spec in merged]
+        self.sent = [(spec, self.pending[spec]) for spec in merged]
+        for spec in merged:
+            del self.pending[spec]
+        return command, [spec.name for spec in merged]
+
+
+class Readback:
+    __slots__ = ("spec", "value", "sent", "firstSent", "lastSent", "attempts", "retryAt")
+
+    def __init__(self, spec: CommandSpec, value: int, sent: int, now: float):
+        self.spec = spec
+        self.value = value
+        # the byte sent at the command's offset
+        self.sent = sent
+        self.firstSent = now
+        self.lastSent = now
+        self.attempts = 1
+        self.retryAt: float = None
+
+
+class CommandReadback:
+    # sent commands waiting for the heat pump to report their value in a main frame. Frames within settle seconds
+    # after sending may still show the old state, the first frame after that decides: without the value the
+    # command is sent again after backoff seconds, doubling per retry, and given up after retries retries.
+    def __init__(self, settle: float = 2, retries: int = 3, backoff: float = 5, clock: any = time.monotonic):
+        self.settle = settle
+        self.retries = retries
+        self.backoff = backoff
+        self.clock = clock
+        self.pending = {}
+        self.acked = 0
+        self.nacked = 0
+        self.retried = 0
+
+    def sent(self, sent: [], query: bytes):
+        # called with CommandBuffer.sent and the frame once it is written to the bus
+        now = self.clock()
+        for spec, value in sent:
+            if spec.readback is None:
+                continue
+            readback = self.pending.get(spec)
+            if readback is not None and readback.value == value and readback.retryAt is not None:
+                readback.lastSent = now
+                readback.retryAt = None
+            else:
+                # a new value replaces one still waiting to be confirmed
+                self.pending[spec] = Readback(spec, value, query[spec.offset], now)
+
+    def check(self, frame: bytes) -> []:
+        # returns (readback, "ack", "retry" or "nack") for the commands decided by this main frame
+        now = self.clock()
+        outcomes = []
+        for spec, readback in list(self.pending.items()):
+            if readback.retryAt is not None:
+                continue
+            if spec.readback(frame[spec.offset], readback.sent):
+                del self.pending[spec]
+                self.acked += 1
+                outcomes.append((readback, "ack"))
+            elif now - readback.lastSent >= self.settle:
+                if readback.attempts > self.retries:
+                    del self.pending[spec]
+                    self.nacked += 1
+                    outcomes.append((readback, "nack"))
+                else:
+                    readback.retryAt = now + self.backoff * 2 ** (readback.attempts - 1)
+                    readback.attempts += 1
+                    self.retried += 1
+                    outcomes.append((readback, "retry"))
+        return outcomes
+
+
+class OptionalCommand(Frame):
+    def __init__(self):
+        Frame.__init__(self, optionalPCBTemplate)
+        # a setter changed a byte since the frame was last sent
+        self.changed = False
 
-    def set_z2_room_temp(self, temp: int):
-        self.set_xxx_temp(temp, 11)
+    def optional_command_query(self) -> bytes:
+        self.changed = False
+        return bytes(self.query)
 
-    def set_z2_water_temp(self, temp: int):
-        self.set_xxx_temp(temp, 15)
+    @staticmethod
+    def known_commands() -> []:
+        return [spec.name for spec in optionalCommands.values()]
 
-    def set_solar_temp(self, temp: int):
-        self.set_xxx_temp(temp, 13)
+    def set(self, command: str, value: int) -> bool:
+        spec: CommandSpec = optionalCommands.get(command.lower())
+        if spec is None:
+            return False
+        if self.write(spec.offset, spec.encode(value), spec.mask):
+            self.changed = True
+        return True
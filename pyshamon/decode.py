@@ -59,25 +59,25 @@ def int_minus_1_times_50(value):
 def get_op_mode(value):
     op_mode = int(value & 0b111111)
     if op_mode == 18:
-        return "0"
+        return 0
     elif op_mode == 19:
-        return "1"
+        return 1
     elif op_mode == 25:
-        return "2"
+        return 2
     elif op_mode == 33:
-        return "3"
+        return 3
     elif op_mode == 34:
-        return "4"
+        return 4
     elif op_mode == 35:
-        return "5"
+        return 5
     elif op_mode == 41:
-        return "6"
+        return 6
     elif op_mode == 26:
-        return "7"
+        return 7
     elif op_mode == 42:
-        return "8"
+        return 8
     else:
-        return "-1"
+        return -1
 
 
 def get_energy(value):
@@ -88,25 +88,24 @@ def word(b1, b2):
     return b1 * 256 + b2
 
 
-def get_model(data):
-    model = [data[129], data[130], data[131], data[132], data[133], data[134], data[135], data[136], data[137],
-             data[138]]
+def get_model(*model):
+    model = list(model)
     for i in range(len(descriptions.knownModels)):
         if model == descriptions.knownModels[i]:
             return i
     return -1
 
 
-def get_pump_flow(data):
-    pump_flow1 = int(data[170])
-    pump_flow2 = ((float(data[169]) - 1) / 256)
+def get_pump_flow(fraction, integer):
+    pump_flow1 = int(integer)
+    pump_flow2 = ((float(fraction) - 1) / 256)
     pump_flow = pump_flow1 + pump_flow2
     return round(pump_flow, 2)
 
 
-def get_error_info(data):
-    error_type = int(data[113])
-    error_number = int(data[114]) - 17
+def get_error_info(error_type, error_number):
+    error_type = int(error_type)
+    error_number = int(error_number) - 17
     if error_type == 177-128:
         return "F{:02X}".format(error_number)
     elif error_type == 161-128:
@@ -115,9 +114,8 @@ def get_error_info(data):
         return "?{:02X}:{:02X}".format(error_type, error_number)
 
 
-def get_inlet_temp(data):
-    value = float(int_minus_128(data[143]))
-    fractional = int(data[118] & 0b111)
+def get_temp_with_fraction(value, fractional):
+    value = float(int_minus_128(value))
     if fractional == 2:
         value += .25
     elif fractional == 3:
@@ -127,16 +125,16 @@ def get_inlet_temp(data):
     return value
 
 
-def get_outlet_temp(data):
-    value = float(int_minus_128(data[144]))
-    fractional = int((data[118] >> 3) & 0b111)
-    if fractional == 2:
-        value += .25
-    elif fractional == 3:
-        value += .5
-    elif fractional == 4:
-        value += .75
-    return value
+def get_inlet_temp(value, fraction_byte):
+    return get_temp_with_fraction(value, int(fraction_byte & 0b111))
+
+
+def get_outlet_temp(value, fraction_byte):
+    return get_temp_with_fraction(value, int((fraction_byte >> 3) & 0b111))
+
+
+def word_minus_1(b1, b2):
+    return word(b1, b2) - 1
 
 
 def get_first_byte(value_byte):
@@ -145,3 +143,65 @@ def get_first_byte(value_byte):
 
 def get_second_byte(value_byte):
     return (value_byte & 0b1111) - 1
+
+
+def raw_bit_1(value):
+    return value >> 7
+
+
+def raw_bits_2_and_3(value):
+    return (value >> 5) & 0b11
+
+
+def raw_bit_4(value):
+    return (value >> 4) & 0b1
+
+
+def raw_bits_5_and_6(value):
+    return (value >> 2) & 0b11
+
+
+def raw_bit_7(value):
+    return (value >> 1) & 0b1
+
+
+def raw_bit_8(value):
+    return value & 0b1
+
+
+# codecs decoding a single byte, these get compiled into 256 entry lookup tables
+byteCodecs = {
+    "bit_1": bit_1,
+    "bits_1_and_2": bits_1_and_2,
+    "bits_3_and_4": bits_3_and_4,
+    "bits_5_and_6": bits_5_and_6,
+    "bits_7_and_8": bits_7_and_8,
+    "bits_3_to_5": bits_3_to_5,
+    "left_5_bits": left_5_bits,
+    "right_3_bits": right_3_bits,
+    "int_minus_1": int_minus_1,
+    "int_minus_128": int_minus_128,
+    "int_minus_1_div_5": int_minus_1_div_5,
+    "int_minus_1_times_10": int_minus_1_times_10,
+    "int_minus_1_times_50": int_minus_1_times_50,
+    "op_mode": get_op_mode,
+    "energy": get_energy,
+    "first_byte": get_first_byte,
+    "second_byte": get_second_byte,
+    "raw_bit_1": raw_bit_1,
+    "raw_bits_2_and_3": raw_bits_2_and_3,
+    "raw_bit_4": raw_bit_4,
+    "raw_bits_5_and_6": raw_bits_5_and_6,
+    "raw_bit_7": raw_bit_7,
+    "raw_bit_8": raw_bit_8,
+}
+
+# codecs combining several bytes, called with the bytes at the topic's offsets in the given order
+frameCodecs = {
+    "word_minus_1": word_minus_1,
+    "pump_flow": get_pump_flow,
+    "inlet_temp": get_inlet_temp,
+    "outlet_temp": get_outlet_temp,
+    "error_info": get_error_info,
+    "model": get_model,
+}
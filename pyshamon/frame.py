@@ -0,0 +1,115 @@
+import logging
+
+# every frame starts with a header byte and a length byte, the total frame size is length + 3.
+# byte 3 selects main (0x10) or optional pcb (0x50) data, the last byte is the checksum.
+frameHeaders = (0x71, 0xF1)
+frameLengths = (0xC8, 0x6C, 0x11)
+frameTypes = (0x10, 0x50)
+
+maximum_frame_size = 0xFF + 3
+
+# what a frame is, told apart by its header and length byte. On a bus polled by another controller the
+# reader sees its queries as well as the heat pump's answers.
+kind_poll = "poll"
+kind_command = "command"
+kind_response = "response"
+kind_optional_query = "optional_query"
+kind_optional_response = "optional_response"
+kind_unknown = "unknown"
+frameKinds = {
+    (0x71, 0x6C): kind_poll,
+    (0xF1, 0x6C): kind_command,
+    (0x71, 0xC8): kind_response,
+    (0xF1, 0x11): kind_optional_query,
+    (0x71, 0x11): kind_optional_response,
+}
+# query kind -> the kind of its answer
+answerKinds = {kind_poll: kind_response, kind_command: kind_response, kind_optional_query: kind_optional_response}
+
+
+def classify(frame: bytes) -> str:
+    return frameKinds.get((frame[0], frame[1]), kind_unknown)
+
+
+class FrameReader:
+    def __init__(self):
+        self.buffer = bytearray(maximum_frame_size * 2)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.expected = 0
+        self.summed = 0
+        self.sum = 0
+
+        self.frames = 0
+        self.bytes = 0
+        self.checksumErrors = 0
+        self.skippedBytes = 0
+
+    def reset(self):
+        self.length = 0
+        self.expected = 0
+
+    def feed(self, data: bytes) -> []:
+        frames = []
+        offset = 0
+        self.bytes += len(data)
+        while offset < len(data):
+            # never copy more than fits into the preallocated buffer
+            chunk = min(len(data) - offset, len(self.buffer) - self.length)
+            self.buffer[self.length:self.length + chunk] = data[offset:offset + chunk]
+            self.length += chunk
+            offset += chunk
+            self.scan(frames)
+        return frames
+
+    def scan(self, frames: []):
+        start = 0
+        while True:
+            if self.expected == 0:
+                while start < self.length and self.buffer[start] not in frameHeaders:
+                    start += 1
+                    self.skippedBytes += 1
+                if self.length - start < 2:
+                    break
+                if self.buffer[start + 1] not in frameLengths:
+                    start += 1
+                    self.skippedBytes += 1
+                    continue
+                self.expected = self.buffer[start + 1] + 3
+                self.summed = 0
+                self.sum = 0
+
+            available = self.length - start
+            if available > 3 and self.buffer[start + 3] not in frameTypes:
+                self.expected = 0
+                start += 1
+                self.skippedBytes += 1
+                continue
+
+            # sum up the bytes received so far, so a complete frame only needs a final compare
+            end = min(self.expected, available)
+            if end > self.summed:
+                self.sum += sum(self.view[start + self.summed:start + end])
+                self.summed = end
+
+            if available < self.expected:
+                break
+
+            if self.sum & 0xFF != 0:
+                # no valid frame at this position, retry one byte later so a following frame survives
+                logging.debug(F"frame: invalid checksum on {self.expected} bytes frame, resyncing")
+                self.checksumErrors += 1
+                self.expected = 0
+                start += 1
+                self.skippedBytes += 1
+                continue
+
+            frames.append(bytes(self.view[start:start + self.expected]))
+            self.frames += 1
+            start += self.expected
+            self.expected = 0
+
+        if start > 0:
+            remaining = self.length - start
+            self.buffer[0:remaining] = self.buffer[start:self.length]
+            self.length = remaining
@@ -1,138 +1,282 @@
-import traceback
-from datetime import datetime, timedelta
+import asyncio
+import math
+import time
 
 from topics import Topics
-from queue import Queue
-from command import Command, OptionalCommand
+from frame import FrameReader, kind_optional_response, kind_response
+from scheduler import BusJob, BusScheduler
+from command import CommandBuffer, CommandReadback, OptionalCommand, Readback, pollQuery
+from stats import BusStats
 import serial
 import logging
 
 minimum_poll_interval = 2
+serial_reconnect_interval = 5
 
 
 class Heatpump:
     def __init__(self, device: str, poll_interval: int, optional_pcb_poll_interval: int,
-                 on_topic_received: any, on_topic_data: any):
+                 on_topic_received: any, on_topic_data: any, on_frame_decoded: any = None,
+                 command_buffer_size: int = 32, readback: CommandReadback = None, on_command_result: any = None,
+                 passive: bool = False, optional_pcb_debounce: float = 0.5):
         self.topics: Topics = Topics()
         self.device = device
         self.onTopicReceived = on_topic_received
         self.onTopicData = on_topic_data
-        self.commandQueue = Queue()
+        self.onFrameDecoded = on_frame_decoded
+        self.commandBuffer = CommandBuffer(command_buffer_size)
+        # confirms sent commands from the main frames and retries them, None to send commands unchecked
+        self.readback = readback
+        self.onCommandResult = on_command_result
         self.optionalCommand = OptionalCommand()
         self.pollInterval = None if poll_interval <= 0 else 10 \
             if poll_interval < minimum_poll_interval else poll_interval
 
         self.optionalPollInterval = None if optional_pcb_poll_interval <= 0 else 10 \
             if optional_pcb_poll_interval < minimum_poll_interval else optional_pcb_poll_interval
+        # changed optional pcb values are sent this long after the first change, unchanged frames every
+        # optionalPollInterval as keep-alive
+        self.optionalDebounce = optional_pcb_debounce
+
+        # passive: another controller polls the heat pump, nothing is sent and its answers are picked off the bus
+        self.passive = passive
+        self.busStats: BusStats = None
+        if passive:
+            self.pollInterval = None
+            self.optionalPollInterval = None
+            self.busStats = BusStats()
 
         self.serial: serial.Serial = None
+        self.frameReader = FrameReader()
+        self.loop: asyncio.AbstractEventLoop = None
+        self.wakeup = asyncio.Event()
+        self.running = False
+        # Stats timing the pipeline stages, set by the owner when wanted
+        self.stats = None
 
-        self.open_serial()
-        if self.pollInterval:
-            logging.info(F"heatpump: connected to {self.device} with 9600-8-E-1, poll interval {self.pollInterval}s")
-            self.nextPoll = datetime.now() + timedelta(seconds=2)
+        if self.device is None:
+            # frames are fed to on_receive directly, e.g. when replaying a capture
+            logging.info("heatpump: no serial device")
         else:
-            logging.info(F"heatpump: connected to {self.device} with 9600-8-E-1, no polling")
-            self.nextPoll = datetime.max
+            self.open_serial()
+            if self.passive:
+                logging.info(F"heatpump: listening on {self.device} with 9600-8-E-1, not sending")
+            elif self.pollInterval:
+                logging.info(F"heatpump: connected to {self.device} with 9600-8-E-1, poll interval {self.pollInterval}s")
+            else:
+                logging.info(F"heatpump: connected to {self.device} with 9600-8-E-1, no polling")
 
         if self.optionalPollInterval:
             logging.info(F"heatpump: simulating optional pcb with poll interval {self.optionalPollInterval}s")
-            self.nextOptionalPoll = datetime.now() + timedelta(seconds=0)
-        else:
-            self.nextOptionalPoll = datetime.max
 
-        self.nextAllowedSend = datetime.now() + timedelta(seconds=minimum_poll_interval)
+        # bus jobs on time.monotonic() deadlines. Commands go first, but an optional pcb frame more than one
+        # send slot late and a poll more than a poll interval late take precedence over further commands.
+        self.scheduler = BusScheduler(minimum_poll_interval)
+        self.commandJob = self.scheduler.add(BusJob("command", 0, self.send_command))
+        self.optionalJob = self.scheduler.add(BusJob("optional_pcb", 1, self.send_optional_poll,
+                                                     self.optionalPollInterval, minimum_poll_interval))
+        self.pollJob = self.scheduler.add(BusJob("poll", 2, self.send_poll, self.pollInterval,
+                                                 self.pollInterval or math.inf))
+        # an extra poll reading back the settings a command changed
+        self.readbackJob = self.scheduler.add(BusJob("readback", 2, self.send_poll))
 
     def open_serial(self):
+        # non-blocking, reads are triggered by the event loop as soon as data is available
         self.serial = \
             serial.Serial(self.device,
                           baudrate=9600,
                           parity=serial.PARITY_EVEN,
                           stopbits=serial.STOPBITS_ONE,
-                          timeout=0.1)
+                          timeout=0)
 
-    def on_receive(self, buffer: []):
-        if self.topics.decode_and_update(buffer):
-            logging.debug(F"Received {len(buffer)} bytes: {buffer}")
+    def on_receive(self, buffer: bytes):
+        started = time.perf_counter()
+        changed = self.topics.decode_and_update(buffer)
+        decoded = time.perf_counter()
+        if changed is not None:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Received %d bytes: %s", len(buffer), buffer.hex(' '))
             if self.onTopicData is not None:
                 self.onTopicData("optional" if len(buffer) == 20 else "main", buffer)
 
-            for topic in self.topics.topics:
+            for topic in changed:
                 if self.onTopicReceived is not None:
                     if self.onTopicReceived(topic):
                         topic.delegated = True
 
+            if self.onFrameDecoded is not None:
+                self.onFrameDecoded("optional" if len(buffer) == 20 else "main", changed)
+
+            if self.readback is not None and self.readback.pending and len(buffer) == 203:
+                self.check_readback(buffer)
+
+            if self.stats is not None:
+                self.stats.observe("decode", decoded - started)
+                self.stats.observe("callbacks", time.perf_counter() - decoded)
+
             if len(buffer) == 20:
                 # optional pcb response to heatpump should contain the data from heatpump on byte 4 and 5
-                self.optionalCommand.optional_query[4] = buffer[4]
-                self.optionalCommand.optional_query[5] = buffer[5]
+                self.optionalCommand.write(4, buffer[4])
+                self.optionalCommand.write(5, buffer[5])
+
+    def check_readback(self, frame: bytes):
+        for readback, outcome in self.readback.check(frame):
+            latency = self.readback.clock() - readback.firstSent
+            if outcome == "retry":
+                self.loop.call_later(readback.retryAt - self.readback.clock(), self.retry_command, readback)
+            elif outcome == "ack" and self.stats is not None:
+                self.stats.observe("command_effect", latency)
+            if self.onCommandResult is not None:
+                self.onCommandResult(readback, outcome, latency)
+
+    def retry_command(self, readback: Readback):
+        spec = readback.spec
+        # nothing to do if a newer value replaced it, the newer command decides when it is sent
+        if not self.running or self.readback.pending.get(spec) is not readback or spec in self.commandBuffer.pending:
+            return
+        if self.commandBuffer.add(spec.name, readback.value):
+            self.scheduler.schedule_earlier(self.commandJob, time.monotonic())
+            self.wakeup.set()
+            return
+        del self.readback.pending[spec]
+        self.readback.nacked += 1
+        if self.onCommandResult is not None:
+            self.onCommandResult(readback, "nack", self.readback.clock() - readback.firstSent)
+
+    def on_sniffed(self, buffer: bytes):
+        # every frame on the bus is counted, the heat pump's answers are decoded like answers to own polls
+        kind = self.busStats.add(buffer)
+        if kind == kind_response or kind == kind_optional_response:
+            self.on_receive(buffer)
 
     def shutdown(self):
         logging.info("heatpump: disconnecting")
-        self.serial.close()
+        self.running = False
+        self.wakeup.set()
 
-    def command(self, name: str, param: int):
-        command = Command()
-        if command.set(name, param):
-            self.commandQueue.put(command)
-            return True
-        else:
+    def command(self, name: str, param: int) -> bool:
+        # False for unknown commands and for commands dropped on a full command buffer
+        if self.passive or not self.commandBuffer.known(name):
+            return False
+        if not self.commandBuffer.add(name, param):
             return False
+        self.scheduler.schedule_earlier(self.commandJob, time.monotonic())
+        self.wakeup.set()
+        return True
 
     def optional_command(self, name: str, param: int):
+        if self.passive:
+            return False
         if self.optionalCommand.set(name, param):
-            self.nextOptionalPoll = datetime.now() + timedelta(seconds=minimum_poll_interval)
+            # further changes within the debounce window go out in the same frame. Without an optional pcb
+            # poll interval no optional pcb frames are sent at all, the value is only kept.
+            if self.running and self.optionalPollInterval and self.optionalCommand.changed:
+                self.scheduler.schedule_earlier(self.optionalJob, time.monotonic() + self.optionalDebounce)
+                self.wakeup.set()
             return True
         else:
             return False
 
-    def loop(self) -> []:
-        buffer = []
-        while True:
-            try:
-                single_or_no_byte = self.serial.read(1)
-                if len(single_or_no_byte) > 0:
-                    buffer += single_or_no_byte
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        if self.pollInterval:
+            self.scheduler.schedule(self.pollJob, now + 2)
+        if self.optionalPollInterval:
+            self.scheduler.schedule(self.optionalJob, now)
+        self.scheduler.hold_off(minimum_poll_interval)
+
+        self.running = True
+        self.loop.add_reader(self.serial.fileno(), self.on_readable)
+        try:
+            while self.running:
+                delay = self.scheduler.next_run() - time.monotonic()
+                if delay > 0:
+                    # sleep until the next deadline, a new command or a shutdown request
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), None if delay == math.inf else delay)
+                    except asyncio.TimeoutError:
+                        pass
                 else:
-                    break
-            except serial.serialutil.PortNotOpenError:
-                self.open_serial()
+                    self.scheduler.run_due()
+        finally:
+            self.scheduler.log()
+            self.close_serial()
+
+    def close_serial(self):
+        try:
+            self.loop.remove_reader(self.serial.fileno())
+        except Exception:
+            pass
+        self.serial.close()
 
-        if len(buffer) > 0:
+    def on_readable(self):
+        try:
+            started = time.perf_counter()
+            data = self.serial.read(max(1, self.serial.in_waiting))
+            if self.stats is not None:
+                self.stats.observe("read", time.perf_counter() - started)
+        except serial.SerialException as err:
+            logging.error(F"heatpump: failed to read from {self.device}: {err}")
+            self.close_serial()
+            self.loop.create_task(self.reopen_serial())
+            return
+
+        receive = self.on_receive if self.busStats is None else self.on_sniffed
+        for frame in self.frameReader.feed(data):
             try:
-                self.on_receive(buffer)
+                receive(frame)
             except Exception as err:
-                self.nextPoll = datetime.now() + timedelta(seconds=minimum_poll_interval)
+                if self.pollInterval:
+                    self.scheduler.schedule(self.pollJob, time.monotonic() + minimum_poll_interval)
                 logging.error(F"Unknown error while processing received data: {err}")
 
-        if self.nextAllowedSend < datetime.now():
-
-            if not self.commandQueue.empty():
-                try:
-                    command: Command = self.commandQueue.get()
-                    query: [] = command.command_query()
-                    self.nextAllowedSend = datetime.now() + timedelta(seconds=minimum_poll_interval)
-                    logging.debug(F"raw command: {query}")
-                    self.serial.write(query)
-                except Exception as err:
-                    logging.error(F"Unknown error while sending command: {err}")
-
-            elif self.nextOptionalPoll < datetime.now():
-                try:
-                    query: [] = self.optionalCommand.optional_command_query()
-                    logging.debug(F"Polling for new optional data {query}")
-                    self.nextOptionalPoll = datetime.now() + timedelta(seconds=self.optionalPollInterval)
-                    self.nextAllowedSend = datetime.now() + timedelta(seconds=minimum_poll_interval)
-                    self.serial.write(query)
-                except Exception as err:
-                    logging.error(F"Unknown error while polling optional data: {err}")
-
-            elif self.nextPoll < datetime.now():
-                try:
-                    query: [] = Command().poll_query()
-                    logging.debug(F"Polling for new data {query}")
-                    self.nextPoll = datetime.now() + timedelta(seconds=self.pollInterval)
-                    self.nextAllowedSend = datetime.now() + timedelta(seconds=minimum_poll_interval)
-                    self.serial.write(query)
-                except Exception as err:
-                    logging.error(F"Unknown error while polling: {err}")
+    async def reopen_serial(self):
+        self.frameReader.reset()
+        while self.running:
+            await asyncio.sleep(serial_reconnect_interval)
+            try:
+                self.open_serial()
+                self.loop.add_reader(self.serial.fileno(), self.on_readable)
+                logging.info(F"heatpump: reconnected to {self.device}")
+                return
+            except Exception as err:
+                logging.warning(F"heatpump: failed to reconnect to {self.device}: {err}. Retrying...")
+
+    def send_command(self):
+        try:
+            command, names = self.commandBuffer.pop()
+            query: bytes = command.command_query()
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("raw command: %s: %s", ', '.join(names), query.hex(' '))
+            self.serial.write(query)
+            if self.stats is not None:
+                for waited in self.commandBuffer.waited:
+                    self.stats.observe("command_wait", waited)
+            if self.readback is not None:
+                self.readback.sent(self.commandBuffer.sent, query)
+                if self.readback.pending:
+                    self.scheduler.schedule_earlier(self.readbackJob, time.monotonic() + self.readback.settle)
+        except Exception as err:
+            logging.error(F"Unknown error while sending command: {err}")
+        if self.commandBuffer:
+            # conflicting commands follow in the next send slot
+            self.scheduler.schedule(self.commandJob, time.monotonic())
+
+    def send_optional_poll(self):
+        try:
+            query: bytes = self.optionalCommand.optional_command_query()
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Polling for new optional data %s", query.hex(' '))
+            self.serial.write(query)
+        except Exception as err:
+            logging.error(F"Unknown error while polling optional data: {err}")
+
+    def send_poll(self):
+        try:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Polling for new data %s", pollQuery.hex(' '))
+            self.serial.write(pollQuery)
+        except Exception as err:
+            logging.error(F"Unknown error while polling: {err}")
@@ -0,0 +1,435 @@
+import asyncio
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+# values are stored per topic in chunks appended to fixed size, memory mapped segment files:
+#   segment header: magic, bytes used, first and last sample time in ms
+#   chunk header:   value kind, topic name length, sample count, data length, first and last sample time in ms,
+#                   followed by the topic name and the compressed samples
+# times are delta of delta encoded, integers and floats with few decimals (scaled to integers) delta encoded,
+# other floats xor encoded against the previous value, all written as zigzag varints.
+magic = b"PYSHHST1"
+segmentHeader = struct.Struct("<8sIqq")
+segment_header_size = 32
+chunkHeader = struct.Struct("<BBHIqq")
+kind_int = 0
+kind_float = 1
+# kind_decimal + n: floats stored as integers of value * 10^n
+kind_decimal = 2
+maximum_decimals = 4
+
+minute = 60
+hour = 3600
+day = 86400
+
+# the hourly rollups reach back the whole retention, they are saved on close and every rollups_save_interval seconds
+# so startup only decodes the chunks written after the last save, and the chunks within the minute retention
+rollups_file = "rollups.json"
+rollups_save_interval = hour
+
+
+def zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data: bytes, offset: int) -> ():
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def float_bits(value: float) -> int:
+    return struct.unpack("<Q", struct.pack("<d", value))[0]
+
+
+def bits_float(bits: int) -> float:
+    return struct.unpack("<d", struct.pack("<Q", bits))[0]
+
+
+def chunk_kind(kind: int, samples: []) -> int:
+    # most decoded floats have a fixed number of decimals, e.g. temperatures in quarters of a degree
+    if kind != kind_float:
+        return kind
+    for decimals in range(1, maximum_decimals + 1):
+        scale = 10 ** decimals
+        if all(round(value * scale) / scale == value for _, value in samples):
+            return kind_decimal + decimals
+    return kind_float
+
+
+def encode_chunk(kind: int, samples: []) -> bytearray:
+    out = bytearray()
+    scale = 10 ** (kind - kind_decimal) if kind >= kind_decimal else 1
+    previous_time = previous_delta = 0
+    previous_value = 0
+    for sample_time, value in samples:
+        delta = sample_time - previous_time
+        write_varint(out, zigzag(delta - previous_delta))
+        previous_time, previous_delta = sample_time, delta
+        if kind == kind_int:
+            write_varint(out, zigzag(value - previous_value))
+            previous_value = value
+        elif kind >= kind_decimal:
+            value = round(value * scale)
+            write_varint(out, zigzag(value - previous_value))
+            previous_value = value
+        else:
+            bits = float_bits(value)
+            xor = bits ^ previous_value
+            # byte aligned variant of gorilla compression: trailing zero bits are dropped
+            trailing = (xor & -xor).bit_length() - 1 if xor else 0
+            write_varint(out, trailing)
+            write_varint(out, xor >> trailing)
+            previous_value = bits
+    return out
+
+
+def decode_chunk(kind: int, count: int, data: bytes) -> []:
+    samples = []
+    scale = 10 ** (kind - kind_decimal) if kind >= kind_decimal else 1
+    offset = 0
+    previous_time = previous_delta = 0
+    previous_value = 0
+    for _ in range(count):
+        delta_of_delta, offset = read_varint(data, offset)
+        previous_delta += unzigzag(delta_of_delta)
+        previous_time += previous_delta
+        if kind == kind_int:
+            delta, offset = read_varint(data, offset)
+            previous_value += unzigzag(delta)
+            samples.append((previous_time, previous_value))
+        elif kind >= kind_decimal:
+            delta, offset = read_varint(data, offset)
+            previous_value += unzigzag(delta)
+            samples.append((previous_time, previous_value / scale))
+        else:
+            trailing, offset = read_varint(data, offset)
+            xor, offset = read_varint(data, offset)
+            previous_value ^= xor << trailing
+            samples.append((previous_time, bits_float(previous_value)))
+    return samples
+
+
+class Segment:
+    def __init__(self, path: str, size: int = None):
+        self.path = path
+        new = size is not None and not os.path.exists(path)
+        self.file = open(path, "w+b" if new else "r+b")
+        if new:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.size = len(self.map)
+        if new:
+            self.used, self.first, self.last = segment_header_size, 0, 0
+            self.write_header()
+        else:
+            header, self.used, self.first, self.last = segmentHeader.unpack_from(self.map, 0)
+            if header != magic:
+                raise ValueError(F"{path} is not a pyshamon history segment")
+
+    def write_header(self):
+        segmentHeader.pack_into(self.map, 0, magic, self.used, self.first, self.last)
+
+    def free(self) -> int:
+        return self.size - self.used
+
+    def append(self, chunk: bytes, first: int, last: int) -> int:
+        offset = self.used
+        self.map[offset:offset + len(chunk)] = chunk
+        self.used += len(chunk)
+        self.first = first if not self.first else min(self.first, first)
+        self.last = max(self.last, last)
+        self.write_header()
+        return offset
+
+    def chunks(self) -> iter:
+        # yields (offset, kind, name, count, first, last, data offset, data length) of every chunk
+        offset = segment_header_size
+        while offset < self.used:
+            kind, name_length, count, data_length, first, last = chunkHeader.unpack_from(self.map, offset)
+            name_offset = offset + chunkHeader.size
+            data_offset = name_offset + name_length
+            name = bytes(self.map[name_offset:data_offset]).decode()
+            yield offset, kind, name, count, first, last, data_offset, data_length
+            offset = data_offset + data_length
+
+    def read(self, kind: int, count: int, data_offset: int, data_length: int) -> []:
+        return decode_chunk(kind, count, self.map[data_offset:data_offset + data_length])
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class Rollup:
+    # min, max, sum and count of the samples per bucket, buckets are kept in time order
+    def __init__(self, width: int):
+        self.width = width
+        self.buckets = {}
+
+    def add(self, sample_time: float, value: float):
+        self.merge(int(sample_time // self.width * self.width), value, value, value, 1)
+
+    def merge(self, start: int, low: float, high: float, total: float, count: int):
+        bucket = self.buckets.get(start)
+        if bucket is None:
+            self.buckets[start] = [low, high, total, count]
+        else:
+            if low < bucket[0]:
+                bucket[0] = low
+            if high > bucket[1]:
+                bucket[1] = high
+            bucket[2] += total
+            bucket[3] += count
+
+    def trim(self, before: float):
+        for start in list(self.buckets):
+            if start >= before:
+                break
+            del self.buckets[start]
+
+
+class HistoryStore:
+    def __init__(self, directory: str, segment_size: int = 256 * 1024, retention: float = 30 * day,
+                 minute_retention: float = 2 * day, chunk_samples: int = 128, flush_interval: float = 60):
+        self.directory = directory
+        self.segmentSize = segment_size
+        self.retention = retention
+        self.minuteRetention = minute_retention
+        self.chunkSamples = chunk_samples
+        self.flushInterval = flush_interval
+
+        self.segments = []
+        # topic name -> [(segment, kind, count, first, last, data offset, data length)] in time order
+        self.index = {}
+        # topic name -> (kind, [(ms, value)], time.monotonic() of the first buffered sample)
+        self.buffers = {}
+        self.minutes = {}
+        self.hours = {}
+        self.samples = 0
+        self.rollupsSaved = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        # segment file name -> bytes used when the hourly rollups were saved
+        rolled_up = self.load_rollups()
+        minutes_from = (time.time() - minute_retention) * 1000
+        decoded = 0
+        for path in sorted(glob.glob(os.path.join(directory, "segment-*.dat"))):
+            try:
+                decoded += self.load(Segment(path), rolled_up.get(os.path.basename(path), 0), minutes_from)
+            except (ValueError, OSError, struct.error) as err:
+                logging.error(F"history: skipping damaged segment {path}: {err}")
+        logging.info(F"history: {len(self.segments)} segments with {self.samples} samples in {directory}, "
+                     F"{decoded} decoded for the rollups")
+
+    def load(self, segment: Segment, rolled_up: int, minutes_from: float) -> int:
+        # chunks below rolled_up are in the saved hourly rollups, minute rollups start at minutes_from ms
+        self.segments.append(segment)
+        decoded = 0
+        for offset, kind, name, count, first, last, data_offset, data_length in segment.chunks():
+            self.index.setdefault(name, []).append((segment, kind, count, first, last, data_offset, data_length))
+            self.samples += count
+            hours = offset >= rolled_up
+            minutes = last >= minutes_from
+            if not hours and not minutes:
+                continue
+            for sample_time, value in segment.read(kind, count, data_offset, data_length):
+                if minutes:
+                    self.rollup(self.minutes, name, minute).add(sample_time / 1000, value)
+                if hours:
+                    self.rollup(self.hours, name, hour).add(sample_time / 1000, value)
+            decoded += count
+        return decoded
+
+    def load_rollups(self) -> {}:
+        path = os.path.join(self.directory, rollups_file)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as file:
+                saved = json.load(file)
+            for name, buckets in saved["hours"].items():
+                rollup = self.rollup(self.hours, name, hour)
+                for bucket in buckets:
+                    rollup.merge(*bucket)
+            return saved["segments"]
+        except (ValueError, KeyError, TypeError, OSError) as err:
+            logging.error(F"history: rebuilding the rollups, {path} is damaged: {err}")
+            self.hours = {}
+            return {}
+
+    def save_rollups(self):
+        # buffered samples are already rolled up, they are written first so no chunk after the save holds them
+        for name in list(self.buffers):
+            self.flush(name)
+        path = os.path.join(self.directory, rollups_file)
+        saved = {"segments": {os.path.basename(segment.path): segment.used for segment in self.segments},
+                 "hours": {name: [[start] + bucket for start, bucket in rollup.buckets.items()]
+                           for name, rollup in self.hours.items()}}
+        with open(path + ".tmp", "w") as file:
+            json.dump(saved, file)
+        os.replace(path + ".tmp", path)
+        self.rollupsSaved = time.monotonic()
+
+    @staticmethod
+    def rollup(rollups: {}, name: str, width: int) -> Rollup:
+        rollup = rollups.get(name)
+        if rollup is None:
+            rollup = rollups[name] = Rollup(width)
+        return rollup
+
+    def roll_up(self, name: str, sample_time: float, value: float):
+        self.rollup(self.minutes, name, minute).add(sample_time, value)
+        self.rollup(self.hours, name, hour).add(sample_time, value)
+
+    def add(self, name: str, sample_time: float, value: any):
+        # sample_time is the epoch time of the value, non numeric values are not stored
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        kind = kind_int if isinstance(value, int) else kind_float
+        buffer = self.buffers.get(name)
+        if buffer is not None and buffer[0] != kind:
+            self.flush(name)
+            buffer = None
+        if buffer is None:
+            buffer = self.buffers[name] = (kind, [], time.monotonic())
+        buffer[1].append((int(sample_time * 1000), value))
+        self.roll_up(name, sample_time, value)
+        self.samples += 1
+        if len(buffer[1]) >= self.chunkSamples:
+            self.flush(name)
+
+    def flush(self, name: str):
+        kind, samples, _ = self.buffers.pop(name)
+        kind = chunk_kind(kind, samples)
+        encoded_name = name.encode()
+        data = encode_chunk(kind, samples)
+        first, last = samples[0][0], samples[-1][0]
+        chunk = chunkHeader.pack(kind, len(encoded_name), len(samples), len(data), first, last) + encoded_name + data
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.free() < len(chunk):
+            segment = self.new_segment(max(self.segmentSize, len(chunk) + segment_header_size), first)
+        offset = segment.append(chunk, first, last)
+        data_offset = offset + chunkHeader.size + len(encoded_name)
+        self.index.setdefault(name, []).append((segment, kind, len(samples), first, last, data_offset, len(data)))
+
+    def new_segment(self, size: int, first: int) -> Segment:
+        if self.segments:
+            self.segments[-1].map.flush()
+        path = os.path.join(self.directory, F"segment-{first:015d}.dat")
+        segment = Segment(path, size)
+        self.segments.append(segment)
+        return segment
+
+    def flush_due(self):
+        # bounds how many samples a crash can lose
+        now = time.monotonic()
+        for name in [name for name, buffer in self.buffers.items() if now - buffer[2] >= self.flushInterval]:
+            self.flush(name)
+
+    def expire(self, now: float = None):
+        now = time.time() if now is None else now
+        cutoff = (now - self.retention) * 1000
+        while len(self.segments) > 1 and self.segments[0].last < cutoff:
+            segment = self.segments.pop(0)
+            for name, chunks in self.index.items():
+                self.samples -= sum(chunk[2] for chunk in chunks if chunk[0] is segment)
+                self.index[name] = [chunk for chunk in chunks if chunk[0] is not segment]
+            segment.close()
+            os.unlink(segment.path)
+            logging.info(F"history: removed expired segment {segment.path}")
+        for rollup in self.minutes.values():
+            rollup.trim(now - self.minuteRetention)
+        for rollup in self.hours.values():
+            rollup.trim(now - self.retention)
+
+    def raw(self, name: str, start: float, end: float) -> []:
+        first, last = start * 1000, end * 1000
+        samples = []
+        for segment, kind, count, chunk_first, chunk_last, data_offset, data_length in self.index.get(name, ()):
+            if chunk_last >= first and chunk_first <= last:
+                samples += [s for s in segment.read(kind, count, data_offset, data_length) if first <= s[0] <= last]
+        if name in self.buffers:
+            samples += [s for s in self.buffers[name][1] if first <= s[0] <= last]
+        return [(sample_time / 1000, value) for sample_time, value in samples]
+
+    def query(self, name: str, start: float, end: float, resolution: int = 0) -> []:
+        # resolution 0 returns the stored samples as [time, value], otherwise [time, min, max, avg] per
+        # resolution seconds from the hourly rollups for whole hours, else from the minute rollups
+        if resolution <= 0:
+            return [list(sample) for sample in self.raw(name, start, end)]
+        rollups = self.hours if resolution % hour == 0 or start < time.time() - self.minuteRetention \
+            else self.minutes
+        rollup = rollups.get(name)
+        if rollup is None:
+            return []
+        width = max(resolution, rollup.width)
+        buckets = {}
+        for bucket_start, (low, high, total, count) in rollup.buckets.items():
+            # the bucket holding start counts, start need not be aligned to the bucket width
+            if bucket_start + rollup.width > start and bucket_start <= end:
+                target = int(bucket_start // width * width)
+                bucket = buckets.get(target)
+                if bucket is None:
+                    buckets[target] = [low, high, total, count]
+                else:
+                    bucket[0] = min(bucket[0], low)
+                    bucket[1] = max(bucket[1], high)
+                    bucket[2] += total
+                    bucket[3] += count
+        return [[bucket_start, low, high, round(total / count, 3)]
+                for bucket_start, (low, high, total, count) in sorted(buckets.items())]
+
+    def request(self, payload: bytes) -> str:
+        # {"topic": "Main_Inlet_Temp", "start": <epoch>, "end": <epoch>, "resolution": 60}, start and end
+        # default to the last hour, negative values are seconds before now
+        try:
+            request = json.loads(payload)
+            now = time.time()
+            start = float(request.get("start", -hour))
+            end = float(request.get("end", now))
+            start = now + start if start < 0 else start
+            end = now + end if end < 0 else end
+            resolution = int(request.get("resolution", 0))
+            values = self.query(request["topic"], start, end, resolution)
+            return json.dumps({"topic": request["topic"], "start": start, "end": end, "resolution": resolution,
+                               "values": values})
+        except (ValueError, KeyError, TypeError) as err:
+            return json.dumps({"error": F"invalid history request: {err}"})
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            self.flush_due()
+            self.expire()
+            if time.monotonic() - self.rollupsSaved >= rollups_save_interval:
+                self.save_rollups()
+
+    def close(self):
+        self.save_rollups()
+        for segment in self.segments:
+            segment.close()
+        logging.info(F"history: closed with {self.samples} samples")
@@ -0,0 +1,97 @@
+import asyncio
+import collections
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from logging import LogRecord
+
+
+class RateLimitFilter(logging.Filter):
+    # token bucket per log call site: burst records at once, then rate records per second. The next record
+    # let through mentions how many were suppressed since.
+    def __init__(self, rate: float, burst: int = 10, clock: any = time.monotonic):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        # (pathname, lineno) -> [tokens, last refill, suppressed]
+        self.buckets = {}
+        self.suppressed = 0
+
+    def filter(self, record: LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        now = self.clock()
+        key = (record.pathname, record.lineno)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            self.suppressed += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = F"{record.getMessage()} ({bucket[2]} similar suppressed)"
+            record.args = None
+            bucket[2] = 0
+        return True
+
+
+class MQTTLogHandler(logging.Handler):
+    # queues records for mqtt instead of publishing from within the logging call. The queue is bounded,
+    # records arriving while it is full are counted and dropped. paho's own records are never forwarded,
+    # publishing them would log again. Records logged by other threads, e.g. paho's network thread, are
+    # handed over to the event loop, the queue and the event are only touched on the loop's thread.
+    def __init__(self, level: int, max_queued: int = 100):
+        logging.Handler.__init__(self, level)
+        self.queue = collections.deque()
+        self.maxQueued = max_queued
+        self.wakeup = asyncio.Event()
+        self.loop: asyncio.AbstractEventLoop = None
+        self.loopThread: int = None
+        self.forwarded = 0
+        self.dropped = 0
+
+    def emit(self, record: LogRecord):
+        if getattr(record, "mqttClient", False):
+            return
+        # the message is formatted here, its arguments may change before the queue is drained
+        entry = (record.created, record.levelname, record.getMessage())
+        if self.loop is None or threading.get_ident() == self.loopThread:
+            self.enqueue(entry)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.enqueue, entry)
+        except RuntimeError:
+            # the loop is closed, nothing forwards the record anymore
+            self.dropped += 1
+
+    def enqueue(self, entry: ()):
+        if len(self.queue) >= self.maxQueued:
+            self.dropped += 1
+            return
+        self.queue.append(entry)
+        self.wakeup.set()
+
+    async def run(self, publish: any):
+        self.loop = asyncio.get_running_loop()
+        self.loopThread = threading.get_ident()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.queue:
+                created, level, message = self.queue.popleft()
+                try:
+                    publish(json.dumps({"time": str(datetime.fromtimestamp(created)), "level": level,
+                                        "msg": message}))
+                    self.forwarded += 1
+                except Exception:
+                    self.dropped += 1
+                # let serial reads in between long bursts
+                await asyncio.sleep(0)
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import tracemalloc
+
+from topics import Topics
+
+
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        # not linux, fall back to the peak resident size
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MemoryReport:
+    def __init__(self, frames: int = 5):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = self.snapshot()
+        self.baselineRss = rss_kb()
+        self.reports = 0
+
+    @staticmethod
+    def snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def report(self, limit: int = 5) -> []:
+        snapshot = self.snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [F"rss {rss_kb()}kB ({rss_kb() - self.baselineRss:+}kB), "
+                 F"traced {current // 1024}kB, peak {peak // 1024}kB"]
+        for stat in snapshot.compare_to(self.baseline, "lineno")[:limit]:
+            lines.append(F"{stat.size_diff / 1024:+.1f}kB {stat.count_diff:+} blocks: {stat.traceback}")
+        self.reports += 1
+        return lines
+
+    def log(self, limit: int = 5):
+        for line in self.report(limit):
+            logging.info(F"memory: {line}")
+
+    async def run(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            self.log()
+
+
+if __name__ == '__main__':
+    # feeds generated frames through the decoder and prints how memory developed between rounds
+    from benchmark import sample_frames
+
+    parser = argparse.ArgumentParser(description="pyshamon allocation report")
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    topics = Topics()
+    frames = sample_frames(args.frames)
+    # warm up so interned values and caches exist before the baseline is taken
+    for frame in frames[:100]:
+        topics.decode_and_update(frame)
+
+    report = MemoryReport()
+    for i in range(args.rounds):
+        for frame in frames:
+            topics.decode_and_update(frame)
+        print(F"round {i + 1}:")
+        for line in report.report():
+            print(F"  {line}")
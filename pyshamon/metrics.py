@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from topics import Topic
+
+contentType = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def label(value: any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsExporter:
+    # serves the topics and operational counters in the prometheus text format on /metrics. Every topic keeps
+    # its exposition line, a changed topic only rebuilds its own line and the text is joined again on the next
+    # scrape, so scrapes between frames return the cached text. Numeric and textual values are separate families
+    # whose samples must stay together, so each topic has a line in both lists, one of them empty. Several heat
+    # pumps are told apart by a unit label.
+    def __init__(self, host: str = "", port: int = 9101, prefix: str = "heatpump"):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        # (unit label, function returning the counters)
+        self.sources = []
+        # topic -> (index into the line lists, labels)
+        self.index = {}
+        # heatpump_topic and heatpump_topic_info samples
+        self.lines = []
+        self.infoLines = []
+        self.text: str = None
+        self.server: asyncio.AbstractServer = None
+        self.scrapes = 0
+        self.updates = 0
+
+    def add(self, topics: [], counters: any, unit: str = None):
+        # counters returns (name, prometheus type, help text, value) tuples, optionally followed by labels
+        # like 'job="poll"'
+        unit_label = "" if unit is None else F"unit=\"{label(unit)}\","
+        for topic in topics:
+            if topic.type in ("main", "optional"):
+                self.index[topic] = (len(self.lines), F"{unit_label}topic=\"{topic.name}\",type=\"{topic.type}\"")
+                self.lines.append("")
+                self.infoLines.append("")
+        self.sources.append((unit_label, counters))
+        self.text = None
+
+    def header(self) -> str:
+        return F"# HELP {self.prefix}_topic heat pump topic value, enums carry their description\n" \
+               F"# TYPE {self.prefix}_topic gauge\n"
+
+    def info_header(self) -> str:
+        return F"# HELP {self.prefix}_topic_info heat pump topic with a textual value\n" \
+               F"# TYPE {self.prefix}_topic_info gauge\n"
+
+    def info_line(self, topic: Topic, labels: str) -> str:
+        if not isinstance(topic.value, str):
+            return ""
+        return F"{self.prefix}_topic_info{{{labels},value=\"{label(topic.value)}\"}} 1\n"
+
+    def line(self, topic: Topic, labels: str) -> str:
+        if topic.value is None or isinstance(topic.value, str):
+            return ""
+        if topic.textual_description is not None and len(topic.textual_description) > 1 \
+                and topic.description is not None:
+            labels += F",description=\"{label(topic.description)}\""
+        return F"{self.prefix}_topic{{{labels}}} {topic.value}\n"
+
+    def update(self, changed: []):
+        # called with the changed topics of each decoded frame
+        for topic in changed:
+            entry = self.index.get(topic)
+            if entry is not None:
+                self.lines[entry[0]] = self.line(topic, entry[1])
+                self.infoLines[entry[0]] = self.info_line(topic, entry[1])
+                self.text = None
+                self.updates += 1
+
+    def counter_lines(self) -> str:
+        # the samples of all units grouped below one HELP and TYPE per counter
+        families = {}
+        for unit_label, counters in self.sources:
+            for name, kind, description, value, *labels in counters():
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = [F"# HELP {self.prefix}_{name} {description}\n"
+                                               F"# TYPE {self.prefix}_{name} {kind}\n"]
+                sample_labels = unit_label + "".join(F"{label}," for label in labels)
+                family.append(F"{self.prefix}_{name}{{{sample_labels[:-1]}}} {value}\n" if sample_labels
+                              else F"{self.prefix}_{name} {value}\n")
+        return "".join(line for family in families.values() for line in family)
+
+    def exposition(self) -> str:
+        if self.text is None:
+            self.text = self.header() + "".join(self.lines) + self.info_header() + "".join(self.infoLines)
+        self.scrapes += 1
+        return self.text + self.counter_lines()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.on_connection, self.host or None, self.port)
+        logging.info(F"metrics: serving /metrics on port {self.port}")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            logging.info(F"metrics: {self.scrapes} scrapes, {self.updates} topic updates")
+
+    async def on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # the headers are not needed, only read past them
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+                status, body = "405 Method Not Allowed", b""
+            elif parts[1].split("?")[0] != "/metrics":
+                status, body = "404 Not Found", b""
+            else:
+                status, body = "200 OK", self.exposition().encode("utf-8")
+            writer.write(F"HTTP/1.1 {status}\r\nContent-Type: {contentType}\r\nContent-Length: {len(body)}\r\n"
+                         F"Connection: close\r\n\r\n".encode("latin-1"))
+            if parts and parts[0] != "HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as err:
+            logging.debug(F"metrics: scrape failed: {err}")
+        finally:
+            writer.close()
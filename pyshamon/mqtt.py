@@ -1,13 +1,16 @@
-import time
-import traceback
+import asyncio
+import threading
 
-from command import Command, OptionalCommand
+import command
+from outbox import Outbox
 from topics import Topic
-from paho.mqtt.client import Client, MQTTv5, MQTTv31, MQTTv311, MQTTMessage
-from paho.mqtt.properties import Properties
+from paho.mqtt.client import Client, MQTTv5, MQTTv31, MQTTv311, MQTTMessage, MQTT_ERR_NO_CONN
+from paho.mqtt.properties import Properties, VariableByteIntegers, writeUTF
 from paho.mqtt.packettypes import PacketTypes
 import logging
-import binascii
+import json
+
+reconnect_interval = 5
 
 mqttVersions = {
     31: MQTTv31,
@@ -16,16 +19,195 @@ mqttVersions = {
 }
 
 
-class MQTT:
+class MQTTLogAdapter(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        # marks paho's records, they are not forwarded to the mqtt log topic
+        kwargs["extra"] = {"mqttClient": True}
+        return F"mqtt: {msg}", kwargs
+
+
+class UserProperties:
+    # stands in for paho's Properties on publish: paho only calls pack(), which returns the
+    # dt/dsc user properties assembled from pre-encoded parts instead of walking all property names
+    __slots__ = ("packed",)
+
+    identifier = bytes([Properties(PacketTypes.PUBLISH).getIdentFromName("UserProperty")])
+    timestamps = [0, b""]
+    descriptions = {}
+
+    def __init__(self):
+        self.packed = b"\x00"
+
+    def __str__(self):
+        return F"[UserProperty : {self.packed[1:]}]"
+
+    def pack(self) -> bytes:
+        return self.packed
+
+    def set(self, timestamp: int, description: str):
+        # all topics of a frame share the same second, descriptions come from a small fixed set
+        if UserProperties.timestamps[0] != timestamp:
+            UserProperties.timestamps[0] = timestamp
+            UserProperties.timestamps[1] = self.identifier + writeUTF("dt") + writeUTF(str(timestamp))
+        encoded_description = UserProperties.descriptions.get(description)
+        if encoded_description is None:
+            encoded_description = self.identifier + writeUTF("dsc") + writeUTF(description)
+            UserProperties.descriptions[description] = encoded_description
+        encoded = UserProperties.timestamps[1] + encoded_description
+        self.packed = VariableByteIntegers.encode(len(encoded)) + encoded
+
+
+class TopicPlan:
+    __slots__ = ("topic", "properties")
+
+    def __init__(self, topic: str, with_properties: bool):
+        self.topic = topic
+        self.properties = UserProperties() if with_properties else None
+
+
+class MQTTNamespace:
+    # the topics and commands of one heat pump below topic_base, several namespaces share one connection
+    def __init__(self, connection: any, topic_base: str, on_command: any, published_topics: [],
+                 subscribed_commands: []):
+        self.connection = connection
+        self.client: Client = connection.client
+        self.protocol_version = connection.protocol_version
+        self.topic_base = topic_base
+        self.subscribed_commands = set(subscribed_commands)
+        self.published_topics = set(published_topics)
+        self.plans = {}
+        self.commandPrefix = F"{topic_base}/commands/"
+        self.logTopic = F"{topic_base}/log"
+        self.statsTopic = F"{topic_base}/stats"
+        self.rawTopics = {"main": F"{topic_base}/raw/main", "optional": F"{topic_base}/raw/optional"}
+        self.rawDeltaTopics = {"main": F"{topic_base}/raw/main/delta", "optional": F"{topic_base}/raw/optional/delta"}
+        self.snapshotTopics = {"main": F"{topic_base}/main", "optional": F"{topic_base}/optional"}
+        self.on_command = on_command
+        self.publishes = 0
+
+    def prepare(self, topics: []):
+        # decide once per topic whether it is published and precompute its topic string and properties
+        self.plans = {}
+        for topic in topics:
+            topic.enabled = topic.name.lower() in self.published_topics
+            if topic.enabled:
+                self.plans[topic] = TopicPlan(F"{self.topic_base}/{topic.type}/{topic.name}",
+                                              self.protocol_version == 5)
+
+    def publish(self, topic: Topic):
+        plan: TopicPlan = self.plans.get(topic)
+        if plan is None:
+            logging.debug("mqtt: skipping deactivated topic %s", topic.name)
+            return False
+
+        properties = plan.properties
+        if properties is not None:
+            properties.set(int(topic.timestamp()), topic.description)
+        self.connection.send(plan.topic, topic.value, True, properties)
+        self.publishes += 1
+        return True
+
+    def publish_log(self, payload):
+        if "log" in self.published_topics:
+            self.connection.send(self.logTopic, payload, False)
+
+    def publish_stats(self, payload: str):
+        self.connection.send(self.statsTopic, payload, False)
+        self.publishes += 1
+
+    def publish_command_result(self, name: str, payload: str):
+        self.connection.send(F"{self.commandPrefix}{name}/result", payload, False)
+        self.publishes += 1
+
+    def publish_snapshot(self, topic_type: str, payload: str, retain: bool):
+        self.connection.send(self.snapshotTopics[topic_type], payload, retain)
+        self.publishes += 1
+
+    def publish_raw(self, topic_type: str, payload: bytes, retain: bool = False):
+        if "raw" in self.published_topics:
+            try:
+                self.connection.send(self.rawTopics[topic_type], payload, retain)
+                self.publishes += 1
+            except Exception as err:
+                logging.error(f"mqtt: unknown error handling raw data: {err}")
+
+    def publish_raw_delta(self, topic_type: str, payload: bytes):
+        # retained, an empty delta removes the retained one after a new keyframe
+        if "raw" in self.published_topics:
+            try:
+                self.connection.send(self.rawDeltaTopics[topic_type], payload, True)
+                self.publishes += 1
+            except Exception as err:
+                logging.error(f"mqtt: unknown error handling raw data: {err}")
+
+    def add_request_handler(self, name: str, handler: any):
+        self.connection.requestHandlers[F"{self.topic_base}/{name}"] = handler
+
+    def command_topics(self) -> []:
+        topics = [(F"{self.commandPrefix}{spec.name}", 1)
+                  for registry in (command.commands, command.optionalCommands)
+                  for key, spec in registry.items()
+                  if key in self.subscribed_commands]
+        if "bulk" in self.subscribed_commands:
+            topics.append((F"{self.commandPrefix}Bulk", 1))
+        return topics
+
+    def on_command_message(self, name: str, payload: bytes):
+        if name.lower() == "bulk" and "bulk" in self.subscribed_commands:
+            self.on_bulk_message(payload)
+        elif name.lower() in self.subscribed_commands:
+            try:
+                param = int(payload)
+                self.dispatch(name, param)
+            except ValueError as err:
+                logging.warning(f"mqtt: command {name} only supports integer payload but got '{payload}': {err}")
+        else:
+            logging.warning(f"mqtt: command {name}={payload} not known or allowed.")
+
+    def on_bulk_message(self, payload: bytes):
+        # {"SetDHWTemp": 48, "SetZ1HeatCurveTargetHighTemp": 35, ...}
+        try:
+            commands = json.loads(payload)
+            if not isinstance(commands, dict):
+                raise ValueError("expected a json object")
+        except ValueError as err:
+            logging.warning(f"mqtt: bulk command payload '{payload}' is not a json object of commands: {err}")
+            return
+
+        for name, value in commands.items():
+            if name.lower() not in self.subscribed_commands or name.lower() == "bulk":
+                logging.warning(f"mqtt: bulk command {name}={value} not known or allowed.")
+            elif not isinstance(value, int) or isinstance(value, bool):
+                logging.warning(f"mqtt: bulk command {name} only supports integer values but got '{value}'")
+            else:
+                self.dispatch(name, value)
+
+    def dispatch(self, name: str, param: int):
+        # reject values outside the command's range before anything is queued
+        spec: command.CommandSpec = command.find_command(name)
+        if spec is None:
+            logging.warning(f"mqtt: command {name}={param} not known.")
+        elif not spec.accepts(param):
+            logging.warning(f"mqtt: command {spec.name}={param} out of range {spec.minimum}..{spec.maximum}")
+        elif self.on_command:
+            self.on_command(spec.name, param)
+
+
+class MQTT(MQTTNamespace):
+    # the connection and the namespace of topic_base itself, add_namespace() adds one below it per heat pump
     def __init__(self, protocol_version: int, host: str, port: int, topic_base: str, on_command: any,
-                 published_topics: [], subscribed_commands: [], username: str = None, password: str = None):
+                 published_topics: [], subscribed_commands: [], username: str = None, password: str = None,
+                 outbox: Outbox = None, flush_rate: int = 100):
         self.host = host
         self.port = port
-        self.topic_base = topic_base
-        self.subscribed_commands = subscribed_commands
-        self.published_topics = published_topics
-        self.on_command = on_command
         self.protocol_version = protocol_version
+        # messages published while disconnected, sent at flush_rate messages per second after reconnecting
+        self.outbox = outbox if outbox is not None else Outbox()
+        self.flushRate = flush_rate
+        self.connected = False
+        self.drainTask: asyncio.Task = None
+        # request topic -> handler returning the response payload
+        self.requestHandlers = {}
 
         self.client = Client(protocol=mqttVersions[protocol_version])
         if username is not None:
@@ -34,88 +216,169 @@ class MQTT:
         self.client.on_disconnect = self.on_mqtt_disconnect
         self.client.on_connect_fail = self.on_mqtt_connect_fail
         self.client.on_message = self.on_message
-        self.client.on_log = self.on_mqtt_log
+        # paho's debug lines are only formatted when the log level lets them through
+        self.client.enable_logger(MQTTLogAdapter(logging.getLogger(), {}))
+
+        # let the asyncio event loop drive paho's socket instead of paho's own network thread
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+        MQTTNamespace.__init__(self, self, topic_base, on_command, published_topics, subscribed_commands)
+        self.namespaces = [self]
 
+        self.loop: asyncio.AbstractEventLoop = None
+        self.loopThread: int = None
+        self.miscTask: asyncio.Task = None
         self.running = False
 
-    def run(self):
+    def add_namespace(self, name: str, on_command: any) -> MQTTNamespace:
+        namespace = MQTTNamespace(self, F"{self.topic_base}/{name}", on_command, self.published_topics,
+                                  self.subscribed_commands)
+        self.namespaces.append(namespace)
+        return namespace
+
+    async def run(self):
+        # returns at once, the connection is made in the background while publishes go to the outbox
+        self.loop = asyncio.get_running_loop()
+        self.loopThread = threading.get_ident()
         self.running = True
+        self.miscTask = self.loop.create_task(self.misc())
+
+    async def connect(self, connect: any, *args) -> bool:
+        # paho resolves the host and opens the socket blocking, in the executor the serial port is still served
+        try:
+            await self.loop.run_in_executor(None, connect, *args)
+            return True
+        except ValueError as err:
+            logging.critical(F"mqtt: configuration problem {self.host}:{self.port}: {err}")
+            exit(1)
+        except Exception as err:
+            logging.warning(F"mqtt: failed to connect to {self.host}:{self.port}: {err}. Retrying...")
+            return False
+
+    async def misc(self):
+        # connecting, keep alive handling, reconnects and outbox commits, everything else is triggered by socket events
+        logging.info(F"mqtt: connecting to {self.host}:{self.port} using protocol v{self.protocol_version}")
+        while self.running and not await self.connect(self.client.connect, self.host, self.port, 60):
+            await asyncio.sleep(reconnect_interval)
         while self.running:
-            try:
-                logging.info(F"mqtt: connecting to {self.host}:{self.port} using protocol v{self.protocol_version}")
-                self.client.connect(host=self.host, port=self.port, keepalive=60)
-                break
-            except ValueError as err:
-                logging.critical(F"mqtt: configuration problem {self.host}:{self.port}: {err}")
-                exit(1)
-            except Exception as err:
-                logging.warning(F"mqtt: failed to connect to {self.host}:{self.port}: {err}. Retrying...")
-                time.sleep(5)
+            await asyncio.sleep(1)
+            self.outbox.commit()
+            if self.client.loop_misc() == MQTT_ERR_NO_CONN and self.running:
+                logging.info(F"mqtt: reconnecting to {self.host}:{self.port}")
+                if not await self.connect(self.client.reconnect):
+                    await asyncio.sleep(reconnect_interval)
 
-        self.client.loop_start()
+    def in_loop(self, fnc: any, *args):
+        # paho calls the socket callbacks from the executor while connecting
+        if threading.get_ident() == self.loopThread:
+            fnc(*args)
+        else:
+            self.loop.call_soon_threadsafe(fnc, *args)
 
-    def publish(self, topic: Topic):
-        if topic.name.lower() in self.published_topics:
-            properties = Properties(PacketTypes.PUBLISH)
-            properties.UserProperty = ("dt", str(int(topic.since.timestamp())))
-            properties.UserProperty = ("dsc", topic.description)
-            self.client.publish(
-                f"{self.topic_base}/{topic.type}/{topic.name}",
-                payload=topic.value, qos=0, retain=True, properties=properties)
-            return True
+    def on_socket_open(self, client, userdata, sock):
+        self.in_loop(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.in_loop(self.loop.remove_reader, sock)
+        self.in_loop(self.loop.remove_writer, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.in_loop(self.loop.remove_writer, sock)
+
+    def send(self, topic: str, payload: any, retain: bool, properties: UserProperties = None):
+        # straight to paho while connected, to the outbox while disconnected and until the outbox is drained,
+        # paho itself drops qos 0 messages queued before a reconnect
+        if self.connected and not self.outbox.pending:
+            self.client.publish(topic, payload=payload, qos=0, retain=retain, properties=properties)
         else:
-            logging.debug(F"mqtt: skipping deactivated topic {topic.name}")
-            return False
+            self.outbox.put(topic, payload, retain, None if properties is None else properties.pack())
 
-    def publish_log(self, payload):
-        if "log" in self.published_topics:
-            self.client.publish(f"{self.topic_base}/log", payload=payload, qos=0, retain=False)
+    async def drain(self):
+        batch = max(1, self.flushRate // 10)
+        logging.info(F"mqtt: sending {self.outbox.pending} queued messages, {self.flushRate} per second")
+        while self.running and self.connected and self.outbox.pending:
+            messages = self.outbox.peek(batch)
+            for _, topic, payload, retain, packed in messages:
+                properties = None
+                if packed is not None:
+                    properties = UserProperties()
+                    properties.packed = packed
+                self.client.publish(topic, payload=payload, qos=0, retain=bool(retain), properties=properties)
+            self.outbox.remove(messages[-1][0])
+            await asyncio.sleep(0.1)
+        self.outbox.commit()
+        if not self.outbox.pending:
+            logging.info("mqtt: outbox sent")
 
-    def publish_raw(self, topic_type: str, raw: []):
-        if "raw" in self.published_topics:
-            try:
-                self.client.publish(f"{self.topic_base}/raw/{topic_type}", payload=binascii.hexlify(bytes(raw), " "), qos=0, retain=False)
-            except Exception as err:
-                logging.error(f"mqtt: unknown error handling raw data: {err}")
+    def on_request(self, message: MQTTMessage, handler: any):
+        # mqtt 5 clients name their response topic and correlation data, others get <request topic>/response
+        response = handler(message.payload)
+        request_properties = getattr(message, "properties", None)
+        response_topic = getattr(request_properties, "ResponseTopic", None)
+        properties = None
+        if response_topic and self.protocol_version == 5:
+            properties = Properties(PacketTypes.PUBLISH)
+            correlation = getattr(request_properties, "CorrelationData", None)
+            if correlation is not None:
+                properties.CorrelationData = correlation
+        self.client.publish(response_topic or F"{message.topic}/response", payload=response, qos=0, retain=False,
+                            properties=properties)
 
     def on_message(self, client, userdata, message: MQTTMessage):
         try:
-            name = message.topic
-            if name.lower().startswith(F"{self.topic_base}/commands/".lower()):
-                name = message.topic[len(F"{self.topic_base}/commands/"):]
-            if name.lower() in self.subscribed_commands:
-                try:
-                    param = int(message.payload)
-                    if self.on_command:
-                        self.on_command(name, param)
-                except ValueError as err:
-                    logging.warning(f"mqtt: command {name} only supports integer payload but got '{message.payload}': {err}")
-            else:
-                logging.warning(f"mqtt: command {name}={message.payload} not known or allowed.")
+            handler = self.requestHandlers.get(message.topic)
+            if handler is not None:
+                self.on_request(message, handler)
+                return
+            for namespace in self.namespaces:
+                if namespace.on_command is not None \
+                        and message.topic.lower().startswith(namespace.commandPrefix.lower()):
+                    namespace.on_command_message(message.topic[len(namespace.commandPrefix):], message.payload)
+                    return
+            logging.warning(f"mqtt: command {message.topic}={message.payload} not known or allowed.")
         except Exception as err:
             logging.error(f"mqtt: unknown error handling command {message.topic}={message.payload}: {err}")
 
     def on_mqtt_connect(self, client, userdata, flags, rc, properties=None):
         logging.info(f"mqtt: connected to {self.host}:{self.port} rc={rc}")
-        topics = [(F"{self.topic_base}/commands/{command}", 1)
-                  for command in Command().known_commands()
-                  if command.lower() in self.subscribed_commands]
-        topics += [(F"{self.topic_base}/commands/{command}", 1)
-                  for command in OptionalCommand().known_commands()
-                  if command.lower() in self.subscribed_commands]
+        if rc != 0:
+            return
+        self.connected = True
+        if self.outbox.pending and (self.drainTask is None or self.drainTask.done()):
+            self.drainTask = self.loop.create_task(self.drain())
+        topics = [topic for namespace in self.namespaces if namespace.on_command is not None
+                  for topic in namespace.command_topics()]
+        topics += [(topic, 1) for topic in self.requestHandlers]
 
-        logging.info(F"mqtt: subscribing {len(topics)} topics")
-        self.client.subscribe(topics)
+        # a subscribe without topics is a protocol error, e.g. for a passive unit without request handlers
+        if topics:
+            logging.info(F"mqtt: subscribing {len(topics)} topics")
+            self.client.subscribe(topics)
 
     def on_mqtt_disconnect(self, client, userdata, rc, properties=None):
+        self.connected = False
         logging.warning(f"mqtt: disconnected from {self.host}:{self.port} rc={rc}")
 
     def on_mqtt_connect_fail(self, client, userdata, rc, properties=None):
         logging.warning(f"mqtt: failed to connect to  {self.host}:{self.port} rc={rc}")
 
-    def on_mqtt_log(self, client, userdata, level, buf):
-        logging.log(level, f"mqtt: {buf}")
-
     def shutdown(self):
         self.running = False
         self.client.disconnect()
+
+    async def stop(self):
+        self.shutdown()
+        # give the event loop a chance to flush the disconnect packet
+        for _ in range(10):
+            if self.client.socket() is None:
+                break
+            await asyncio.sleep(0.1)
+        if self.miscTask is not None:
+            self.miscTask.cancel()
+        self.outbox.close()
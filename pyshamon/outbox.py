@@ -0,0 +1,89 @@
+import logging
+import sqlite3
+
+
+def to_bytes(payload: any) -> bytes:
+    # the conversion paho applies when publishing
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    return str(payload).encode("ascii")
+
+
+class Outbox:
+    # messages published while the broker is unreachable, kept in sqlite until the connection is back.
+    # A retained topic only keeps its latest message, other messages are kept in order up to max_messages,
+    # dropping the oldest first. path ":memory:" keeps the queue in memory only.
+    def __init__(self, path: str = ":memory:", max_messages: int = 10000):
+        self.path = path
+        self.maxMessages = max_messages
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL,"
+                        " payload BLOB NOT NULL, retain INTEGER NOT NULL, properties BLOB)")
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS retained ON outbox (topic) WHERE retain = 1")
+        self.pending = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        self.dirty = False
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.sent = 0
+        if self.pending:
+            logging.info(F"outbox: {self.pending} messages left from the last run in {self.path}")
+
+    def __len__(self):
+        return self.pending
+
+    def put(self, topic: str, payload: any, retain: bool, properties: bytes = None):
+        payload = to_bytes(payload)
+        self.queued += 1
+        if retain:
+            replaced = self.db.execute("DELETE FROM outbox WHERE retain = 1 AND topic = ?", (topic,)).rowcount
+            self.coalesced += replaced
+            self.pending -= replaced
+        self.db.execute("INSERT INTO outbox (topic, payload, retain, properties) VALUES (?, ?, ?, ?)",
+                        (topic, payload, int(retain), properties))
+        self.pending += 1
+        self.dirty = True
+        if self.pending > self.maxMessages:
+            self.drop(self.pending - self.maxMessages)
+
+    def drop(self, count: int):
+        # the oldest non retained messages go first, a retained topic's latest value is worth more
+        for retained in (0, 1):
+            if count <= 0:
+                break
+            deleted = self.db.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE retain = ? "
+                                      "ORDER BY id LIMIT ?)", (retained, count)).rowcount
+            count -= deleted
+            self.pending -= deleted
+            self.dropped += deleted
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logging.warning(F"outbox: full with {self.pending} messages, {self.dropped} dropped so far")
+
+    def peek(self, count: int) -> []:
+        # (id, topic, payload, retain, properties) of the oldest messages
+        return self.db.execute("SELECT id, topic, payload, retain, properties FROM outbox ORDER BY id LIMIT ?",
+                               (count,)).fetchall()
+
+    def remove(self, last_id: int):
+        removed = self.db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,)).rowcount
+        self.pending -= removed
+        self.sent += removed
+        self.dirty = True
+
+    def commit(self):
+        if self.dirty:
+            self.db.commit()
+            self.dirty = False
+
+    def close(self):
+        self.commit()
+        self.db.close()
+        if self.queued:
+            logging.info(F"outbox: {self.queued} messages queued, {self.coalesced} coalesced, {self.dropped} dropped, "
+                         F"{self.sent} sent, {self.pending} left")
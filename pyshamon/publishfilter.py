@@ -0,0 +1,124 @@
+import logging
+import time
+
+from topics import Topic
+
+
+class FilterRule:
+    __slots__ = ("absolute", "relative", "interval", "heartbeat")
+
+    def __init__(self, absolute: float = 0, relative: float = 0, interval: float = 0, heartbeat: float = 0):
+        self.absolute = absolute
+        self.relative = relative
+        self.interval = interval
+        self.heartbeat = heartbeat
+
+    def __str__(self):
+        return F"deadband={self.absolute}/{self.relative * 100}% interval={self.interval}s heartbeat={self.heartbeat}s"
+
+    @staticmethod
+    def parse(text: str) -> 'FilterRule':
+        # e.g. "deadband=0.1 interval=60 heartbeat=900" or "deadband=2%"
+        rule = FilterRule()
+        for part in text.split():
+            key, _, value = part.partition("=")
+            if key == "deadband" and value.endswith("%"):
+                rule.relative = float(value[:-1]) / 100
+            elif key == "deadband":
+                rule.absolute = float(value)
+            elif key == "interval":
+                rule.interval = float(value)
+            elif key == "heartbeat":
+                rule.heartbeat = float(value)
+            else:
+                raise ValueError(F"unknown filter setting '{part}'")
+        return rule
+
+
+class FilterState:
+    __slots__ = ("topic", "rule", "value", "published", "pending", "suppressed")
+
+    def __init__(self, topic: Topic, rule: FilterRule):
+        self.topic = topic
+        self.rule = rule
+        self.value = None
+        self.published: float = None
+        self.pending = False
+        self.suppressed = 0
+
+
+class PublishFilter:
+    def __init__(self, topics: [], rules: {}, default: FilterRule = None):
+        self.states = {}
+        for topic in topics:
+            rule = rules.get(topic.name.lower(), default)
+            if rule is not None:
+                self.states[topic] = FilterState(topic, rule)
+        self.timed = [state for state in self.states.values() if state.rule.interval or state.rule.heartbeat]
+        self.suppressed = 0
+        self.reported = 0
+
+    def accept(self, topic: Topic, now: float = None) -> bool:
+        state: FilterState = self.states.get(topic)
+        if state is None:
+            return True
+        if now is None:
+            now = time.monotonic()
+
+        if state.published is not None:
+            if self.within_deadband(state, topic.value):
+                state.pending = False
+                state.suppressed += 1
+                self.suppressed += 1
+                return False
+            if now - state.published < state.rule.interval:
+                # publish the latest value once the interval passed, see due()
+                state.pending = True
+                state.suppressed += 1
+                self.suppressed += 1
+                return False
+
+        self.mark_published(state, now)
+        return True
+
+    @staticmethod
+    def within_deadband(state: FilterState, value: any) -> bool:
+        rule = state.rule
+        if not (rule.absolute or rule.relative) \
+                or not isinstance(value, (int, float)) or not isinstance(state.value, (int, float)):
+            return False
+        delta = abs(value - state.value)
+        return delta < rule.absolute or delta < abs(state.value) * rule.relative
+
+    @staticmethod
+    def mark_published(state: FilterState, now: float):
+        state.value = state.topic.value
+        state.published = now
+        state.pending = False
+
+    def due(self, now: float = None) -> []:
+        # topics with a held back change whose interval passed or without publish for longer than heartbeat
+        if now is None:
+            now = time.monotonic()
+        topics = []
+        for state in self.timed:
+            if state.published is None:
+                continue
+            elapsed = now - state.published
+            if state.pending and elapsed >= state.rule.interval:
+                state.pending = False
+                if not self.within_deadband(state, state.topic.value):
+                    self.mark_published(state, now)
+                    topics.append(state.topic)
+                    continue
+            if state.rule.heartbeat and elapsed >= state.rule.heartbeat:
+                self.mark_published(state, now)
+                topics.append(state.topic)
+        return topics
+
+    def report(self, interval: float):
+        suppressed = self.suppressed - self.reported
+        self.reported = self.suppressed
+        top = sorted(self.states.values(), key=lambda s: s.suppressed, reverse=True)[:5]
+        logging.info(F"filter: suppressed {suppressed} publishes in the last {interval}s, {self.suppressed} total; "
+                     F"most suppressed: {', '.join(F'{s.topic.name}={s.suppressed}' for s in top if s.suppressed)}")
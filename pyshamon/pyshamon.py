@@ -1,19 +1,30 @@
+import json
 import os
 import sys
+import time
 
 from topics import Topic
 import logging
-from logging import LogRecord
 import atexit
 import configparser
-from mqtt import MQTT
+from mqtt import MQTT, MQTTNamespace
 from heatpump import Heatpump
-from datetime import datetime
-import json
+from command import CommandReadback, Readback
+from memreport import MemoryReport
+from publishfilter import PublishFilter, FilterRule
+from snapshot import SnapshotEncoder
+from capture import CaptureWriter
+from history import HistoryStore
+from metrics import MetricsExporter
+from stats import Stats, Profiler
+from logs import MQTTLogHandler, RateLimitFilter
+from rawframe import RawEncoder, encode_frame
+from outbox import Outbox
 import signal
+import asyncio
 
 
-def raw_diff(old, new: []):
+def raw_diff(old: bytes, new: bytes):
     hx: str = ""
     changed = False
     for o, n in zip(old, new):
@@ -29,83 +40,413 @@ def raw_diff(old, new: []):
     return hx
 
 
+class Unit:
+    # one heat pump with its serial port, scheduler and features, publishing into its own mqtt namespace.
+    # A [heatpump:<name>] section overrides the settings of the other sections for its unit.
+    def __init__(self, config: configparser.ConfigParser, name: str, section: str, mqtt: MQTTNamespace,
+                 metrics: MetricsExporter):
+        self.config = config
+        self.name = name
+        self.section = section
+        self.mqtt = mqtt
+        self.metrics = metrics
+        self.prefix = "" if name is None else F"{name}: "
+        self.last_raw = {'main': bytearray(203), 'optional': bytearray(20)}
+        self.capture: CaptureWriter = None
+        self.history: HistoryStore = None
+        self.stats: Stats = None
+
+        passive = self.config.BOOLEAN_STATES.get(self.setting("heatpump", "passive", "no").lower(), False)
+        readback: CommandReadback = None
+        readback_delay = float(self.setting("heatpump", "command_readback_delay", 2))
+        if readback_delay > 0 and not passive:
+            readback = CommandReadback(readback_delay, int(self.setting("heatpump", "command_retries", 3)),
+                                       float(self.setting("heatpump", "command_retry_backoff", 5)))
+
+        try:
+            self.heatpump = Heatpump(self.setting("heatpump", "serial_port"),
+                                     int(self.setting("heatpump", "poll_interval")),
+                                     int(self.setting("heatpump", "optional_pcb_poll_interval")),
+                                     self.on_topic_received,
+                                     self.on_topic_data,
+                                     self.on_frame_decoded,
+                                     int(self.setting("heatpump", "command_buffer_size", 32)),
+                                     readback,
+                                     self.on_command_result,
+                                     passive,
+                                     float(self.setting("heatpump", "optional_pcb_debounce", 0.5)))
+        except Exception as msg:
+            logging.error(F"pyshamon: {self.prefix}failed to connect to heat pump: {msg}")
+            raise msg
+
+        # a passive unit cannot send, its commands are not subscribed
+        self.mqtt.on_command = None if passive else self.on_command_received
+        self.mqtt.prepare(self.heatpump.topics.topics)
+        self.publishFilter = self.read_filter(self.heatpump.topics.topics)
+
+        self.rawBinary = self.setting("mqtt", "raw_format", "hex").lower() == "binary"
+        self.rawEncoder: RawEncoder = None
+        if self.setting("mqtt", "raw_mode", "full").lower() == "delta":
+            self.rawEncoder = RawEncoder(self.setting("mqtt", "raw_format", "hex").lower(),
+                                         int(self.setting("mqtt", "raw_keyframe_interval", 300)))
+
+        snapshot_mode = self.setting("mqtt", "snapshot", "off").lower()
+        self.snapshotOnly = snapshot_mode != "off" \
+            and self.config.BOOLEAN_STATES.get(self.setting("mqtt", "snapshot_only", "no").lower(), False)
+        self.snapshots = {}
+        if snapshot_mode != "off":
+            self.snapshots = {topic_type: SnapshotEncoder(self.heatpump.topics.topics, topic_type, snapshot_mode)
+                              for topic_type in ("main", "optional")}
+            logging.info(F"pyshamon: {self.prefix}publishing {snapshot_mode} json snapshots"
+                         + (" instead of single topics" if self.snapshotOnly else ""))
+
+        if self.metrics is not None:
+            self.metrics.add(self.heatpump.topics.topics, self.metric_counters, name)
+
+    def setting(self, section: str, key: str, fallback: any = None) -> str:
+        # without a fallback a missing setting raises like ConfigParser.get()
+        if self.config.has_option(self.section, key):
+            return self.config.get(self.section, key)
+        if fallback is None:
+            return self.config.get(section, key)
+        return self.config.get(section, key, fallback=str(fallback))
+
+    def start(self):
+        # everything needing the event loop, called from within Pyshamon.run()
+        loop = asyncio.get_running_loop()
+        history_directory = self.setting("history", "directory", "")
+        if history_directory:
+            if self.name is not None and not self.config.has_option(self.section, "directory"):
+                history_directory = os.path.join(history_directory, self.name)
+            self.history = HistoryStore(history_directory,
+                                        int(self.setting("history", "segment_size_kb", 256)) * 1024,
+                                        float(self.setting("history", "retention_days", 30)) * 86400,
+                                        float(self.setting("history", "minute_retention_days", 2)) * 86400)
+            self.mqtt.add_request_handler("history/query", self.history.request)
+            loop.create_task(self.history.run())
+
+        stats_interval = int(self.setting("pyshamon", "stats_interval", 0))
+        if stats_interval > 0:
+            self.stats = self.heatpump.stats = Stats(self.heatpump.frameReader, self.heatpump.busStats,
+                                                     self.heatpump.scheduler.jobs)
+            loop.create_task(self.stats.run(stats_interval, self.mqtt.publish_stats))
+
+        if self.publishFilter.timed or self.filterReportInterval > 0:
+            loop.create_task(self.run_filter())
+
+        capture_file = self.setting("pyshamon", "capture_file", "")
+        if capture_file:
+            if self.name is not None and not self.config.has_option(self.section, "capture_file"):
+                root, extension = os.path.splitext(capture_file)
+                capture_file = F"{root}-{self.name}{extension}"
+            logging.info(F"pyshamon: {self.prefix}capturing frames to {capture_file}")
+            self.capture = CaptureWriter(capture_file)
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.close()
+        if self.history is not None:
+            self.history.close()
+
+    def read_filter(self, topics: []) -> PublishFilter:
+        rules = {}
+        default = None
+        self.filterReportInterval = 0
+        if self.config.has_section("mqtt_filter"):
+            for key, value in self.config.items("mqtt_filter", raw=True):
+                if key in self.config.defaults():
+                    continue
+                elif key == "report_interval":
+                    self.filterReportInterval = int(value)
+                elif key == "default":
+                    default = FilterRule.parse(value)
+                else:
+                    rules[key] = FilterRule.parse(value)
+
+        known = set(topic.name.lower() for topic in topics)
+        for key in rules:
+            if key not in known:
+                logging.warning(F"pyshamon: filter for unknown topic {key} ignored")
+        return PublishFilter(topics, rules, default)
+
+    async def run_filter(self):
+        # publishes changes held back by a minimum interval, heartbeats and the suppression report
+        loop = asyncio.get_running_loop()
+        next_report = loop.time() + self.filterReportInterval
+        while True:
+            await asyncio.sleep(1)
+            for topic in self.publishFilter.due():
+                logging.info("topic: %s%s", self.prefix, topic)
+                self.publish_topic(topic)
+            if 0 < self.filterReportInterval and next_report <= loop.time():
+                next_report += self.filterReportInterval
+                self.publishFilter.report(self.filterReportInterval)
+
+    def on_topic_received(self, topic: Topic) -> bool:
+        if not topic.delegated:
+            if topic.name == "Alarm_State" and topic.value == 1:
+                logging.warning(f"pyshamon: {self.prefix}heatpump reported alarm state!")
+            if self.history is not None:
+                self.history.add(topic.name, topic.timestamp(), topic.value)
+            # disabled topics stay out of the filter, they are neither suppressed nor due
+            if not topic.enabled:
+                logging.info("topic: %s%s", self.prefix, topic)
+                return False
+            if not self.publishFilter.accept(topic):
+                return False
+            logging.info("topic: %s%s", self.prefix, topic)
+            return self.publish_topic(topic)
+
+    def publish_topic(self, topic: Topic) -> bool:
+        if self.snapshots:
+            self.snapshots[topic.type].add(topic)
+            if self.snapshotOnly:
+                return True
+        if self.stats is None:
+            return self.mqtt.publish(topic)
+        started = time.perf_counter()
+        published = self.mqtt.publish(topic)
+        self.stats.observe("publish", time.perf_counter() - started)
+        return published
+
+    def on_frame_decoded(self, topic_type: str, changed: []):
+        if self.metrics is not None:
+            self.metrics.update(changed)
+        if self.snapshots:
+            snapshot: SnapshotEncoder = self.snapshots[topic_type]
+            payload = snapshot.encode()
+            if payload is not None:
+                self.mqtt.publish_snapshot(topic_type, payload, retain=snapshot.mode == "full")
+
+    def metric_counters(self) -> []:
+        # name, prometheus type, help text, value
+        reader = self.heatpump.frameReader
+        return [
+            ("frames_total", "counter", "frames received from the heat pump", reader.frames),
+            ("checksum_errors_total", "counter", "frames dropped for an invalid checksum", reader.checksumErrors),
+            ("skipped_bytes_total", "counter", "bytes skipped while looking for a frame", reader.skippedBytes),
+            ("mqtt_publishes_total", "counter", "messages published to mqtt", self.mqtt.publishes),
+            ("command_queue_depth", "gauge", "commands waiting for the next send slot",
+             len(self.heatpump.commandBuffer)),
+            ("commands_dropped_total", "counter", "commands dropped on a full command buffer",
+             self.heatpump.commandBuffer.dropped),
+        ] + self.job_counters() + ([] if self.heatpump.readback is None else [
+            ("commands_acked_total", "counter", "commands reported back by the heat pump",
+             self.heatpump.readback.acked),
+            ("commands_nacked_total", "counter", "commands given up after their retries",
+             self.heatpump.readback.nacked),
+            ("commands_retried_total", "counter", "commands sent again as they were not reported back",
+             self.heatpump.readback.retried),
+        ]) + ([] if self.heatpump.busStats is None else [
+            ("bus_frames_total", "counter", "frames seen on the bus, queries of the other controller included",
+             sum(self.heatpump.busStats.frames.values())),
+            ("bus_unanswered_total", "counter", "queries on the bus the heat pump did not answer",
+             self.heatpump.busStats.unanswered),
+            ("bus_poll_interval_seconds", "gauge", "time between the last two polls of the other controller",
+             self.heatpump.busStats.pollInterval),
+        ])
+
+    def job_counters(self) -> []:
+        # how late the bus scheduler ran each job compared to its deadline
+        counters = []
+        for job in self.heatpump.scheduler.jobs:
+            stats = job.stats()
+            job_label = F"job=\"{job.name}\""
+            counters += [
+                ("bus_job_runs_total", "counter", "frames sent per bus job", stats["runs"], job_label),
+                ("bus_job_lateness_seconds", "gauge", "how late the last run of the bus job was", stats["last"],
+                 job_label),
+                ("bus_job_lateness_max_seconds", "gauge", "how late the bus job ran at most", stats["max"], job_label),
+                ("bus_job_lateness_average_seconds", "gauge", "average lateness of the bus job", stats["average"],
+                 job_label),
+                ("bus_job_overdue_total", "counter", "runs of the bus job later than its maximum lateness",
+                 stats["overdue"], job_label),
+            ]
+        return counters
+
+    def on_topic_data(self, topic_type: str, raw: bytes):
+        if self.capture is not None:
+            self.capture.write(raw)
+        if raw != self.last_raw[topic_type]:
+            # the colored diff is only built when it is logged
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                started = time.perf_counter()
+                diff = raw_diff(self.last_raw[topic_type], raw)
+                if self.stats is not None:
+                    self.stats.observe("raw_diff", time.perf_counter() - started)
+                logging.info("raw: %s%s", self.prefix, diff)
+            self.publish_raw(topic_type, raw)
+            self.last_raw[topic_type][:] = raw
+
+    def publish_raw(self, topic_type: str, raw: bytes):
+        if self.rawEncoder is None:
+            self.mqtt.publish_raw(topic_type, encode_frame(raw, self.rawBinary))
+            return
+        keyframe, delta = self.rawEncoder.encode(topic_type, raw)
+        if keyframe is not None:
+            self.mqtt.publish_raw(topic_type, keyframe, retain=True)
+            self.mqtt.publish_raw_delta(topic_type, b"")
+        else:
+            self.mqtt.publish_raw_delta(topic_type, delta)
+
+    def on_command_result(self, readback: Readback, outcome: str, latency: float):
+        name = readback.spec.name
+        if outcome == "retry":
+            logging.warning(F"command: {self.prefix}{name} = {readback.value} not reported back by the heat pump, "
+                            F"sending it again in {readback.retryAt - time.monotonic():.0f}s")
+            return
+        if outcome == "ack":
+            logging.info("command: %s%s = %s applied after %.1fs", self.prefix, name, readback.value, latency)
+        else:
+            logging.error(F"command: {self.prefix}{name} = {readback.value} not applied after "
+                          F"{readback.attempts} attempts")
+        self.mqtt.publish_command_result(name, json.dumps({"value": readback.value, "result": outcome,
+                                                           "latency": round(latency, 3),
+                                                           "attempts": readback.attempts}))
+
+    def on_command_received(self, name: str, param: int):
+        if self.heatpump.commandBuffer.known(name):
+            # a command dropped on a full buffer is logged by the buffer
+            if self.heatpump.command(name, param):
+                logging.info("command: %s%s = %s", self.prefix, name, param)
+        elif self.heatpump.optional_command(name, param):
+            logging.info("optional pcb command: %s%s = %s", self.prefix, name, param)
+        else:
+            logging.error(f"command: {self.prefix}{name} not implemented!")
+
+
 class Pyshamon:
     def __init__(self):
-        self.last_raw = {'main': [0] * 203, 'optional': [0] * 20}
+        self.units = []
+        self.metrics: MetricsExporter = None
+        self.profiler: Profiler = None
+        # the last config file read, files like the outbox default to its directory
+        self.configFile: str = None
 
         self.config = configparser.ConfigParser(os.environ)
         self.read_config()
         self.cleanedUp = False
 
-        self.log_mqtt_level = self.config.getint("pyshamon", "log_mqtt_level")
         logging.basicConfig(format=self.config.get("pyshamon", "log_format"),
                             level=self.config.getint("pyshamon", "log_level"),
                             datefmt="%Y-%m-%dT%H:%M:%S%z")
-        logging.getLogger().addHandler(self.LogHandler(self.on_log))
+        self.logHandler = MQTTLogHandler(self.config.getint("pyshamon", "log_mqtt_level"),
+                                         self.config.getint("pyshamon", "log_mqtt_queue_size", fallback=100))
+        logging.getLogger().addHandler(self.logHandler)
+        # records of all modules and paho go through the root logger, its filter sees every record once
+        self.logRateLimit: RateLimitFilter = None
+        log_rate_limit = self.config.getfloat("pyshamon", "log_rate_limit", fallback=0)
+        if log_rate_limit > 0:
+            self.logRateLimit = RateLimitFilter(log_rate_limit,
+                                                self.config.getint("pyshamon", "log_rate_burst", fallback=10))
+            logging.getLogger().addFilter(self.logRateLimit)
 
         logging.info("pyshamon: starting up")
 
         atexit.register(self.cleanup)
-        signal.signal(signal.SIGINT, self.cleanup)
-        signal.signal(signal.SIGTERM, self.cleanup)
+        asyncio.run(self.run())
 
-        try:
-            self.heatpump = Heatpump(self.config.get("heatpump", "serial_port"),
-                                     self.config.getint("heatpump", "poll_interval"),
-                                     self.config.getint("heatpump", "optional_pcb_poll_interval"),
-                                     self.on_topic_received,
-                                     self.on_topic_data)
-        except Exception as msg:
-            logging.error(F"pyshamon: failed to connect to heat pump: {msg}")
-            raise msg
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.cleanup)
+        loop.add_signal_handler(signal.SIGTERM, self.cleanup)
 
         self.mqtt = MQTT(protocol_version=self.config.getint("mqtt", "version"),
                          host=self.config.get("mqtt", "host"),
                          port=self.config.getint("mqtt", "port"),
                          topic_base=self.config.get("mqtt", "topic_base"),
-                         on_command=self.on_command_received,
+                         on_command=None,
                          published_topics=[key.lower() for (key, value) in self.config.items('mqtt_topics')
                                            if value.lower() in ['yes', 'true', '1']],
                          subscribed_commands=[key.lower() for (key, value) in self.config.items('mqtt_commands')
                                             if value.lower() in ['yes', 'true', '1']],
                          username=self.config.get("mqtt", "username", fallback=None),
-                         password=self.config.get("mqtt", "password", fallback=None))
-        self.mqtt.run()
+                         password=self.config.get("mqtt", "password", fallback=None),
+                         outbox=Outbox(self.outbox_path(),
+                                       self.config.getint("mqtt", "outbox_size", fallback=10000)),
+                         flush_rate=self.config.getint("mqtt", "outbox_flush_rate", fallback=100))
 
-        while not self.cleanedUp:
-            try:
-                self.heatpump.loop()
-            except KeyboardInterrupt:
-                self.cleanup()
-            except Exception as err:
-                if not self.cleanedUp:
-                    logging.error(err)
-
-    class LogHandler(logging.Handler):
-        def __init__(self, on_log: any):
-            self.on_log = on_log
-            logging.Handler.__init__(self)
-
-        def emit(self, record: LogRecord):
-            self.on_log(record)
-
-    def on_log(self, record: LogRecord):
-        if self.log_mqtt_level <= record.levelno:
-            data = {"time": str(datetime.fromtimestamp(record.created)),
-                    "level": record.levelname,
-                    "msg": record.msg}
-            try:
-                self.mqtt.publish_log(json.dumps(data))
-            except AttributeError:
-                pass
+        metrics_port = self.config.getint("metrics", "port", fallback=0)
+        if metrics_port > 0:
+            self.metrics = MetricsExporter(self.config.get("metrics", "host", fallback=""), metrics_port,
+                                           self.config.get("metrics", "prefix", fallback="heatpump"))
+            self.metrics.add([], self.metric_counters)
+
+        # one unit per [heatpump:<name>] section below <topic_base>/<name>, or the [heatpump] section on <topic_base>
+        sections = [section for section in self.config.sections() if section.lower().startswith("heatpump:")]
+        if sections:
+            for section in sections:
+                name = section.split(":", 1)[1].strip()
+                self.units.append(Unit(self.config, name, section, self.mqtt.add_namespace(name, None),
+                                       self.metrics))
+            logging.info(F"pyshamon: managing {len(self.units)} heat pumps: "
+                         F"{', '.join(unit.name for unit in self.units)}")
+        else:
+            self.units.append(Unit(self.config, None, "heatpump", self.mqtt, self.metrics))
+
+        if "log" in self.mqtt.published_topics:
+            loop.create_task(self.logHandler.run(self.mqtt.publish_log))
+        else:
+            logging.getLogger().removeHandler(self.logHandler)
+
+        profile_directory = self.config.get("pyshamon", "profile_directory", fallback="")
+        if profile_directory:
+            self.profiler = Profiler(profile_directory)
+            self.mqtt.add_request_handler("commands/Profile", self.profiler.request)
+
+        for unit in self.units:
+            unit.start()
+        await self.mqtt.run()
+
+        memory_report_interval = self.config.getint("pyshamon", "memory_report_interval", fallback=0)
+        if memory_report_interval > 0:
+            logging.info(F"pyshamon: tracing memory allocations, reporting every {memory_report_interval}s")
+            loop.create_task(MemoryReport().run(memory_report_interval))
+
+        if self.metrics is not None:
+            await self.metrics.start()
+
+        # serial reads, poll timers and mqtt i/o of all heat pumps run on this event loop until shutdown
+        try:
+            if not self.cleanedUp:
+                await asyncio.gather(*[unit.heatpump.run() for unit in self.units])
+        finally:
+            await self.mqtt.stop()
+            if self.profiler is not None:
+                self.profiler.stop()
+            if self.metrics is not None:
+                await self.metrics.stop()
+            for unit in self.units:
+                unit.close()
+
+    def metric_counters(self) -> []:
+        # process wide counters, the units add their own
+        return [
+            ("log_records_dropped_total", "counter", "log records not forwarded to mqtt", self.logHandler.dropped),
+            ("log_records_suppressed_total", "counter", "log records suppressed by the rate limit",
+             self.logRateLimit.suppressed if self.logRateLimit is not None else 0),
+            ("mqtt_connected", "gauge", "1 while connected to the mqtt broker", int(self.mqtt.connected)),
+            ("mqtt_outbox_depth", "gauge", "messages waiting in the outbox for the broker", self.mqtt.outbox.pending),
+            ("mqtt_outbox_dropped_total", "counter", "messages dropped on a full outbox", self.mqtt.outbox.dropped),
+        ]
 
     def read_config(self):
         config_file_candidates = \
             ["/etc/pyshamon.conf", "~/.pyshamon.conf", "pyshamon.conf", sys.argv[1] if len(sys.argv) > 1 else ""]
-        self.config.read(config_file_candidates)
+        read = self.config.read(config_file_candidates)
         if not self.config.sections():
             print(F"Config file not found. Searched: {config_file_candidates}")
             exit(1)
+        self.configFile = read[-1]
+
+    def outbox_path(self) -> str:
+        # empty for outbox-<topic_base>.sqlite next to the config file, so instances with their own topic_base
+        # don't share a queue, :memory: keeps the outbox in memory only
+        path = self.config.get("mqtt", "outbox", fallback="")
+        if path:
+            return path
+        name = "".join(c if c.isalnum() or c in "-_." else "_" for c in self.config.get("mqtt", "topic_base"))
+        return os.path.join(os.path.dirname(os.path.abspath(self.configFile)), F"outbox-{name}.sqlite")
 
     def cleanup(self, *args):
         if self.cleanedUp:
@@ -113,10 +454,11 @@ class Pyshamon:
 
         self.cleanedUp = True
         logging.warning("pyshamon: shutting down")
-        try:
-            self.heatpump.shutdown()
-        except Exception as err:
-            logging.warning(F"pyshamon: failed to disconnect from heat pump: {err}")
+        for unit in self.units:
+            try:
+                unit.heatpump.shutdown()
+            except Exception as err:
+                logging.warning(F"pyshamon: {unit.prefix}failed to disconnect from heat pump: {err}")
 
         try:
             self.mqtt.shutdown()
@@ -125,29 +467,6 @@ class Pyshamon:
 
         pass
 
-    def on_topic_received(self, topic: Topic) -> bool:
-        if not topic.delegated:
-            if topic.name == "Alarm_State" and topic.value == 1:
-                logging.warning(f"pyshamon: heatpump reported alarm state!")
-            logging.info(f"topic: {topic}")
-
-            return self.mqtt.publish(topic)
-
-    def on_topic_data(self, topic_type: str, raw: []):
-        if raw != self.last_raw[topic_type]:
-            diff = raw_diff(self.last_raw[topic_type], raw)
-            logging.info(f"raw: {diff}")
-            self.mqtt.publish_raw(topic_type, raw)
-            self.last_raw[topic_type] = raw
-
-    def on_command_received(self, name: str, param: int):
-        if self.heatpump.command(name, param):
-            logging.info(f"command: {name} = {param}")
-        elif self.heatpump.optional_command(name, param):
-            logging.info(f"optional pcb command: {name} = {param}")
-        else:
-            logging.error(f"command: {name} not implemented!")
-
 
 if __name__ == '__main__':
     Pyshamon()
@@ -0,0 +1,86 @@
+import binascii
+import time
+
+from topics import changed_offsets
+
+rawFormats = ("hex", "binary")
+
+# unchanged bytes between two changed ranges up to this gap are sent along, a new range costs two bytes
+merge_gap = 2
+
+
+def changed_ranges(old: bytes, new: bytes) -> []:
+    # (offset, length) of the byte ranges that differ, close ranges merged
+    ranges = []
+    for offset in changed_offsets(old, new):
+        if ranges and offset - (ranges[-1][0] + ranges[-1][1]) <= merge_gap:
+            ranges[-1][1] = offset - ranges[-1][0] + 1
+        else:
+            ranges.append([offset, 1])
+    return ranges
+
+
+def encode_frame(frame: bytes, binary: bool) -> bytes:
+    return bytes(frame) if binary else binascii.hexlify(frame, " ")
+
+
+def encode_delta(frame: bytes, ranges: [], binary: bool) -> bytes:
+    # binary: offset byte, length byte, bytes per range. hex: "<offset>:<hex bytes>" per range, space separated
+    if binary:
+        delta = bytearray()
+        for offset, length in ranges:
+            delta.append(offset)
+            delta.append(length)
+            delta += frame[offset:offset + length]
+        return bytes(delta)
+    return b" ".join(b"%d:%s" % (offset, binascii.hexlify(frame[offset:offset + length]))
+                     for offset, length in ranges)
+
+
+def apply_delta(keyframe: bytes, delta: bytes, binary: bool) -> bytes:
+    frame = bytearray(keyframe)
+    if binary:
+        position = 0
+        while position < len(delta):
+            offset, length = delta[position], delta[position + 1]
+            frame[offset:offset + length] = delta[position + 2:position + 2 + length]
+            position += 2 + length
+    else:
+        for part in delta.split():
+            offset, data = part.split(b":")
+            data = binascii.unhexlify(data)
+            frame[int(offset):int(offset) + len(data)] = data
+    return bytes(frame)
+
+
+class RawEncoder:
+    # full frames are published retained as keyframes, changes in between as the difference to the last
+    # keyframe, also retained. A subscriber rebuilds the current frame from the two retained messages alone.
+    # A new keyframe follows after keyframe_interval seconds or when the delta grows beyond half a frame.
+    def __init__(self, raw_format: str = "hex", keyframe_interval: float = 300, clock: any = time.monotonic):
+        if raw_format not in rawFormats:
+            raise ValueError(F"unknown raw format '{raw_format}', expected one of {', '.join(rawFormats)}")
+        self.binary = raw_format == "binary"
+        self.keyframeInterval = keyframe_interval
+        self.clock = clock
+        # frame type -> (keyframe, time.monotonic() it was sent)
+        self.keyframes = {}
+        self.keyframesSent = 0
+        self.deltasSent = 0
+
+    def encode(self, topic_type: str, raw: bytes) -> ():
+        # returns (keyframe, delta), either may be None
+        now = self.clock()
+        keyframe, sent = self.keyframes.get(topic_type, (None, 0))
+        if keyframe is None or len(keyframe) != len(raw) or now - sent >= self.keyframeInterval:
+            return self.keyframe(topic_type, raw, now), None
+        ranges = changed_ranges(keyframe, raw)
+        if sum(length + 2 for _, length in ranges) > len(raw) // 2:
+            return self.keyframe(topic_type, raw, now), None
+        self.deltasSent += 1
+        return None, encode_delta(raw, ranges, self.binary)
+
+    def keyframe(self, topic_type: str, raw: bytes, now: float) -> bytes:
+        self.keyframes[topic_type] = (bytes(raw), now)
+        self.keyframesSent += 1
+        return encode_frame(raw, self.binary)
@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import logging
+import math
+import time
+
+
+class BusJob:
+    # a frame sent on the bus at a deadline. Lower priority values win when several jobs are due,
+    # a job later than max_lateness wins over all jobs within their lateness.
+    __slots__ = ("name", "priority", "interval", "maxLateness", "run", "deadline", "runs", "lateness", "maxLate",
+                 "totalLate", "overdueRuns")
+
+    def __init__(self, name: str, priority: int, run: any, interval: float = None, max_lateness: float = math.inf):
+        self.name = name
+        self.priority = priority
+        self.run = run
+        self.interval = interval
+        self.maxLateness = max_lateness
+        self.deadline = math.inf
+
+        # how late the job ran compared to its deadline
+        self.runs = 0
+        self.lateness = 0.0
+        self.maxLate = 0.0
+        self.totalLate = 0.0
+        self.overdueRuns = 0
+
+    def __str__(self):
+        average = self.totalLate / self.runs if self.runs else 0
+        return F"{self.name}: {self.runs} runs, lateness last {self.lateness:.3f}s avg {average:.3f}s " \
+               F"max {self.maxLate:.3f}s, {self.overdueRuns} beyond {self.maxLateness}s"
+
+    def stats(self) -> {}:
+        # lateness in seconds
+        return {"runs": self.runs, "last": round(self.lateness, 4), "max": round(self.maxLate, 4),
+                "average": round(self.totalLate / self.runs, 4) if self.runs else 0, "overdue": self.overdueRuns}
+
+
+class BusScheduler:
+    # jobs ordered by their time.monotonic() deadline, consecutive frames are at least spacing seconds apart
+    def __init__(self, spacing: float, clock: any = time.monotonic):
+        self.spacing = spacing
+        self.clock = clock
+        self.queue = []
+        self.sequence = itertools.count()
+        self.jobs = []
+        self.nextAllowedSend = -math.inf
+
+    def add(self, job: BusJob, deadline: float = math.inf) -> BusJob:
+        self.jobs.append(job)
+        self.schedule(job, deadline)
+        return job
+
+    def schedule(self, job: BusJob, deadline: float):
+        # moves the job to a new deadline, the old heap entry becomes stale and is skipped
+        if deadline == job.deadline:
+            return
+        job.deadline = deadline
+        if deadline != math.inf:
+            heapq.heappush(self.queue, (deadline, next(self.sequence), job))
+
+    def schedule_earlier(self, job: BusJob, deadline: float):
+        if deadline < job.deadline:
+            self.schedule(job, deadline)
+
+    def hold_off(self, delay: float):
+        # no frame before now + delay, e.g. after a failed exchange
+        self.nextAllowedSend = max(self.nextAllowedSend, self.clock() + delay)
+
+    def next_run(self) -> float:
+        queue = self.queue
+        while queue and queue[0][2].deadline != queue[0][0]:
+            heapq.heappop(queue)
+        if not queue:
+            return math.inf
+        return max(self.nextAllowedSend, queue[0][0])
+
+    def pop(self, now: float) -> BusJob:
+        # among the due jobs those beyond their max lateness go first, then the highest priority and earliest deadline
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            entry = heapq.heappop(self.queue)
+            if entry[2].deadline == entry[0]:
+                due.append(entry)
+        if not due:
+            return None
+
+        best = min(due, key=lambda e: (now - e[0] <= e[2].maxLateness, e[2].priority, e[0]))
+        for entry in due:
+            if entry is not best:
+                heapq.heappush(self.queue, entry)
+
+        job: BusJob = best[2]
+        lateness = now - job.deadline
+        job.runs += 1
+        job.lateness = lateness
+        job.totalLate += lateness
+        job.maxLate = max(job.maxLate, lateness)
+        if lateness > job.maxLateness:
+            job.overdueRuns += 1
+
+        # periodic jobs run again one interval after they actually ran, a late job does not catch up in a burst
+        if job.interval:
+            self.schedule(job, now + job.interval)
+        else:
+            job.deadline = math.inf
+        self.nextAllowedSend = now + self.spacing
+        return job
+
+    def run_due(self) -> BusJob:
+        job = self.pop(self.clock())
+        if job is not None:
+            job.run()
+        return job
+
+    def log(self):
+        for job in self.jobs:
+            logging.info(F"scheduler: {job}")
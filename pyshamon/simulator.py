@@ -0,0 +1,215 @@
+import argparse
+import logging
+import os
+import random
+import select
+import termios
+import threading
+import time
+import tty
+
+import command
+from topics import checksum, valid_checksum
+
+# heat pump answer taken from the protocol documentation
+sampleMainFrame = bytes.fromhex(
+    "71c801105655624900050000000000000000000019151155165e550509000000000000000000808f808ab27171979900000000"
+    "000000000000008085158a8585d07b781f7e1f1f79798d8d9e96718fb7a37b8f8e85808f8a949e8a8a949e82908b056578c1"
+    "0b00000000000000005556552153155a051212190000000000000000e2ce0d718172ce0c9281b000aa7cabb032329cb632"
+    "323280b7afcd9aac79807780ff9101295900003b0b1c51590136790101c30200dd02000500000100000601010101010a1400"
+    "000077")
+sampleOptionalFrame = bytes([0x71, 0x11, 0x01, 0x50] + [0x00] * 15 + [0x2d])
+
+# bytes changing between polls on a running heat pump: flow, temperatures, compressor, pressures, fans
+noisyBytes = (118, 143, 144, 145, 146, 155, 158, 160, 163, 164, 165, 166, 169, 170, 171, 172, 173, 174)
+
+# bit groups of the settings bytes a command frame can change, a group left 0 in the command keeps its state
+settingGroups = {
+    4: (0xC0, 0x30, 0x0C, 0x03),
+    5: (0xC0, 0x30, 0x0C, 0x03),
+    6: (0xC0, 0x3F),
+    7: (0xC0, 0x38, 0x07),
+    20: (0xC0, 0x30, 0x0C, 0x03),
+    25: (0xC0, 0x30, 0x0C, 0x03),
+}
+# operation mode as sent by SetOperationMode -> as reported by the heat pump
+operationModes = {24: 25, 40: 41}
+# reset, force defrost and force sterilization only trigger an action
+momentaryBytes = (8,)
+
+baud_bits_per_byte = 11
+
+
+class Simulator:
+    # answers pyshamon on a pseudo-terminal like a heat pump: polls with 203 bytes main frames,
+    # optional pcb frames with 20 bytes frames, command frames are applied to the simulated settings
+    def __init__(self, link: str = None, delay: float = 0.05, noise: float = 0.2, drop: float = 0.0,
+                 corrupt: float = 0.0, baud: int = 0, seed: int = None):
+        self.delay = delay
+        self.noise = noise
+        self.drop = drop
+        self.corrupt = corrupt
+        self.baud = baud
+        self.random = random.Random(seed)
+        self.state = bytearray(sampleMainFrame)
+        self.optional = bytearray(sampleOptionalFrame)
+        self.lastOptionalQuery: bytes = None
+        self.settingOffsets = set(spec.offset for spec in command.commands.values()) - set(momentaryBytes)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        # the slave stays open here, so the pty survives pyshamon closing and reopening the port
+        self.port = os.ttyname(self.slave)
+        self.speed = termios.tcgetattr(self.slave)[4]
+        self.link = link
+        if link is not None:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.port, link)
+
+        self.buffer = bytearray()
+        self.running = False
+        self.thread: threading.Thread = None
+
+        self.queries = 0
+        self.commands = 0
+        self.optionalQueries = 0
+        self.dropped = 0
+        self.corrupted = 0
+        self.invalid = 0
+        # time.monotonic() when the last answer was written completely
+        self.answered: float = None
+
+    def start(self) -> str:
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.link or self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.unlink(self.link)
+
+    def run(self):
+        self.running = True
+        logging.info(F"simulator: heat pump listening on {self.link or self.port}")
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.2)
+            self.keep_reopenable()
+            if readable:
+                self.buffer += os.read(self.master, 1024)
+                for query in self.frames():
+                    self.on_query(query)
+
+    def keep_reopenable(self):
+        # a pty ignores parity, so a client setting the same speed and parity again changes nothing it honours
+        # and linux fails that tcsetattr with EINVAL. Resetting the speed lets pyserial reopen the port.
+        attributes = termios.tcgetattr(self.slave)
+        if attributes[4] != self.speed:
+            attributes[4] = attributes[5] = self.speed
+            termios.tcsetattr(self.slave, termios.TCSANOW, attributes)
+
+    def frames(self) -> []:
+        frames = []
+        while len(self.buffer) >= 2:
+            if self.buffer[0] not in (0x71, 0xF1):
+                del self.buffer[0]
+                continue
+            size = self.buffer[1] + 3
+            if len(self.buffer) < size:
+                break
+            frames.append(bytes(self.buffer[:size]))
+            del self.buffer[:size]
+        return frames
+
+    def on_query(self, query: bytes):
+        if not valid_checksum(query) or len(query) < 4:
+            self.invalid += 1
+            logging.warning(F"simulator: ignoring invalid query {query.hex(' ')}")
+            return
+
+        if query[3] == 0x50:
+            self.optionalQueries += 1
+            self.lastOptionalQuery = query
+            answer = self.optional_answer()
+        elif query[0] == 0xF1:
+            self.commands += 1
+            self.apply(query)
+            answer = self.main_answer()
+        else:
+            self.queries += 1
+            answer = self.main_answer()
+
+        if self.random.random() < self.drop:
+            self.dropped += 1
+            return
+        if self.random.random() < self.corrupt:
+            self.corrupted += 1
+            answer[self.random.randrange(4, len(answer))] ^= 1 << self.random.randrange(8)
+
+        time.sleep(self.delay)
+        if self.baud:
+            # write at the pace of the real bus
+            for i in range(0, len(answer), 16):
+                os.write(self.master, answer[i:i + 16])
+                time.sleep(len(answer[i:i + 16]) * baud_bits_per_byte / self.baud)
+        else:
+            os.write(self.master, answer)
+        self.answered = time.monotonic()
+
+    def apply(self, query: bytes):
+        for offset in self.settingOffsets:
+            value = query[offset]
+            if value == 0:
+                continue
+            groups = settingGroups.get(offset)
+            if groups is None:
+                self.state[offset] = value
+                continue
+            if offset == 6 and value & 0x3F:
+                value = (value & 0xC0) | operationModes.get(value & 0x3F, value & 0x3F)
+            for mask in groups:
+                if value & mask:
+                    self.state[offset] = (self.state[offset] & ~mask) | (value & mask)
+
+    def main_answer(self) -> bytearray:
+        # random walk on the measured values like a running unit
+        for offset in noisyBytes:
+            if self.random.random() < self.noise:
+                self.state[offset] = max(1, min(254, self.state[offset] + self.random.choice((-1, 1))))
+        self.state[-1] = checksum(self.state[:-1])
+        return bytearray(self.state)
+
+    def optional_answer(self) -> bytearray:
+        self.optional[-1] = checksum(self.optional[:-1])
+        return bytearray(self.optional)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="simulated heat pump on a pseudo-terminal")
+    parser.add_argument("--link", default="/tmp/heatpump", help="symlink to the pty, use as serial_port")
+    parser.add_argument("--delay", type=float, default=0.05, help="seconds before answering a query")
+    parser.add_argument("--noise", type=float, default=0.2, help="chance per measured byte to change per answer")
+    parser.add_argument("--drop", type=float, default=0.0, help="chance to not answer a query")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="chance to flip a bit in an answer")
+    parser.add_argument("--baud", type=int, default=0, help="pace answers like a serial line, 0 to write at once")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    simulator = Simulator(args.link, args.delay, args.noise, args.drop, args.corrupt, args.baud, args.seed)
+    print(F"simulated heat pump on {simulator.port}, linked from {args.link}", flush=True)
+    try:
+        simulator.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+        print(F"{simulator.queries} polls, {simulator.commands} commands, {simulator.optionalQueries} optional pcb "
+              F"frames, {simulator.dropped} dropped, {simulator.corrupted} corrupted, {simulator.invalid} invalid")
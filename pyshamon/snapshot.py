@@ -0,0 +1,44 @@
+import json
+import time
+
+from topics import Topic
+
+snapshotModes = ("off", "full", "changes")
+
+
+def encode_value(value: any) -> str:
+    if value is None:
+        return "null"
+    elif isinstance(value, str):
+        return json.dumps(value)
+    return str(value)
+
+
+class SnapshotEncoder:
+    # builds one json document per frame, keys are encoded once so a document is a single join
+    def __init__(self, topics: [], topic_type: str, mode: str):
+        if mode not in snapshotModes:
+            raise ValueError(F"unknown snapshot mode '{mode}', expected one of {', '.join(snapshotModes)}")
+        self.mode = mode
+        self.topics = [topic for topic in topics if topic.type == topic_type and topic.enabled]
+        self.keys = {topic: json.dumps(topic.name) + ":" for topic in self.topics}
+        self.changes = []
+
+    def add(self, topic: Topic):
+        if self.mode == "changes" and topic in self.keys:
+            self.changes.append(topic)
+
+    def encode(self) -> any:
+        # full: every published topic of the frame type, changes: the topics collected by add() since the last call
+        if self.mode == "full":
+            topics = self.topics
+        else:
+            topics = self.changes
+            if not topics:
+                return None
+        keys = self.keys
+        parts = [F'{{"dt":{int(time.time())}']
+        for topic in topics:
+            parts.append(keys[topic] + encode_value(topic.value))
+        self.changes.clear()
+        return ",".join(parts) + "}"
@@ -0,0 +1,189 @@
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import time
+
+from frame import FrameReader, answerKinds, classify, frameKinds, kind_poll, kind_unknown
+
+# pipeline stages timed with time.perf_counter(): serial read, frame decoding, the per topic callbacks,
+# the raw frame diff for logging, mqtt publish, how long commands waited for a send slot and how long after
+# sending the heat pump reported a command's value
+stages = ("read", "decode", "callbacks", "raw_diff", "publish", "command_wait", "command_effect")
+
+histogram_buckets = 32
+
+
+class Histogram:
+    # bucket i counts durations below 2^i microseconds, recording is an index increment
+    __slots__ = ("counts", "count", "total", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * histogram_buckets
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, seconds: float):
+        micros = int(seconds * 1000000)
+        self.counts[min(histogram_buckets - 1, micros.bit_length())] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, fraction: float) -> int:
+        # upper bound in microseconds of the bucket holding the percentile
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return 1 << bucket
+        return 1 << histogram_buckets
+
+    def summary(self) -> {}:
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "avg_us": round(self.total / self.count * 1000000, 1),
+                "p50_us": self.percentile(0.5), "p99_us": self.percentile(0.99),
+                "max_us": round(self.maximum * 1000000, 1)}
+
+
+class BusStats:
+    # traffic on a bus polled by another controller: frames per kind, the other controller's poll interval,
+    # how long the heat pump took to answer and the queries left without an answer
+    def __init__(self, clock: any = time.monotonic):
+        self.clock = clock
+        self.frames = dict.fromkeys(list(frameKinds.values()) + [kind_unknown], 0)
+        self.unanswered = 0
+        self.unsolicited = 0
+        # (kind of the expected answer, time.monotonic() of the query)
+        self.waiting: () = None
+        self.lastPoll: float = None
+        self.pollInterval = 0.0
+        self.answers = Histogram()
+        self.lastFrames = dict(self.frames)
+        self.lastUnanswered = 0
+
+    def add(self, frame: bytes) -> str:
+        now = self.clock()
+        kind = classify(frame)
+        self.frames[kind] += 1
+        answer = answerKinds.get(kind)
+        if answer is not None:
+            if self.waiting is not None:
+                self.unanswered += 1
+            self.waiting = (answer, now)
+            if kind == kind_poll:
+                if self.lastPoll is not None:
+                    self.pollInterval = now - self.lastPoll
+                self.lastPoll = now
+        elif self.waiting is not None and self.waiting[0] == kind:
+            self.answers.observe(now - self.waiting[1])
+            self.waiting = None
+        elif kind != kind_unknown:
+            # the query was lost in a checksum error or sent before listening started
+            self.unsolicited += 1
+        return kind
+
+    def report(self) -> {}:
+        report = {"frames": {kind: count - self.lastFrames[kind] for kind, count in self.frames.items()},
+                  "unanswered": self.unanswered - self.lastUnanswered, "poll_interval": round(self.pollInterval, 2),
+                  "answer": self.answers.summary()}
+        self.lastFrames = dict(self.frames)
+        self.lastUnanswered = self.unanswered
+        self.answers = Histogram()
+        return report
+
+
+class Stats:
+    # timing histograms per stage, reported and cleared every interval together with the frame reader's rates.
+    # The lateness of the bus jobs is reported as counted since the start.
+    def __init__(self, frame_reader: FrameReader, bus_stats: BusStats = None, jobs: [] = None):
+        self.frameReader = frame_reader
+        self.busStats = bus_stats
+        self.jobs = jobs or []
+        self.histograms = {stage: Histogram() for stage in stages}
+        self.lastReport = time.monotonic()
+        self.lastCounters = self.counters()
+
+    def counters(self) -> ():
+        return self.frameReader.frames, self.frameReader.bytes, self.frameReader.checksumErrors
+
+    def observe(self, stage: str, seconds: float):
+        self.histograms[stage].observe(seconds)
+
+    def report(self) -> {}:
+        now = time.monotonic()
+        elapsed = max(now - self.lastReport, 1e-9)
+        counters = self.counters()
+        frames, received, checksum_errors = [new - old for new, old in zip(counters, self.lastCounters)]
+        report = {"interval": round(elapsed, 1), "frames_per_s": round(frames / elapsed, 2),
+                  "bytes_per_s": round(received / elapsed, 1), "checksum_errors": checksum_errors}
+        for stage, histogram in self.histograms.items():
+            report[stage] = histogram.summary()
+            self.histograms[stage] = Histogram()
+        if self.busStats is not None:
+            report["bus"] = self.busStats.report()
+        if self.jobs:
+            report["jobs"] = {job.name: job.stats() for job in self.jobs}
+        self.lastReport = now
+        self.lastCounters = counters
+        return report
+
+    async def run(self, interval: int, publish: any):
+        while True:
+            await asyncio.sleep(interval)
+            publish(json.dumps(self.report()))
+
+
+class Profiler:
+    # a cProfile session of limited length, started over mqtt on a running unit, written to directory
+    def __init__(self, directory: str, max_seconds: int = 300):
+        self.directory = directory
+        self.maxSeconds = max_seconds
+        self.profile: cProfile.Profile = None
+        self.path: str = None
+        # the timer ending the session, cancelled when the session is stopped otherwise
+        self.timer: asyncio.TimerHandle = None
+
+    def start(self, seconds: float) -> str:
+        if self.profile is not None:
+            raise ValueError(F"already profiling into {self.path}")
+        seconds = min(self.maxSeconds, seconds)
+        if seconds <= 0:
+            raise ValueError("profiling needs a positive number of seconds")
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, F"pyshamon-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+        if self.timer is not None:
+            self.timer.cancel()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+        logging.info(F"stats: profiling for {seconds}s into {self.path}")
+        return self.path
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.profile.dump_stats(self.path)
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(10)
+        logging.info(F"stats: profile written to {self.path}\n{summary.getvalue()}")
+        self.profile = None
+
+    def request(self, payload: bytes) -> str:
+        # payload is the number of seconds to profile, answers with the profile's path
+        try:
+            path = self.start(float(payload))
+            return json.dumps({"profile": path})
+        except ValueError as err:
+            return json.dumps({"error": F"profile not started: {err}"})
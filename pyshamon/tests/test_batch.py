@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+import batch  # noqa: E402
+
+
+@pytest.mark.parametrize("topic_type, size", [("main", 203), ("optional", 20)])
+def test_batch_matches_streaming_decoder(topic_type: str, size: int):
+    assert batch.verify(topic_type, batch.random_frames(2000, size, seed=1)) == 0
+
+
+def test_decode_capture_npz(tmp_path):
+    from capture import CaptureWriter
+    from simulator import sampleMainFrame, sampleOptionalFrame
+
+    path = str(tmp_path / "bus.cap")
+    writer = CaptureWriter(path)
+    for i in range(10):
+        writer.write(sampleMainFrame if i % 2 else sampleOptionalFrame, 100.0 + i)
+    writer.close()
+
+    result = batch.decode_capture(path, str(tmp_path / "bus"), "npz", workers=1)
+    assert (result["main"], result["optional"], result["invalid"]) == (5, 5, 0)
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import threading
+
+import capture
+from capture import CaptureReader, CaptureWriter, frameRecord, kind_frame, kind_repeat, kind_session, sessionRecord
+from simulator import sampleMainFrame, sampleOptionalFrame
+
+
+def read(path: str) -> []:
+    reader = CaptureReader(path)
+    records = [(kind, monotonic, None if frame is None else bytes(frame)) for kind, _, monotonic, frame in
+               reader.records()]
+    reader.close()
+    return records
+
+
+def test_repeats_are_replayed_at_their_times(tmp_path):
+    path = str(tmp_path / "bus.cap")
+    writer = CaptureWriter(path)
+    for i in range(6):
+        writer.write(sampleMainFrame if i % 2 else sampleOptionalFrame, 100.0 + i)
+    writer.close()
+    records = read(path)
+    assert [kind for kind, _, _ in records] == [kind_session, kind_frame, kind_frame] + [kind_repeat] * 4
+    assert [(monotonic, frame) for _, monotonic, frame in records[1:]] == \
+        [(100.0 + i, sampleMainFrame if i % 2 else sampleOptionalFrame) for i in range(6)]
+
+
+def test_flush_writes_pending_repeats(tmp_path):
+    path = str(tmp_path / "bus.cap")
+    writer = CaptureWriter(path, flush_interval=10)
+    for i in range(12):
+        writer.write(sampleMainFrame, float(i))
+    # the repeats up to the flush at 10s are on disk while the writer is still open
+    assert [monotonic for _, monotonic, _ in read(path)[1:]] == [float(i) for i in range(11)]
+    writer.close()
+    assert [monotonic for _, monotonic, _ in read(path)[1:]] == [float(i) for i in range(12)]
+
+
+def test_torn_record_is_cut_off_on_reopen(tmp_path):
+    path = str(tmp_path / "bus.cap")
+    writer = CaptureWriter(path)
+    writer.write(sampleMainFrame, 1.0)
+    writer.close()
+    size = os.path.getsize(path)
+    with open(path, "ab") as file:
+        file.write(frameRecord.pack(kind_frame, 2.0, len(sampleMainFrame))[:6])
+
+    # the reader stops at the torn record
+    assert [kind for kind, _, _ in read(path)] == [kind_session, kind_frame]
+
+    writer = CaptureWriter(path)
+    writer.file.flush()
+    assert os.path.getsize(path) == size + sessionRecord.size
+    writer.write(sampleOptionalFrame, 5.0)
+    writer.close()
+    records = read(path)
+    assert [(kind, frame) for kind, _, frame in records] == \
+        [(kind_session, None), (kind_frame, sampleMainFrame), (kind_session, None), (kind_frame, sampleOptionalFrame)]
+    assert records[-1][1] == 5.0
+
+
+def test_torn_frame_bytes_are_skipped(tmp_path):
+    path = str(tmp_path / "bus.cap")
+    writer = CaptureWriter(path)
+    writer.write(sampleMainFrame, 1.0)
+    writer.write(sampleOptionalFrame, 2.0)
+    writer.close()
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 5)
+    assert [frame for _, _, frame in read(path)] == [None, sampleMainFrame]
+
+
+def test_flush_syncs_in_the_executor(tmp_path, monkeypatch):
+    threads = []
+    monkeypatch.setattr(capture.os, "fsync", lambda fileno: threads.append(threading.current_thread()))
+
+    async def flush():
+        writer = CaptureWriter(str(tmp_path / "bus.cap"))
+        writer.write(sampleMainFrame)
+        writer.flush()
+        await writer.syncing
+        writer.close()
+
+    asyncio.run(flush())
+    assert threads and threads[0] is not threading.main_thread()
@@ -0,0 +1,158 @@
+import pytest
+
+from command import Command, CommandBuffer, CommandReadback, OptionalCommand, find_command
+from simulator import Simulator
+from topics import Topics, valid_checksum
+
+
+@pytest.fixture
+def simulator() -> Simulator:
+    simulator = Simulator(noise=0, seed=1)
+    yield simulator
+    simulator.stop()
+
+
+def decoded(frame: bytes) -> {}:
+    topics = Topics()
+    topics.decode_and_update(frame)
+    return {topic.name: topic.value for topic in topics.topics}
+
+
+# command, value, topic decoded from the heat pump's answer
+roundTrips = [
+    ("SetHeatpump", 1, "Heatpump_State"),
+    ("SetHeatpump", 0, "Heatpump_State"),
+    ("SetMaxPumpDuty", 100, "Max_Pump_Duty"),
+    ("SetQuietMode", 2, "Quiet_Mode_Level"),
+    ("SetPowerfulMode", 2, "Powerful_Mode_Time"),
+    ("SetHolidayMode", 1, "Holiday_Mode_State"),
+    ("SetForceDHW", 1, "Force_DHW_State"),
+    ("SetOperationMode", 2, "Operating_Mode_State"),
+    ("SetOperationMode", 4, "Operating_Mode_State"),
+    ("SetZ1HeatRequestTemperature", 35, "Z1_Heat_Request_Temp"),
+    ("SetZ1CoolRequestTemperature", -3, "Z1_Cool_Request_Temp"),
+    ("SetDHWTemp", 48, "DHW_Target_Temp"),
+]
+
+
+@pytest.mark.parametrize("name, value, topic", roundTrips)
+def test_round_trip(simulator: Simulator, name: str, value: int, topic: str):
+    command = Command()
+    assert command.set(name, value)
+    query = command.command_query()
+    assert valid_checksum(query)
+    simulator.apply(query)
+    assert decoded(bytes(simulator.main_answer()))[topic] == value
+
+
+def test_case_folded_lookup():
+    assert find_command("setdhwtemp") is find_command("SetDHWTemp")
+    assert find_command("SetPoolTemp").optional
+
+
+def test_unknown_command():
+    assert not Command().set("SetNothing", 1)
+    assert not CommandBuffer.known("SetNothing")
+    assert find_command("SetNothing") is None
+
+
+def test_buffer_merges_and_splits(simulator: Simulator):
+    buffer = CommandBuffer()
+    for name, value in (("SetDHWTemp", 40), ("SetHeatpump", 1), ("SetForceDHW", 1), ("SetDHWTemp", 45)):
+        assert buffer.add(name, value)
+    # SetForceDHW writes byte 4 like SetHeatpump and goes out in a second frame, SetDHWTemp keeps its latest value
+    command, merged = buffer.pop()
+    assert merged == ["SetDHWTemp", "SetHeatpump"]
+    simulator.apply(command.command_query())
+    command, merged = buffer.pop()
+    assert merged == ["SetForceDHW"]
+    assert len(buffer) == 0
+    simulator.apply(command.command_query())
+
+    values = decoded(bytes(simulator.main_answer()))
+    assert (values["DHW_Target_Temp"], values["Heatpump_State"], values["Force_DHW_State"]) == (45, 1, 1)
+
+
+def test_buffer_full():
+    buffer = CommandBuffer(max_pending=1)
+    assert buffer.add("SetDHWTemp", 40)
+    assert buffer.add("SetDHWTemp", 41)
+    assert not buffer.add("SetHeatpump", 1)
+    assert buffer.dropped == 1
+
+
+@pytest.mark.parametrize("name, value, topic", roundTrips)
+def test_applied_command_is_reported_back(simulator: Simulator, name: str, value: int, topic: str):
+    command = Command()
+    command.set(name, value)
+    query = command.command_query()
+    simulator.apply(query)
+    spec = find_command(name)
+    assert spec.readback(simulator.main_answer()[spec.offset], query[spec.offset])
+
+
+def readback_run(simulator: Simulator, apply_at: int) -> ():
+    # sends SetDHWTemp until it is decided, the simulator applies it with the apply_at-th frame
+    now = [0.0]
+    readback = CommandReadback(settle=2, retries=1, backoff=5, clock=lambda: now[0])
+    buffer = CommandBuffer()
+    buffer.add("SetDHWTemp", 52)
+    command, _ = buffer.pop()
+    query = command.command_query()
+    outcomes = []
+    for attempt in range(1, 4):
+        readback.sent(buffer.sent, query)
+        if attempt == apply_at:
+            simulator.apply(query)
+        now[0] += 3
+        outcomes += [outcome for _, outcome in readback.check(bytes(simulator.main_answer()))]
+        if not readback.pending:
+            break
+        now[0] += 10
+    return outcomes, readback
+
+
+def test_readback_waits_for_the_settle_time(simulator: Simulator):
+    now = [0.0]
+    readback = CommandReadback(settle=2, clock=lambda: now[0])
+    buffer = CommandBuffer()
+    buffer.add("SetDHWTemp", 52)
+    command, _ = buffer.pop()
+    readback.sent(buffer.sent, command.command_query())
+    now[0] = 1
+    assert readback.check(bytes(simulator.main_answer())) == []
+    assert readback.pending
+
+
+def test_readback_ack_after_retry(simulator: Simulator):
+    outcomes, readback = readback_run(simulator, apply_at=2)
+    assert outcomes == ["retry", "ack"]
+    assert (readback.acked, readback.retried, readback.nacked) == (1, 1, 0)
+
+
+def test_readback_gives_up_after_retries(simulator: Simulator):
+    outcomes, readback = readback_run(simulator, apply_at=0)
+    assert outcomes == ["retry", "nack"]
+    assert (readback.acked, readback.nacked) == (0, 1)
+
+
+def test_momentary_commands_are_not_read_back():
+    readback = CommandReadback()
+    buffer = CommandBuffer()
+    buffer.add("SetForceDefrost", 1)
+    command, _ = buffer.pop()
+    readback.sent(buffer.sent, command.command_query())
+    assert not readback.pending
+
+
+def test_optional_command_tracks_changes():
+    command = OptionalCommand()
+    assert command.set("SetPoolTemp", 30)
+    assert command.changed
+    query = command.optional_command_query()
+    assert valid_checksum(query)
+    assert not command.changed
+    # the same value again leaves the frame unchanged
+    assert command.set("SetPoolTemp", 30)
+    assert not command.changed
+    assert not command.set("SetDHWTemp", 30)
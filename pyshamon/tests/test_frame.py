@@ -0,0 +1,63 @@
+from command import optionalPCBTemplate, pollQuery
+from frame import FrameReader, classify, kind_optional_query, kind_poll, kind_response
+from simulator import sampleMainFrame, sampleOptionalFrame
+
+
+def test_whole_frames():
+    reader = FrameReader()
+    assert reader.feed(sampleMainFrame + sampleOptionalFrame) == [sampleMainFrame, sampleOptionalFrame]
+    assert reader.frames == 2
+    assert reader.skippedBytes == 0
+
+
+def test_split_feeds():
+    reader = FrameReader()
+    frames = []
+    data = sampleMainFrame * 3
+    for i in range(0, len(data), 7):
+        frames += reader.feed(data[i:i + 7])
+    assert frames == [sampleMainFrame] * 3
+    assert reader.bytes == len(data)
+
+
+def test_single_bytes():
+    reader = FrameReader()
+    frames = []
+    for byte in sampleOptionalFrame + sampleMainFrame:
+        frames += reader.feed(bytes([byte]))
+    assert frames == [sampleOptionalFrame, sampleMainFrame]
+
+
+def test_garbage_resync():
+    reader = FrameReader()
+    garbage = bytes([0x00, 0x13, 0x71, 0x05, 0xF1, 0xFF])
+    assert reader.feed(garbage + sampleMainFrame + garbage + sampleOptionalFrame) == \
+        [sampleMainFrame, sampleOptionalFrame]
+    assert reader.skippedBytes == 2 * len(garbage)
+
+
+def test_checksum_error():
+    reader = FrameReader()
+    broken = bytearray(sampleMainFrame)
+    broken[50] ^= 0x01
+    assert reader.feed(bytes(broken) + sampleMainFrame) == [sampleMainFrame]
+    assert reader.checksumErrors >= 1
+
+
+def test_truncated_frame_followed_by_frame():
+    # a frame cut off by a lost byte must not swallow the next one
+    reader = FrameReader()
+    assert reader.feed(sampleMainFrame[:100] + sampleMainFrame) == [sampleMainFrame]
+
+
+def test_reset_drops_partial_frame():
+    reader = FrameReader()
+    assert reader.feed(sampleMainFrame[:100]) == []
+    reader.reset()
+    assert reader.feed(sampleOptionalFrame) == [sampleOptionalFrame]
+
+
+def test_classify():
+    assert classify(pollQuery) == kind_poll
+    assert classify(sampleMainFrame) == kind_response
+    assert classify(optionalPCBTemplate) == kind_optional_query
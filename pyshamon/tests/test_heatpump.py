@@ -0,0 +1,38 @@
+import math
+import time
+
+from heatpump import Heatpump
+
+
+def running_heatpump(optional_pcb_poll_interval: int) -> Heatpump:
+    heatpump = Heatpump(None, 0, optional_pcb_poll_interval, None, None, optional_pcb_debounce=0.5)
+    heatpump.running = True
+    return heatpump
+
+
+def test_optional_change_is_debounced():
+    heatpump = running_heatpump(5)
+    before = time.monotonic()
+    assert heatpump.optional_command("SetPoolTemp", 30)
+    deadline = heatpump.optionalJob.deadline
+    assert before + 0.5 <= deadline <= time.monotonic() + 0.5
+    # a second change within the window goes out with the first one
+    assert heatpump.optional_command("SetHeatCoolMode", 1)
+    assert heatpump.optionalJob.deadline == deadline
+
+
+def test_unchanged_optional_value_is_not_sent():
+    heatpump = running_heatpump(5)
+    heatpump.optionalCommand.optional_command_query()
+    heatpump.optional_command("SetPoolTemp", 30)
+    heatpump.optionalCommand.optional_command_query()
+    heatpump.scheduler.schedule(heatpump.optionalJob, math.inf)
+    assert heatpump.optional_command("SetPoolTemp", 30)
+    assert heatpump.optionalJob.deadline == math.inf
+
+
+def test_no_optional_frames_when_disabled():
+    heatpump = running_heatpump(0)
+    assert heatpump.optional_command("SetPoolTemp", 30)
+    assert heatpump.optionalJob.deadline == math.inf
+    assert heatpump.scheduler.next_run() == math.inf
@@ -0,0 +1,58 @@
+import json
+import time
+
+import pytest
+
+import history
+from history import HistoryStore, day, hour
+
+
+def test_rollups_survive_restart(tmp_path):
+    now = time.time()
+    store = HistoryStore(str(tmp_path), chunk_samples=16)
+    for i in range(3000):
+        store.add("Outside_Temp", now - 3 * day + i * 60, float(i % 50))
+    hours = dict(store.hours["Outside_Temp"].buckets)
+    minutes = dict(store.minutes["Outside_Temp"].buckets)
+    store.close()
+
+    store = HistoryStore(str(tmp_path), chunk_samples=16)
+    assert store.samples == 3000
+    assert store.hours["Outside_Temp"].buckets == hours
+    # minute rollups are only rebuilt within their retention
+    rebuilt = store.minutes["Outside_Temp"].buckets
+    assert min(rebuilt) >= now - 2 * day - history.minute
+    assert all(minutes[start] == bucket for start, bucket in rebuilt.items())
+    store.close()
+
+
+def test_query_includes_partial_first_bucket(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    start = (time.time() // hour - 3) * hour
+    for i in range(180):
+        store.add("Outside_Temp", start + i * 60, float(i))
+    result = store.query("Outside_Temp", start + 1800, start + 3 * hour, hour)
+    assert [bucket[0] for bucket in result] == [start, start + hour, start + 2 * hour]
+    assert result[0][1:] == [0.0, 59.0, 29.5]
+    store.close()
+
+
+def test_raw_samples_from_chunks_and_buffers(tmp_path):
+    store = HistoryStore(str(tmp_path), chunk_samples=4)
+    start = time.time() - hour
+    for i in range(10):
+        store.add("DHW_Temp", start + i * 10, 40 + i)
+    # 8 samples in two chunks, 2 still buffered
+    values = store.query("DHW_Temp", start + 15, start + 75)
+    assert [value for _, value in values] == [42, 43, 44, 45, 46, 47]
+    assert values[0][0] == pytest.approx(start + 20, abs=0.001)
+    store.close()
+
+
+def test_request(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    store.add("DHW_Temp", time.time() - 60, 48)
+    answer = json.loads(store.request(b'{"topic": "DHW_Temp", "start": -3600}'))
+    assert [value for _, value in answer["values"]] == [48]
+    assert "error" in json.loads(store.request(b'{"start": -3600}'))
+    store.close()
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import logging
+import threading
+
+from logs import MQTTLogHandler, RateLimitFilter
+
+
+def record(message: str, level: int = logging.INFO, line: int = 1) -> logging.LogRecord:
+    return logging.LogRecord("pyshamon", level, "heatpump.py", line, message, None, None)
+
+
+def test_rate_limit_per_call_site():
+    now = [0.0]
+    limit = RateLimitFilter(rate=1, burst=2, clock=lambda: now[0])
+    assert [limit.filter(record("busy")) for _ in range(4)] == [True, True, False, False]
+    # another call site has its own bucket, errors always pass
+    assert limit.filter(record("other", line=2))
+    assert limit.filter(record("failed", logging.ERROR))
+    now[0] = 1
+    passed = record("busy")
+    assert limit.filter(passed)
+    assert passed.getMessage() == "busy (2 similar suppressed)"
+    assert limit.suppressed == 2
+
+
+def test_queue_is_bounded():
+    handler = MQTTLogHandler(logging.INFO, max_queued=2)
+    for i in range(5):
+        handler.emit(record(F"message {i}"))
+    assert len(handler.queue) == 2
+    assert handler.dropped == 3
+
+
+def test_mqtt_client_records_are_not_forwarded():
+    handler = MQTTLogHandler(logging.INFO)
+    paho = record("sending PUBLISH")
+    paho.mqttClient = True
+    handler.emit(paho)
+    assert len(handler.queue) == 0
+
+
+def test_forwards_records_from_other_threads():
+    handler = MQTTLogHandler(logging.INFO)
+    published = []
+
+    async def forward():
+        task = asyncio.create_task(handler.run(published.append))
+        await asyncio.sleep(0)
+        handler.emit(record("from the loop"))
+        thread = threading.Thread(target=lambda: handler.emit(record("from paho")))
+        thread.start()
+        thread.join()
+        # the thread only scheduled its record, the loop queues it
+        assert len(handler.queue) == 1
+        for _ in range(100):
+            if len(published) == 2:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(forward())
+    assert [json.loads(payload)["msg"] for payload in published] == ["from the loop", "from paho"]
+    assert handler.forwarded == 2
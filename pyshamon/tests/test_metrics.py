@@ -0,0 +1,88 @@
+import asyncio
+
+from metrics import MetricsExporter
+from simulator import sampleMainFrame
+from topics import Topics
+
+
+def exporter_with_frame() -> MetricsExporter:
+    topics = Topics()
+    exporter = MetricsExporter()
+    exporter.add(topics.topics, lambda: [])
+    exporter.update(topics.decode_and_update(sampleMainFrame))
+    return exporter
+
+
+def test_topic_samples():
+    lines = exporter_with_frame().exposition().splitlines()
+    assert F'heatpump_topic{{topic="DHW_Target_Temp",type="main"}} {sampleMainFrame[42] - 128}' in lines
+    assert any(line.startswith('heatpump_topic{topic="Heatpump_State",type="main",description="') for line in lines)
+    assert any(line.startswith('heatpump_topic_info{topic="Error",type="main",value="') for line in lines)
+
+
+def test_families_are_contiguous():
+    lines = exporter_with_frame().exposition().splitlines()
+    families = []
+    for line in lines:
+        if line.startswith("# TYPE "):
+            families.append(line.split()[2])
+        elif not line.startswith("#"):
+            assert line.split("{")[0].split()[0] == families[-1]
+    assert len(families) == len(set(families))
+
+
+def test_text_is_cached_until_a_topic_changes():
+    topics = Topics()
+    exporter = MetricsExporter()
+    exporter.add(topics.topics, lambda: [])
+    exporter.update(topics.decode_and_update(sampleMainFrame))
+    text = exporter.exposition()
+    assert exporter.text is not None and exporter.exposition() == text
+    frame = bytearray(sampleMainFrame)
+    frame[42] += 1
+    frame[-1] = (frame[-1] - 1) & 0xFF
+    exporter.update(topics.decode_and_update(bytes(frame)))
+    assert exporter.text is None
+    assert exporter.exposition() != text
+
+
+def test_serves_metrics_over_http():
+    async def scrape() -> ():
+        exporter = exporter_with_frame()
+        exporter.host, exporter.port = "127.0.0.1", 0
+        await exporter.start()
+        port = exporter.server.sockets[0].getsockname()[1]
+        answers = []
+        for request in (b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n", b"GET /other HTTP/1.1\r\n\r\n"):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            answers.append(await reader.read())
+            writer.close()
+        await exporter.stop()
+        return answers
+
+    metrics, other = asyncio.run(scrape())
+    assert metrics.startswith(b"HTTP/1.1 200 OK\r\n") and b"heatpump_topic{" in metrics
+    assert other.startswith(b"HTTP/1.1 404 Not Found\r\n")
+
+
+def test_labeled_counters_of_several_units():
+    exporter = MetricsExporter()
+    for unit in ("house", "garage"):
+        exporter.add([], lambda: [("frames_total", "counter", "frames received", 3),
+                                  ("bus_job_lateness_seconds", "gauge", "lateness", 0.5, 'job="poll"')], unit)
+    assert exporter.counter_lines() == \
+        '# HELP heatpump_frames_total frames received\n# TYPE heatpump_frames_total counter\n' \
+        'heatpump_frames_total{unit="house"} 3\nheatpump_frames_total{unit="garage"} 3\n' \
+        '# HELP heatpump_bus_job_lateness_seconds lateness\n# TYPE heatpump_bus_job_lateness_seconds gauge\n' \
+        'heatpump_bus_job_lateness_seconds{unit="house",job="poll"} 0.5\n' \
+        'heatpump_bus_job_lateness_seconds{unit="garage",job="poll"} 0.5\n'
+
+
+def test_labeled_counter_without_unit():
+    exporter = MetricsExporter()
+    exporter.add([], lambda: [("bus_job_runs_total", "counter", "runs", 2, 'job="command"'),
+                              ("frames_total", "counter", "frames received", 3)])
+    lines = exporter.counter_lines().splitlines()
+    assert 'heatpump_bus_job_runs_total{job="command"} 2' in lines
+    assert "heatpump_frames_total 3" in lines
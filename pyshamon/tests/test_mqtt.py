@@ -0,0 +1,82 @@
+from paho.mqtt.client import MQTTMessage
+
+from mqtt import MQTT
+from topics import Topics
+
+
+def make_mqtt(on_command: any = None) -> MQTT:
+    return MQTT(311, "localhost", 1883, "panasonic_heat_pump", on_command, ["outside_temp", "log"],
+                ["setdhwtemp", "bulk"])
+
+
+def message(topic: str, payload: bytes) -> MQTTMessage:
+    received = MQTTMessage(topic=topic.encode())
+    received.payload = payload
+    return received
+
+
+def test_namespaces_publish_below_topic_base():
+    mqtt = make_mqtt()
+    house = mqtt.add_namespace("house", None)
+    garage = mqtt.add_namespace("garage", None)
+    for namespace in (house, garage):
+        topics = Topics()
+        namespace.prepare(topics.topics)
+        topic = next(topic for topic in topics.topics if topic.name == "Outside_Temp")
+        topic.value, topic.since = 5, 0.0
+        assert namespace.publish(topic)
+        # disabled topics are not published
+        assert not namespace.publish(topics.topics[0])
+    house.publish_log("starting")
+    # not connected, everything waits in the outbox
+    assert [(topic, payload) for _, topic, payload, _, _ in mqtt.outbox.peek(10)] == [
+        ("panasonic_heat_pump/house/main/Outside_Temp", b"5"),
+        ("panasonic_heat_pump/garage/main/Outside_Temp", b"5"),
+        ("panasonic_heat_pump/house/log", b"starting"),
+    ]
+    assert (house.publishes, garage.publishes, mqtt.publishes) == (1, 1, 0)
+
+
+def test_commands_reach_their_unit():
+    received = []
+    mqtt = make_mqtt()
+    mqtt.add_namespace("house", lambda name, value: received.append(("house", name, value)))
+    mqtt.add_namespace("garage", lambda name, value: received.append(("garage", name, value)))
+    mqtt.on_message(None, None, message("panasonic_heat_pump/garage/commands/SetDHWTemp", b"48"))
+    mqtt.on_message(None, None, message("panasonic_heat_pump/house/commands/Bulk", b'{"SetDHWTemp": 45}'))
+    # out of range and not subscribed commands are dropped
+    mqtt.on_message(None, None, message("panasonic_heat_pump/house/commands/SetDHWTemp", b"500"))
+    mqtt.on_message(None, None, message("panasonic_heat_pump/house/commands/SetHeatpump", b"1"))
+    assert received == [("garage", "SetDHWTemp", 48), ("house", "SetDHWTemp", 45)]
+
+
+def test_subscriptions_of_all_units_on_connect():
+    mqtt = make_mqtt()
+    mqtt.add_namespace("house", lambda name, value: None)
+    # a passive unit has no command handler and subscribes nothing
+    mqtt.add_namespace("garage", None)
+    mqtt.add_request_handler("history/query", lambda payload: "")
+    subscribed = []
+    mqtt.client.subscribe = subscribed.append
+    mqtt.on_mqtt_connect(None, None, {}, 0)
+    assert sorted(subscribed[0]) == [("panasonic_heat_pump/history/query", 1),
+                                     ("panasonic_heat_pump/house/commands/Bulk", 1),
+                                     ("panasonic_heat_pump/house/commands/SetDHWTemp", 1)]
+
+
+def test_no_subscribe_without_topics():
+    mqtt = make_mqtt()
+    mqtt.add_namespace("garage", None)
+    subscribed = []
+    mqtt.client.subscribe = subscribed.append
+    mqtt.on_mqtt_connect(None, None, {}, 0)
+    assert subscribed == []
+
+
+def test_requests_are_answered_per_namespace():
+    mqtt = make_mqtt()
+    mqtt.add_namespace("house", None).add_request_handler("history/query", lambda payload: b"house " + payload)
+    published = []
+    mqtt.client.publish = lambda topic, **kwargs: published.append((topic, kwargs["payload"]))
+    mqtt.on_message(None, None, message("panasonic_heat_pump/house/history/query", b"{}"))
+    assert published == [("panasonic_heat_pump/house/history/query/response", b"house {}")]
@@ -0,0 +1,47 @@
+from outbox import Outbox
+
+
+def topics(outbox: Outbox) -> []:
+    return [(topic, payload) for _, topic, payload, _, _ in outbox.peek(100)]
+
+
+def test_retained_topics_keep_their_latest_value():
+    outbox = Outbox()
+    outbox.put("heatpump/main/Outside_Temp", 5, True)
+    outbox.put("heatpump/log", "starting", False)
+    outbox.put("heatpump/main/Outside_Temp", 6, True)
+    assert topics(outbox) == [("heatpump/log", b"starting"), ("heatpump/main/Outside_Temp", b"6")]
+    assert (len(outbox), outbox.coalesced) == (2, 1)
+
+
+def test_full_outbox_drops_oldest_unretained_first():
+    outbox = Outbox(max_messages=3)
+    outbox.put("heatpump/main/Outside_Temp", 5, True)
+    for i in range(4):
+        outbox.put("heatpump/log", F"line {i}", False)
+    assert topics(outbox) == [("heatpump/main/Outside_Temp", b"5"), ("heatpump/log", b"line 2"),
+                              ("heatpump/log", b"line 3")]
+    assert outbox.dropped == 2
+
+
+def test_remove_sent_messages():
+    outbox = Outbox()
+    for i in range(3):
+        outbox.put("heatpump/log", F"line {i}", False)
+    messages = outbox.peek(2)
+    outbox.remove(messages[-1][0])
+    assert topics(outbox) == [("heatpump/log", b"line 2")]
+    assert outbox.sent == 2
+
+
+def test_survives_restart(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+    outbox = Outbox(path)
+    outbox.put("heatpump/main/Outside_Temp", 5, True)
+    outbox.put("heatpump/log", "line", False)
+    outbox.close()
+
+    outbox = Outbox(path)
+    assert len(outbox) == 2
+    assert topics(outbox) == [("heatpump/main/Outside_Temp", b"5"), ("heatpump/log", b"line")]
+    outbox.close()
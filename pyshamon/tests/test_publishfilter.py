@@ -0,0 +1,68 @@
+import pytest
+
+from publishfilter import FilterRule, PublishFilter
+from topics import Topics
+
+
+def make_filter(rule: str) -> ():
+    topics = Topics()
+    topic = next(topic for topic in topics.topics if topic.name == "Outside_Temp")
+    return PublishFilter(topics.topics, {"outside_temp": FilterRule.parse(rule)}), topic
+
+
+def accept(publish_filter: PublishFilter, topic, value: any, now: float) -> bool:
+    topic.value = value
+    return publish_filter.accept(topic, now)
+
+
+def test_parse():
+    rule = FilterRule.parse("deadband=2% interval=60 heartbeat=900")
+    assert (rule.absolute, rule.relative, rule.interval, rule.heartbeat) == (0, 0.02, 60, 900)
+    with pytest.raises(ValueError):
+        FilterRule.parse("deadbnd=1")
+
+
+def test_absolute_deadband():
+    publish_filter, topic = make_filter("deadband=0.5")
+    assert [accept(publish_filter, topic, value, i) for i, value in enumerate((10, 10.25, 10.5, 10.75, 9.5))] == \
+        [True, False, True, False, True]
+    assert publish_filter.suppressed == 2
+
+
+def test_relative_deadband():
+    publish_filter, topic = make_filter("deadband=10%")
+    assert [accept(publish_filter, topic, value, i) for i, value in enumerate((20, 21, 22, -20))] == \
+        [True, False, True, True]
+
+
+def test_interval_publishes_the_latest_value_when_due():
+    publish_filter, topic = make_filter("interval=60")
+    assert accept(publish_filter, topic, 5, 0)
+    assert not accept(publish_filter, topic, 6, 10)
+    assert not accept(publish_filter, topic, 7, 20)
+    assert publish_filter.due(59) == []
+    assert publish_filter.due(60) == [topic]
+    assert publish_filter.states[topic].value == 7
+    assert publish_filter.due(61) == []
+
+
+def test_change_back_within_deadband_is_not_due():
+    publish_filter, topic = make_filter("deadband=1 interval=60")
+    assert accept(publish_filter, topic, 5, 0)
+    assert not accept(publish_filter, topic, 8, 10)
+    topic.value = 5.5
+    assert publish_filter.due(60) == []
+
+
+def test_heartbeat():
+    publish_filter, topic = make_filter("deadband=1 heartbeat=900")
+    assert accept(publish_filter, topic, 5, 0)
+    assert not accept(publish_filter, topic, 5, 100)
+    assert publish_filter.due(899) == []
+    assert publish_filter.due(900) == [topic]
+
+
+def test_unfiltered_topics_pass():
+    publish_filter, _ = make_filter("deadband=1")
+    other = Topics().topics[0]
+    assert all(publish_filter.accept(other, i) for i in range(3))
@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+from rawframe import RawEncoder, apply_delta, changed_ranges, encode_delta
+from simulator import sampleMainFrame
+
+
+def changed(frame: bytes, offsets: ()) -> bytes:
+    frame = bytearray(frame)
+    for offset in offsets:
+        frame[offset] ^= 0xFF
+    return bytes(frame)
+
+
+def test_close_ranges_are_merged():
+    new = changed(sampleMainFrame, (10, 12, 13, 20))
+    assert changed_ranges(sampleMainFrame, new) == [[10, 4], [20, 1]]
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_delta_round_trip(binary: bool):
+    rng = random.Random(1)
+    for _ in range(100):
+        new = changed(sampleMainFrame, rng.sample(range(len(sampleMainFrame)), rng.randrange(1, 20)))
+        delta = encode_delta(new, changed_ranges(sampleMainFrame, new), binary)
+        assert apply_delta(sampleMainFrame, delta, binary) == new
+
+
+def test_hex_delta_format():
+    new = changed(sampleMainFrame, (5,))
+    assert encode_delta(new, changed_ranges(sampleMainFrame, new), False) == b"5:%02x" % new[5]
+
+
+def test_keyframes_and_deltas():
+    now = [0.0]
+    encoder = RawEncoder("hex", keyframe_interval=300, clock=lambda: now[0])
+    keyframe, delta = encoder.encode("main", sampleMainFrame)
+    assert keyframe == sampleMainFrame.hex(" ").encode() and delta is None
+
+    # deltas are against the keyframe, so a subscriber only needs the two retained messages
+    first = changed(sampleMainFrame, (100,))
+    second = changed(first, (150,))
+    assert encoder.encode("main", first)[0] is None
+    keyframe, delta = encoder.encode("main", second)
+    assert keyframe is None
+    assert apply_delta(sampleMainFrame, delta, False) == second
+
+    now[0] = 300
+    assert encoder.encode("main", second)[0] is not None
+    assert (encoder.keyframesSent, encoder.deltasSent) == (2, 2)
+
+
+def test_large_change_sends_a_keyframe():
+    encoder = RawEncoder("binary", clock=lambda: 0)
+    encoder.encode("main", sampleMainFrame)
+    keyframe, delta = encoder.encode("main", changed(sampleMainFrame, range(0, 203, 3)))
+    assert keyframe is not None and delta is None
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        RawEncoder("base64")
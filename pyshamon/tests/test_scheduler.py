@@ -0,0 +1,71 @@
+import math
+
+from scheduler import BusJob, BusScheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_scheduler(spacing: float = 0.1) -> ():
+    clock = Clock()
+    return BusScheduler(spacing, clock), clock
+
+
+def test_priority_among_due_jobs():
+    scheduler, clock = make_scheduler()
+    ran = []
+    poll = scheduler.add(BusJob("poll", 2, lambda: ran.append("poll"), interval=1), 0)
+    scheduler.add(BusJob("command", 0, lambda: ran.append("command")), 0.5)
+    clock.now = 1
+    assert scheduler.run_due().name == "command"
+    clock.now = 1.1
+    assert scheduler.run_due() is poll
+    assert ran == ["command", "poll"]
+
+
+def test_overdue_job_wins():
+    scheduler, clock = make_scheduler()
+    scheduler.add(BusJob("command", 0, lambda: None), 9)
+    scheduler.add(BusJob("optional", 5, lambda: None, max_lateness=2), 0)
+    clock.now = 10
+    job = scheduler.run_due()
+    assert job.name == "optional"
+    assert job.overdueRuns == 1
+    assert job.lateness == 10
+
+
+def test_spacing_and_hold_off():
+    scheduler, clock = make_scheduler(0.5)
+    scheduler.add(BusJob("poll", 1, lambda: None, interval=0.1), 0)
+    assert scheduler.run_due() is not None
+    assert scheduler.next_run() == 0.5
+    scheduler.hold_off(2)
+    assert scheduler.next_run() == 2
+
+
+def test_periodic_job_does_not_catch_up():
+    scheduler, clock = make_scheduler()
+    job = scheduler.add(BusJob("poll", 1, lambda: None, interval=1), 0)
+    clock.now = 5
+    scheduler.run_due()
+    assert job.deadline == 6
+    assert scheduler.run_due() is None
+    assert job.runs == 1
+
+
+def test_reschedule_skips_stale_entries():
+    scheduler, clock = make_scheduler()
+    job = scheduler.add(BusJob("command", 0, lambda: None), 10)
+    scheduler.schedule_earlier(job, 3)
+    scheduler.schedule_earlier(job, 5)
+    assert scheduler.next_run() == 3
+    clock.now = 3
+    assert scheduler.run_due() is job
+    assert job.deadline == math.inf
+    clock.now = 10
+    assert scheduler.run_due() is None
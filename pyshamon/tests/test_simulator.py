@@ -0,0 +1,69 @@
+import os
+import select
+
+import pytest
+
+from command import Command, optionalPCBTemplate, pollQuery
+from frame import FrameReader
+from simulator import Simulator, sampleMainFrame
+from topics import valid_checksum
+
+
+@pytest.fixture
+def simulator() -> Simulator:
+    simulator = Simulator(delay=0, noise=0, seed=1)
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+def exchange(simulator: Simulator, query: bytes) -> bytes:
+    # writes the query to the pty like pyshamon and reads back the answer
+    port = os.open(simulator.port, os.O_RDWR | os.O_NOCTTY)
+    try:
+        os.write(port, query)
+        reader = FrameReader()
+        while True:
+            readable, _, _ = select.select([port], [], [], 2)
+            assert readable, "no answer from the simulator"
+            frames = reader.feed(os.read(port, 1024))
+            if frames:
+                return frames[0]
+    finally:
+        os.close(port)
+
+
+def test_answers_polls(simulator: Simulator):
+    answer = exchange(simulator, pollQuery)
+    assert answer == sampleMainFrame
+    assert simulator.queries == 1
+
+
+def test_answers_optional_pcb_frames(simulator: Simulator):
+    answer = exchange(simulator, optionalPCBTemplate)
+    assert len(answer) == 20 and valid_checksum(answer)
+    assert simulator.lastOptionalQuery == optionalPCBTemplate
+
+
+def test_applies_commands(simulator: Simulator):
+    command = Command()
+    command.set("SetDHWTemp", 48)
+    answer = exchange(simulator, command.command_query())
+    assert answer[42] == 48 + 128
+    assert simulator.commands == 1
+
+
+def test_ignores_invalid_queries(simulator: Simulator):
+    broken = bytearray(pollQuery)
+    broken[-1] ^= 0xFF
+    simulator.on_query(bytes(broken))
+    assert simulator.invalid == 1
+
+
+def test_corrupts_answers():
+    simulator = Simulator(noise=0, corrupt=1, delay=0, seed=1)
+    try:
+        simulator.on_query(pollQuery)
+        assert simulator.corrupted == 1
+    finally:
+        simulator.stop()
@@ -0,0 +1,32 @@
+import asyncio
+
+from frame import FrameReader
+from scheduler import BusJob, BusScheduler
+from stats import Profiler, Stats
+
+
+def test_profiler_timer_of_a_stopped_session_is_cancelled(tmp_path):
+    async def sessions():
+        profiler = Profiler(str(tmp_path))
+        profiler.start(0.2)
+        profiler.stop()
+        second = profiler.start(0.5)
+        # the first session's timer would have stopped the second one here
+        await asyncio.sleep(0.3)
+        assert profiler.profile is not None and profiler.path == second
+        profiler.stop()
+        assert profiler.timer is None
+
+    asyncio.run(sessions())
+
+
+def test_report_includes_bus_job_lateness():
+    now = [0.0]
+    scheduler = BusScheduler(0.1, lambda: now[0])
+    scheduler.add(BusJob("poll", 2, lambda: None, interval=1), 0)
+    scheduler.add(BusJob("command", 0, lambda: None))
+    now[0] = 0.25
+    scheduler.run_due()
+    report = Stats(FrameReader(), jobs=scheduler.jobs).report()
+    assert report["jobs"]["poll"] == {"runs": 1, "last": 0.25, "max": 0.25, "average": 0.25, "overdue": 0}
+    assert report["jobs"]["command"]["runs"] == 0
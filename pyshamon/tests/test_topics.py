@@ -0,0 +1,44 @@
+import random
+
+from simulator import sampleMainFrame
+from topics import Topics, checksum
+
+
+def values(topics: Topics) -> {}:
+    return {topic.name: topic.value for topic in topics.topics}
+
+
+def test_only_topics_of_changed_bytes_are_reported():
+    topics = Topics()
+    assert len(topics.decode_and_update(sampleMainFrame)) > 0
+    assert topics.decode_and_update(sampleMainFrame) == []
+
+    frame = bytearray(sampleMainFrame)
+    # byte 118 holds the fractions of the inlet and outlet temperature
+    frame[118] ^= 0b001001
+    frame[-1] = checksum(frame[:-1])
+    changed = [topic.name for topic in topics.decode_and_update(bytes(frame))]
+    assert sorted(changed) == ["Main_Inlet_Temp", "Main_Outlet_Temp"]
+
+
+def test_incremental_decoding_matches_full_decoding():
+    rng = random.Random(1)
+    incremental = Topics()
+    frame = bytearray(sampleMainFrame)
+    for _ in range(200):
+        for _ in range(rng.randrange(1, 5)):
+            frame[rng.randrange(4, 202)] = rng.randrange(256)
+        frame[-1] = checksum(frame[:-1])
+        incremental.decode_and_update(bytes(frame))
+        full = Topics()
+        full.decode_and_update(bytes(frame))
+        assert values(incremental) == values(full)
+
+
+def test_invalid_frames_are_ignored():
+    topics = Topics()
+    broken = bytearray(sampleMainFrame)
+    broken[10] ^= 1
+    assert topics.decode_and_update(bytes(broken)) is None
+    assert topics.decode_and_update(sampleMainFrame[:100]) is None
+    assert all(topic.value is None for topic in topics.topics)
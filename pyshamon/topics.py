@@ -2,212 +2,315 @@ import logging
 
 import decode
 import descriptions
-from datetime import datetime
+import time
 
 
 def checksum(data: []) -> int:
-    chk = 0
-    for b in data:
-        chk += b
-    chk = (chk ^ 0xFF) + 0x01
-    return chk & 0xFF
+    return -sum(data) & 0xFF
 
 
 def valid_checksum(data: []) -> bool:
-    return checksum(data[:-1]) == data[-1]
+    # all bytes including the checksum add up to zero
+    return sum(data) & 0xFF == 0
+
+
+# name, description, codec (see decode.byteCodecs and decode.frameCodecs), byte offset(s), frame type
+topicTable = [
+    ("Heatpump_State", descriptions.OffOn, "bits_7_and_8", 4),
+    ("Pump_Flow", descriptions.LitersPerMin, "pump_flow", (169, 170)),
+    ("Force_DHW_State", descriptions.DisabledEnabled, "bits_1_and_2", 4),
+    ("Quiet_Mode_Schedule", descriptions.DisabledEnabled, "bits_1_and_2", 7),
+    ("Operating_Mode_State", descriptions.OpModeDesc, "op_mode", 6),
+    ("Main_Inlet_Temp", descriptions.Celsius, "inlet_temp", (143, 118)),
+    ("Main_Outlet_Temp", descriptions.Celsius, "outlet_temp", (144, 118)),
+    ("Main_Target_Temp", descriptions.Celsius, "int_minus_128", 153),
+    ("Compressor_Freq", descriptions.Hertz, "int_minus_1", 166),
+    ("DHW_Target_Temp", descriptions.Celsius, "int_minus_128", 42),
+    ("DHW_Temp", descriptions.Celsius, "int_minus_128", 141),
+    ("Operations_Hours", descriptions.Hours, "word_minus_1", (183, 182)),
+    ("Operations_Counter", descriptions.Counter, "word_minus_1", (180, 179)),
+    ("Main_Schedule_State", descriptions.DisabledEnabled, "bits_1_and_2", 5),
+    ("Outside_Temp", descriptions.Celsius, "int_minus_128", 142),
+    ("Heat_Energy_Production", descriptions.Watt, "energy", 194),
+    ("Heat_Energy_Consumption", descriptions.Watt, "energy", 193),
+    ("Powerful_Mode_Time", descriptions.Powerfulmode, "right_3_bits", 7),
+    ("Quiet_Mode_Level", descriptions.Quietmode, "bits_3_to_5", 7),
+    ("Holiday_Mode_State", descriptions.HolidayState, "bits_3_and_4", 5),
+    ("ThreeWay_Valve_State", descriptions.Valve, "bits_7_and_8", 111),
+    ("Outside_Pipe_Temp", descriptions.Celsius, "int_minus_128", 158),
+    ("DHW_Heat_Delta", descriptions.Kelvin, "int_minus_128", 99),
+    ("Heat_Delta", descriptions.Kelvin, "int_minus_128", 84),
+    ("Cool_Delta", descriptions.Kelvin, "int_minus_128", 94),
+    ("DHW_Holiday_Shift_Temp", descriptions.Kelvin, "int_minus_128", 44),
+    ("Defrosting_State", descriptions.DisabledEnabled, "bits_5_and_6", 111),
+    ("Z1_Heat_Request_Temp", descriptions.Celsius, "int_minus_128", 38),
+    ("Z1_Cool_Request_Temp", descriptions.Celsius, "int_minus_128", 39),
+    ("Z1_Heat_Curve_Target_High_Temp", descriptions.Celsius, "int_minus_128", 75),
+    ("Z1_Heat_Curve_Target_Low_Temp", descriptions.Celsius, "int_minus_128", 76),
+    ("Z1_Heat_Curve_Outside_High_Temp", descriptions.Celsius, "int_minus_128", 78),
+    ("Z1_Heat_Curve_Outside_Low_Temp", descriptions.Celsius, "int_minus_128", 77),
+    ("Room_Thermostat_Temp", descriptions.Celsius, "int_minus_128", 156),
+    ("Z2_Heat_Request_Temp", descriptions.Celsius, "int_minus_128", 40),
+    ("Z2_Cool_Request_Temp", descriptions.Celsius, "int_minus_128", 41),
+    ("Z1_Water_Temp", descriptions.Celsius, "int_minus_128", 145),
+    ("Z2_Water_Temp", descriptions.Celsius, "int_minus_128", 146),
+    ("Cool_Energy_Production", descriptions.Watt, "energy", 196),
+    ("Cool_Energy_Consumption", descriptions.Watt, "energy", 195),
+    ("DHW_Energy_Production", descriptions.Watt, "energy", 198),
+    ("DHW_Energy_Consumption", descriptions.Watt, "energy", 197),
+    ("Z1_Water_Target_Temp", descriptions.Celsius, "int_minus_128", 147),
+    ("Z2_Water_Target_Temp", descriptions.Celsius, "int_minus_128", 148),
+    ("Error", descriptions.ErrorState, "error_info", (113, 114)),
+    ("Room_Holiday_Shift_Temp", descriptions.Kelvin, "int_minus_128", 43),
+    ("Buffer_Temp", descriptions.Celsius, "int_minus_128", 149),
+    ("Solar_Temp", descriptions.Celsius, "int_minus_128", 150),
+    ("Pool_Temp", descriptions.Celsius, "int_minus_128", 151),
+    ("Main_Hex_Outlet_Temp", descriptions.Celsius, "int_minus_128", 154),
+    ("Discharge_Temp", descriptions.Celsius, "int_minus_128", 155),
+    ("Inside_Pipe_Temp", descriptions.Celsius, "int_minus_128", 157),
+    ("Defrost_Temp", descriptions.Celsius, "int_minus_128", 159),
+    ("Eva_Outlet_Temp", descriptions.Celsius, "int_minus_128", 160),
+    ("Bypass_Outlet_Temp", descriptions.Celsius, "int_minus_128", 161),
+    ("Ipm_Temp", descriptions.Celsius, "int_minus_128", 162),
+    ("Z1_Temp", descriptions.Celsius, "int_minus_128", 139),
+    ("Z2_Temp", descriptions.Celsius, "int_minus_128", 140),
+    ("DHW_Heater_State", descriptions.BlockedFree, "bits_5_and_6", 9),
+    ("Room_Heater_State", descriptions.BlockedFree, "bits_7_and_8", 9),
+    ("Internal_Heater_State", descriptions.InactiveActive, "bits_7_and_8", 112),
+    ("External_Heater_State", descriptions.InactiveActive, "bits_5_and_6", 112),
+    ("Fan1_Motor_Speed", descriptions.RotationsPerMin, "int_minus_1_times_10", 173),
+    ("Fan2_Motor_Speed", descriptions.RotationsPerMin, "int_minus_1_times_10", 174),
+    ("High_Pressure", descriptions.Pressure, "int_minus_1_div_5", 163),
+    ("Pump_Speed", descriptions.RotationsPerMin, "int_minus_1_times_50", 171),
+    ("Low_Pressure", descriptions.Pressure, "int_minus_1", 164),
+    ("Compressor_Current", descriptions.Ampere, "int_minus_1_div_5", 165),
+    ("Force_Heater_State", descriptions.InactiveActive, "bits_5_and_6", 5),
+    ("Sterilization_State", descriptions.InactiveActive, "bits_5_and_6", 117),
+    ("Sterilization_Temp", descriptions.Celsius, "int_minus_128", 100),
+    ("Sterilization_Max_Time", descriptions.Minutes, "int_minus_1", 101),
+    ("Z1_Cool_Curve_Target_High_Temp", descriptions.Celsius, "int_minus_128", 86),
+    ("Z1_Cool_Curve_Target_Low_Temp", descriptions.Celsius, "int_minus_128", 87),
+    ("Z1_Cool_Curve_Outside_High_Temp", descriptions.Celsius, "int_minus_128", 89),
+    ("Z1_Cool_Curve_Outside_Low_Temp", descriptions.Celsius, "int_minus_128", 88),
+    ("Heating_Mode", descriptions.HeatCoolModeDesc, "bits_7_and_8", 28),
+    ("Heating_Off_Outdoor_Temp", descriptions.Celsius, "int_minus_128", 83),
+    ("Heater_On_Outdoor_Temp", descriptions.Celsius, "int_minus_128", 85),
+    ("Heat_To_Cool_Temp", descriptions.Celsius, "int_minus_128", 95),
+    ("Cool_To_Heat_Temp", descriptions.Celsius, "int_minus_128", 96),
+    ("Cooling_Mode", descriptions.HeatCoolModeDesc, "bits_5_and_6", 28),
+    ("Z2_Heat_Curve_Target_High_Temp", descriptions.Celsius, "int_minus_128", 79),
+    ("Z2_Heat_Curve_Target_Low_Temp", descriptions.Celsius, "int_minus_128", 80),
+    ("Z2_Heat_Curve_Outside_High_Temp", descriptions.Celsius, "int_minus_128", 82),
+    ("Z2_Heat_Curve_Outside_Low_Temp", descriptions.Celsius, "int_minus_128", 81),
+    ("Z2_Cool_Curve_Target_High_Temp", descriptions.Celsius, "int_minus_128", 90),
+    ("Z2_Cool_Curve_Target_Low_Temp", descriptions.Celsius, "int_minus_128", 91),
+    ("Z2_Cool_Curve_Outside_High_Temp", descriptions.Celsius, "int_minus_128", 93),
+    ("Z2_Cool_Curve_Outside_Low_Temp", descriptions.Celsius, "int_minus_128", 92),
+    ("Room_Heater_Operations_Hours", descriptions.Hours, "word_minus_1", (186, 185)),
+    ("DHW_Heater_Operations_Hours", descriptions.Hours, "word_minus_1", (189, 188)),
+    ("Heat_Pump_Model", descriptions.Model, "model", tuple(range(129, 139))),
+    ("Pump_Duty", descriptions.Duty, "int_minus_1", 172),
+    ("Zones_State", descriptions.ZonesState, "bits_1_and_2", 6),
+    ("Max_Pump_Duty", descriptions.Duty, "int_minus_1", 45),
+    ("Heater_Delay_Time", descriptions.Minutes, "int_minus_1", 104),
+    ("Heater_Start_Delta", descriptions.Kelvin, "int_minus_128", 105),
+    ("Heater_Stop_Delta", descriptions.Kelvin, "int_minus_128", 106),
+    ("Buffer_Installed", descriptions.DisabledEnabled, "bits_5_and_6", 24),
+    ("DHW_Installed", descriptions.DisabledEnabled, "bits_7_and_8", 24),
+    ("Solar_Mode", descriptions.SolarModeDesc, "bits_3_and_4", 24),
+    ("Solar_On_Delta", descriptions.Kelvin, "int_minus_128", 61),
+    ("Solar_Off_Delta", descriptions.Kelvin, "int_minus_128", 62),
+    ("Solar_Frost_Protection", descriptions.Celsius, "int_minus_128", 63),
+    ("Solar_High_Limit", descriptions.Celsius, "int_minus_128", 64),
+    ("Pump_Flowrate_Mode", descriptions.PumpFlowRateMode, "bits_3_and_4", 29),
+    ("Liquid_Type", descriptions.LiquidType, "bit_1", 20),
+    ("Alt_External_Sensor", descriptions.DisabledEnabled, "bits_3_and_4", 20),
+    ("Anti_Freeze_Mode", descriptions.DisabledEnabled, "bits_5_and_6", 20),
+    ("Optional_PCB", descriptions.DisabledEnabled, "bits_7_and_8", 20),
+    ("Z1_Sensor_Settings", descriptions.ZonesSensorType, "second_byte", 22),
+    ("Z2_Sensor_Settings", descriptions.ZonesSensorType, "first_byte", 22),
+    ("Buffer_Tank_Delta", descriptions.Kelvin, "int_minus_128", 59),
+    ("External_Pad_Heater", descriptions.ExtPadHeaterType, "bits_3_and_4", 25),
+
+    ("Z1_Water_Pump", descriptions.OffOn, "raw_bit_1", 4, "optional"),
+    ("Z1_Mixing_Valve", descriptions.MixingValve, "raw_bits_2_and_3", 4, "optional"),
+    ("Z2_Water_Pump", descriptions.OffOn, "raw_bit_4", 4, "optional"),
+    ("Z2_Mixing_Valve", descriptions.MixingValve, "raw_bits_5_and_6", 4, "optional"),
+    ("Pool_Water_Pump", descriptions.OffOn, "raw_bit_7", 4, "optional"),
+    ("Solar_Water_Pump", descriptions.OffOn, "raw_bit_8", 4, "optional"),
+    ("Alarm_State", descriptions.OffOn, "raw_bit_8", 5, "optional"),
+]
+
+
+def changed_offsets(old: bytes, new: bytes) -> []:
+    # xor both frames as one big integer and walk the non-zero bytes only
+    diff = int.from_bytes(old, "little") ^ int.from_bytes(new, "little")
+    offsets = []
+    while diff:
+        offset = ((diff & -diff).bit_length() - 1) >> 3
+        offsets.append(offset)
+        diff &= ~(0xFF << (offset << 3))
+    return offsets
+
+
+# (codec, description) -> precomputed values and descriptions, shared by all topics and heat pumps decoding alike
+byteTables = {}
 
 
 class Topic:
-    def __init__(self, name: str, textual_description: any, fnc: any, topic_type: str = "main"):
+    __slots__ = ("name", "textual_description", "codec", "offsets", "description", "value", "since", "type",
+                 "delegated", "enabled", "fnc", "values", "descriptions")
+
+    def __init__(self, name: str, textual_description: any, codec: str, offsets: any, topic_type: str = "main"):
         self.name = name
         self.textual_description = textual_description
-        self.fnc = fnc
+        self.codec = codec
+        self.offsets = offsets if isinstance(offsets, tuple) else (offsets,)
         self.description = None
         self.value = None
-        self.since = None
+        # time.monotonic() of the last change, see timestamp() for wall clock time
+        self.since: float = None
         self.type = topic_type
         self.delegated: bool = True
+        self.enabled: bool = True
+
+        # single byte codecs are precomputed for every possible byte value, including the description
+        if codec in decode.byteCodecs:
+            self.fnc = decode.byteCodecs[codec]
+            key = (codec, tuple(textual_description or ()))
+            table = byteTables.get(key)
+            if table is None:
+                values = tuple(self.fnc(b) for b in range(256))
+                table = byteTables[key] = (values, tuple(self.describe(value) for value in values))
+            self.values, self.descriptions = table
+        else:
+            self.fnc = decode.frameCodecs[codec]
+            self.values = None
+            self.descriptions = None
         pass
 
     def __str__(self):
         return f'{self.name} = {self.value} {self.description}'
 
-    def update_description(self):
+    def describe(self, value: any) -> any:
         if self.textual_description is None or len(self.textual_description) == 0:
-            self.description = None
+            return None
         elif len(self.textual_description) == 1:
-            self.description = self.textual_description[0]
-        elif self.value is None:
-            self.description = None
-        elif int(self.value) >= len(self.textual_description):
-            self.description = "unknown"
+            return self.textual_description[0]
+        elif value is None:
+            return None
+        elif int(value) >= len(self.textual_description):
+            return "unknown"
         else:
-            self.description = self.textual_description[int(self.value)]
-        self.delegated = False
+            return self.textual_description[int(value)]
+
+    def decode(self, packet_data: bytes) -> any:
+        if self.values is not None:
+            return self.values[packet_data[self.offsets[0]]]
+        return self.fnc(*[packet_data[offset] for offset in self.offsets])
 
-    def update(self, packet_data: bytearray):
-        new_value = self.fnc(packet_data)
+    def update(self, packet_data: bytes):
+        new_value = self.decode(packet_data)
         if new_value != self.value:
             self.value = new_value
-            self.since = datetime.now()
-            self.update_description()
+            self.since = time.monotonic()
+            self.description = self.describe(new_value)
+            self.delegated = False
         pass
 
-    def changed_since(self, since: datetime):
+    def changed_since(self, since: float):
         return self.since is not None and (since is None or since < self.since)
 
+    def timestamp(self) -> float:
+        return time.time() - (time.monotonic() - self.since)
+
 
 class Topics:
     def __init__(self):
-        self.topics = [
-            Topic("Heatpump_State", descriptions.OffOn, lambda d: decode.bits_7_and_8(d[4])),
-            Topic("Pump_Flow", descriptions.LitersPerMin, lambda d: decode.get_pump_flow(d)),
-            Topic("Force_DHW_State", descriptions.DisabledEnabled, lambda d: decode.bits_1_and_2(d[4])),
-            Topic("Quiet_Mode_Schedule", descriptions.DisabledEnabled, lambda d: decode.bits_1_and_2(d[7])),
-            Topic("Operating_Mode_State", descriptions.OpModeDesc, lambda d: decode.get_op_mode(d[6])),
-            Topic("Main_Inlet_Temp", descriptions.Celsius, lambda d: decode.get_inlet_temp(d)),
-            Topic("Main_Outlet_Temp", descriptions.Celsius, lambda d: decode.get_outlet_temp(d)),
-            Topic("Main_Target_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[153])),
-            Topic("Compressor_Freq", descriptions.Hertz, lambda d: decode.int_minus_1(d[166])),
-            Topic("DHW_Target_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[42])),
-            Topic("DHW_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[141])),
-            Topic("Operations_Hours", descriptions.Hours, lambda d: decode.word(d[183], d[182]) - 1),
-            Topic("Operations_Counter", descriptions.Counter, lambda d: decode.word(d[180], d[179]) - 1),
-            Topic("Main_Schedule_State", descriptions.DisabledEnabled, lambda d: decode.bits_1_and_2(d[5])),
-            Topic("Outside_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[142])),
-            Topic("Heat_Energy_Production", descriptions.Watt, lambda d: decode.get_energy(d[194])),
-            Topic("Heat_Energy_Consumption", descriptions.Watt, lambda d: decode.get_energy(d[193])),
-            Topic("Powerful_Mode_Time", descriptions.Powerfulmode, lambda d: decode.right_3_bits(d[7])),
-            Topic("Quiet_Mode_Level", descriptions.Quietmode, lambda d: decode.bits_3_to_5(d[7])),
-            Topic("Holiday_Mode_State", descriptions.HolidayState, lambda d: decode.bits_3_and_4(d[5])),
-            Topic("ThreeWay_Valve_State", descriptions.Valve, lambda d: decode.bits_7_and_8(d[111])),
-            Topic("Outside_Pipe_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[158])),
-            Topic("DHW_Heat_Delta", descriptions.Kelvin, lambda d: decode.int_minus_128(d[99])),
-            Topic("Heat_Delta", descriptions.Kelvin, lambda d: decode.int_minus_128(d[84])),
-            Topic("Cool_Delta", descriptions.Kelvin, lambda d: decode.int_minus_128(d[94])),
-            Topic("DHW_Holiday_Shift_Temp", descriptions.Kelvin, lambda d: decode.int_minus_128(d[44])),
-            Topic("Defrosting_State", descriptions.DisabledEnabled, lambda d: decode.bits_5_and_6(d[111])),
-            Topic("Z1_Heat_Request_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[38])),
-            Topic("Z1_Cool_Request_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[39])),
-            Topic("Z1_Heat_Curve_Target_High_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[75])),
-            Topic("Z1_Heat_Curve_Target_Low_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[76])),
-            Topic("Z1_Heat_Curve_Outside_High_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[78])),
-            Topic("Z1_Heat_Curve_Outside_Low_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[77])),
-            Topic("Room_Thermostat_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[156])),
-            Topic("Z2_Heat_Request_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[40])),
-            Topic("Z2_Cool_Request_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[41])),
-            Topic("Z1_Water_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[145])),
-            Topic("Z2_Water_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[146])),
-            Topic("Cool_Energy_Production", descriptions.Watt, lambda d: decode.get_energy(d[196])),
-            Topic("Cool_Energy_Consumption", descriptions.Watt, lambda d: decode.get_energy(d[195])),
-            Topic("DHW_Energy_Production", descriptions.Watt, lambda d: decode.get_energy(d[198])),
-            Topic("DHW_Energy_Consumption", descriptions.Watt, lambda d: decode.get_energy(d[197])),
-            Topic("Z1_Water_Target_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[147])),
-            Topic("Z2_Water_Target_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[148])),
-            Topic("Error", descriptions.ErrorState, lambda d: decode.get_error_info(d)),
-            Topic("Room_Holiday_Shift_Temp", descriptions.Kelvin, lambda d: decode.int_minus_128(d[43])),
-            Topic("Buffer_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[149])),
-            Topic("Solar_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[150])),
-            Topic("Pool_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[151])),
-            Topic("Main_Hex_Outlet_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[154])),
-            Topic("Discharge_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[155])),
-            Topic("Inside_Pipe_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[157])),
-            Topic("Defrost_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[159])),
-            Topic("Eva_Outlet_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[160])),
-            Topic("Bypass_Outlet_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[161])),
-            Topic("Ipm_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[162])),
-            Topic("Z1_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[139])),
-            Topic("Z2_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[140])),
-            Topic("DHW_Heater_State", descriptions.BlockedFree, lambda d: decode.bits_5_and_6(d[9])),
-            Topic("Room_Heater_State", descriptions.BlockedFree, lambda d: decode.bits_7_and_8(d[9])),
-            Topic("Internal_Heater_State", descriptions.InactiveActive, lambda d: decode.bits_7_and_8(d[112])),
-            Topic("External_Heater_State", descriptions.InactiveActive, lambda d: decode.bits_5_and_6(d[112])),
-            Topic("Fan1_Motor_Speed", descriptions.RotationsPerMin, lambda d: decode.int_minus_1_times_10(d[173])),
-            Topic("Fan2_Motor_Speed", descriptions.RotationsPerMin, lambda d: decode.int_minus_1_times_10(d[174])),
-            Topic("High_Pressure", descriptions.Pressure, lambda d: decode.int_minus_1_div_5(d[163])),
-            Topic("Pump_Speed", descriptions.RotationsPerMin, lambda d: decode.int_minus_1_times_50(d[171])),
-            Topic("Low_Pressure", descriptions.Pressure, lambda d: decode.int_minus_1(d[164])),
-            Topic("Compressor_Current", descriptions.Ampere, lambda d: decode.int_minus_1_div_5(d[165])),
-            Topic("Force_Heater_State", descriptions.InactiveActive, lambda d: decode.bits_5_and_6(d[5])),
-            Topic("Sterilization_State", descriptions.InactiveActive, lambda d: decode.bits_5_and_6(d[117])),
-            Topic("Sterilization_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[100])),
-            Topic("Sterilization_Max_Time", descriptions.Minutes, lambda d: decode.int_minus_1(d[101])),
-            Topic("Z1_Cool_Curve_Target_High_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[86])),
-            Topic("Z1_Cool_Curve_Target_Low_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[87])),
-            Topic("Z1_Cool_Curve_Outside_High_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[89])),
-            Topic("Z1_Cool_Curve_Outside_Low_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[88])),
-            Topic("Heating_Mode", descriptions.HeatCoolModeDesc, lambda d: decode.bits_7_and_8(d[28])),
-            Topic("Heating_Off_Outdoor_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[83])),
-            Topic("Heater_On_Outdoor_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[85])),
-            Topic("Heat_To_Cool_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[95])),
-            Topic("Cool_To_Heat_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[96])),
-            Topic("Cooling_Mode", descriptions.HeatCoolModeDesc, lambda d: decode.bits_5_and_6(d[28])),
-            Topic("Z2_Heat_Curve_Target_High_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[79])),
-            Topic("Z2_Heat_Curve_Target_Low_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[80])),
-            Topic("Z2_Heat_Curve_Outside_High_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[82])),
-            Topic("Z2_Heat_Curve_Outside_Low_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[81])),
-            Topic("Z2_Cool_Curve_Target_High_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[90])),
-            Topic("Z2_Cool_Curve_Target_Low_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[91])),
-            Topic("Z2_Cool_Curve_Outside_High_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[93])),
-            Topic("Z2_Cool_Curve_Outside_Low_Temp", descriptions.Celsius, lambda d: decode.int_minus_128(d[92])),
-            Topic("Room_Heater_Operations_Hours", descriptions.Hours, lambda d: decode.word(d[186], d[185]) - 1),
-            Topic("DHW_Heater_Operations_Hours", descriptions.Hours, lambda d: decode.word(d[189], d[188]) - 1),
-            Topic("Heat_Pump_Model", descriptions.Model, lambda d: decode.get_model(d)),
-            Topic("Pump_Duty", descriptions.Duty, lambda d: decode.int_minus_1(d[172])),
-            Topic("Zones_State", descriptions.ZonesState, lambda d: decode.bits_1_and_2(d[6])),
-            Topic("Max_Pump_Duty", descriptions.Duty, lambda d: decode.int_minus_1(d[45])),
-            Topic("Heater_Delay_Time", descriptions.Minutes, lambda d: decode.int_minus_1(d[104])),
-            Topic("Heater_Start_Delta", descriptions.Kelvin, lambda d: decode.int_minus_128(d[105])),
-            Topic("Heater_Stop_Delta", descriptions.Kelvin, lambda d: decode.int_minus_128(d[106])),
-            Topic("Buffer_Installed", descriptions.DisabledEnabled, lambda d: decode.bits_5_and_6(d[24])),
-            Topic("DHW_Installed", descriptions.DisabledEnabled, lambda d: decode.bits_7_and_8(d[24])),
-            Topic("Solar_Mode", descriptions.SolarModeDesc, lambda d: decode.bits_3_and_4(d[24])),
-            Topic("Solar_On_Delta", descriptions.Kelvin, lambda d: decode.int_minus_128(d[61])),
-            Topic("Solar_Off_Delta", descriptions.Kelvin, lambda d: decode.int_minus_128(d[62])),
-            Topic("Solar_Frost_Protection", descriptions.Celsius, lambda d: decode.int_minus_128(d[63])),
-            Topic("Solar_High_Limit", descriptions.Celsius, lambda d: decode.int_minus_128(d[64])),
-            Topic("Pump_Flowrate_Mode", descriptions.PumpFlowRateMode, lambda d: decode.bits_3_and_4(d[29])),
-            Topic("Liquid_Type", descriptions.LiquidType, lambda d: decode.bit_1(d[20])),
-            Topic("Alt_External_Sensor", descriptions.DisabledEnabled, lambda d: decode.bits_3_and_4(d[20])),
-            Topic("Anti_Freeze_Mode", descriptions.DisabledEnabled, lambda d: decode.bits_5_and_6(d[20])),
-            Topic("Optional_PCB", descriptions.DisabledEnabled, lambda d: decode.bits_7_and_8(d[20])),
-            Topic("Z1_Sensor_Settings", descriptions.ZonesSensorType, lambda d: decode.get_second_byte(d[22])),
-            Topic("Z2_Sensor_Settings", descriptions.ZonesSensorType, lambda d: decode.get_first_byte(d[22])),
-            Topic("Buffer_Tank_Delta", descriptions.Kelvin, lambda d: decode.int_minus_128(d[59])),
-            Topic("External_Pad_Heater", descriptions.ExtPadHeaterType, lambda d: decode.bits_3_and_4(d[25])),
-
-            Topic("Z1_Water_Pump", descriptions.OffOn, lambda d: d[4] >> 7, "optional"),
-            Topic("Z1_Mixing_Valve", descriptions.MixingValve, lambda d: (d[4] >> 5) & 0b11, "optional"),
-            Topic("Z2_Water_Pump", descriptions.OffOn, lambda d: (d[4] >> 4) & 0b1, "optional"),
-            Topic("Z2_Mixing_Valve", descriptions.MixingValve, lambda d: (d[4] >> 2) & 0b11, "optional"),
-            Topic("Pool_Water_Pump", descriptions.OffOn, lambda d: (d[4] >> 1) & 0b1, "optional"),
-            Topic("Solar_Water_Pump", descriptions.OffOn, lambda d: (d[4] >> 0) & 0b1, "optional"),
-            Topic("Alarm_State", descriptions.OffOn, lambda d: (d[5] >> 0) & 0b1, "optional")
-        ]
-
-    def decode_and_update(self, data: []) -> bool:
+        self.topics = [Topic(*row) for row in topicTable]
+        self.decoders = {"main": self.compile("main", 203), "optional": self.compile("optional", 20)}
+        # previous frame per type, copied in place so steady state decoding reuses the same buffers
+        self.lastFrame = {"main": bytearray(203), "optional": bytearray(20)}
+        self.lastFrameValid = {"main": False, "optional": False}
+        self.changed = []
+        self.dirtyBytes = set()
+        self.dirtyFrames = set()
+
+    def compile(self, topic_type: str, frame_size: int) -> ():
+        byte_topics = tuple((topic, topic.offsets[0], topic.values, topic.descriptions)
+                            for topic in self.topics if topic.type == topic_type and topic.values is not None)
+        frame_topics = tuple((topic, topic.fnc, topic.offsets)
+                             for topic in self.topics if topic.type == topic_type and topic.values is None)
+
+        # byte offset -> index of the topics reading that byte,
+        # e.g. byte 118 feeds Main_Inlet_Temp and Main_Outlet_Temp
+        byte_dependents = [() for _ in range(frame_size)]
+        for index, (_, offset, _, _) in enumerate(byte_topics):
+            byte_dependents[offset] += (index,)
+        frame_dependents = [() for _ in range(frame_size)]
+        for index, (_, _, offsets) in enumerate(frame_topics):
+            for offset in offsets:
+                frame_dependents[offset] += (index,)
+
+        return byte_topics, frame_topics, byte_dependents, frame_dependents
+
+    # the returned list of changed topics is reused and only valid until the next call
+    def decode_and_update(self, data: bytes) -> any:
         if not len(data) in [20, 203]:
-            return False
+            return None
 
         if not valid_checksum(data):
             logging.info("topics: invalid checksum received")
-            return False
+            return None
+
+        topic_type = "main" if len(data) == 203 else "optional"
+        byte_topics, frame_topics, byte_dependents, frame_dependents = self.decoders[topic_type]
+        last = self.lastFrame[topic_type]
+        self.changed.clear()
+
+        if not self.lastFrameValid[topic_type]:
+            last[:] = data
+            self.lastFrameValid[topic_type] = True
+            return self.decode(data, byte_topics, frame_topics)
+        if last == data:
+            return self.changed
 
-        if len(data) == 203:
-            for topic in self.topics:
-                if topic.type == "main":
-                    topic.update(data)
-            return True
+        # only re-evaluate topics depending on the bytes that differ from the previous frame
+        dirty_bytes = self.dirtyBytes
+        dirty_frames = self.dirtyFrames
+        dirty_bytes.clear()
+        dirty_frames.clear()
+        for offset in changed_offsets(last, data):
+            dirty_bytes.update(byte_dependents[offset])
+            dirty_frames.update(frame_dependents[offset])
+        last[:] = data
+        return self.decode(data,
+                           [byte_topics[index] for index in sorted(dirty_bytes)],
+                           [frame_topics[index] for index in sorted(dirty_frames)])
 
-        if len(data) == 20:
-            for topic in self.topics:
-                if topic.type == "optional":
-                    topic.update(data)
-            return True
+    def decode(self, data: bytes, byte_topics: (), frame_topics: ()) -> []:
+        changed = self.changed
+        since = time.monotonic()
+        for topic, offset, values, descriptions in byte_topics:
+            value = values[data[offset]]
+            if value != topic.value:
+                topic.value = value
+                topic.description = descriptions[data[offset]]
+                topic.since = since
+                topic.delegated = False
+                changed.append(topic)
 
-        return False
+        for topic, fnc, offsets in frame_topics:
+            value = fnc(*[data[offset] for offset in offsets])
+            if value != topic.value:
+                topic.value = value
+                topic.description = topic.describe(value)
+                topic.since = since
+                topic.delegated = False
+                changed.append(topic)
+        return changed
 
-    def print(self, since: datetime) -> None:
+    def print(self, since: float) -> None:
         for topic in self.topics:
             if topic.changed_since(since):
                 print(topic)